@@ -0,0 +1,142 @@
+import logging
+import os
+import struct
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from codec import encode_fetch_trigger
+from store import JsonStore, STATE_DIR
+
+__all__ = ['ActivitySync', 'ACTIVITY_RECORD']
+
+DEFAULT_STATE_PATH = os.path.join(STATE_DIR, 'activity_sync.json')
+# one record per minute: start of the minute (local epoch), kind, intensity, steps, heart rate
+ACTIVITY_RECORD = np.dtype([('t', '<u4'), ('kind', 'u1'), ('intensity', 'u1'),
+                            ('steps', 'u1'), ('heart_rate', 'u1')])
+_RAW_RECORD = np.dtype([('kind', 'u1'), ('intensity', 'u1'), ('steps', 'u1'), ('heart_rate', 'u1')])
+_HWM_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def _epoch(dt):
+    return int(time.mktime(dt.timetuple()))
+
+
+class ActivitySync(object):
+
+    """Incremental fetch of the band's stored per-minute activity history.
+
+    The last minute received from each band is persisted, so a sync only asks
+    for minutes the host has not seen yet. Records are decoded packet by packet
+    into ACTIVITY_RECORD arrays as they arrive.
+    """
+
+    IDLE = 'idle'
+    REQUESTED = 'requested'
+    RECEIVING = 'receiving'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, band, state=None, first_sync_days=7, timeout=60.0, idle_timeout=5.0):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.band = band
+        self.state_store = state if state is not None else JsonStore.shared(DEFAULT_STATE_PATH)
+        self.first_sync_days = first_sync_days
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.reset()
+
+    def reset(self):
+        self.state = self.IDLE
+        self.expected = 0
+        self.start = None
+        self.chunks = []
+        self.received = 0
+        self.callback = None
+        self._last_packet = None
+
+    def high_water_mark(self):
+        value = self.state_store.get(self.band.mac_address)
+        return datetime.strptime(value, _HWM_FORMAT) if value else None
+
+    def _since(self, since):
+        if since is not None:
+            return since
+        hwm = self.high_water_mark()
+        if hwm is not None:
+            return hwm + timedelta(minutes=1)
+        return (datetime.now() - timedelta(days=self.first_sync_days)).replace(second=0, microsecond=0)
+
+    # notifications ##########################################################
+
+    def on_fetch(self, data):
+        cmd = data[:3]
+        if cmd == b'\x10\x01\x01':
+            self.expected = struct.unpack_from('<I', data, 3)[0] if len(data) >= 7 else 0
+            if len(data) >= 13:
+                year, month, day, hour, minute = struct.unpack_from('<HBBBB', data, 7)
+                self.start = datetime(year, month, day, hour, minute)
+            if self.expected == 0:
+                self.state = self.DONE
+            else:
+                self.state = self.RECEIVING
+                self._last_packet = time.time()
+                self.band._char('CHARACTERISTIC_FETCH').write(b'\x02', False)
+        elif cmd == b'\x10\x02\x01':
+            self.state = self.DONE
+        else:
+            self._log.error("Activity fetch failed: " + repr(data))
+            self.state = self.FAILED
+
+    def on_data(self, data):
+        if self.state != self.RECEIVING:
+            return
+        self._last_packet = time.time()
+        # byte 0 is a packet counter, then 4 byte records
+        body = data[1:1 + (len(data) - 1) // 4 * 4]
+        raw = np.frombuffer(body, dtype=_RAW_RECORD)
+        records = np.empty(len(raw), dtype=ACTIVITY_RECORD)
+        records['t'] = _epoch(self.start) + 60 * (self.received + np.arange(len(raw)))
+        for name in _RAW_RECORD.names:
+            records[name] = raw[name]
+        self.received += len(raw)
+        self.chunks.append(records)
+        if self.callback:
+            self.callback(records)
+
+    # API ####################################################################
+
+    def sync(self, since=None, callback=None):
+        """Fetch everything after ``since`` (default: the stored high-water mark)."""
+        self.reset()
+        self.callback = callback
+        self.start = self._since(since)
+        band = self.band
+        band._activity_sync = self
+        started = time.time()
+        try:
+            band._desc('CHARACTERISTIC_FETCH').write(b'\x01\x00', True)
+            band._desc('CHARACTERISTIC_ACTIVITY_DATA').write(b'\x01\x00', True)
+            self._log.info("Trigger activity communication since %s", self.start)
+            band._char('CHARACTERISTIC_FETCH').write(encode_fetch_trigger(self.start), False)
+            self.state = self.REQUESTED
+            while self.state in (self.REQUESTED, self.RECEIVING):
+                with band._lock:
+                    band.waitForNotifications(0.5)
+                now = time.time()
+                idle = self._last_packet is not None and now - self._last_packet > self.idle_timeout
+                if now - started > self.timeout or idle:
+                    self._log.error("Activity fetch timed out after %d records", self.received)
+                    self.state = self.FAILED
+        finally:
+            band._activity_sync = None
+            band._desc('CHARACTERISTIC_ACTIVITY_DATA').write(b'\x00\x00', True)
+            band._desc('CHARACTERISTIC_FETCH').write(b'\x00\x00', True)
+
+        records = np.concatenate(self.chunks) if self.chunks else np.empty(0, dtype=ACTIVITY_RECORD)
+        if len(records):
+            last = datetime.fromtimestamp(int(records['t'][-1]))
+            self.state_store.set(band.mac_address, last.strftime(_HWM_FORMAT))
+        self.elapsed = time.time() - started
+        return records
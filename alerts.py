@@ -0,0 +1,263 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from bluepy.btle import BTLEException
+
+from constants import ALERT_TYPES
+from fleet import FleetStats
+
+__all__ = ['AlertDispatcher', 'Alert', 'PRIORITIES']
+
+# lower is sent first
+PRIORITIES = {
+    'call': 0,
+    'phone': 0,
+    'missed_call': 1,
+    'message': 2,
+}
+# kind -> plain alert type (no text) and custom alert type (with text)
+_TYPES = {
+    'call': (ALERT_TYPES.PHONE, 3),
+    'phone': (ALERT_TYPES.PHONE, 3),
+    'missed_call': (None, 4),
+    'message': (ALERT_TYPES.MESSAGE, 5),
+}
+
+
+class Alert(object):
+
+    """One queued alert; ``wait()`` for the outcome in ``state``."""
+
+    PENDING, SENT, FAILED, COALESCED, SUPERSEDED = 'pending', 'sent', 'failed', 'coalesced', 'superseded'
+
+    def __init__(self, mac_address, kind, text=None, key=None):
+        if kind not in PRIORITIES:
+            raise ValueError("unknown alert kind %r" % kind)
+        self.mac_address = mac_address
+        self.kind = kind
+        self.text = text
+        # alerts sharing a key replace each other while queued
+        self.key = key
+        self.priority = PRIORITIES[kind]
+        self.state = self.PENDING
+        self.attempts = 0
+        self.error = None
+        self.enqueued_at = time.time()
+        self.delivered_at = None
+        self._done = threading.Event()
+
+    @property
+    def latency(self):
+        return self.delivered_at - self.enqueued_at if self.delivered_at is not None else None
+
+    def _finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        if state == self.SENT:
+            self.delivered_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """True once the alert reached the band."""
+        self._done.wait(timeout)
+        return self.state == self.SENT
+
+    def __repr__(self):
+        return '<Alert %s %s %r %s>' % (self.mac_address, self.kind, self.text, self.state)
+
+
+class _BandQueue(object):
+
+    """Priority queue and sender thread of one band."""
+
+    def __init__(self, dispatcher, mac_address):
+        self.dispatcher = dispatcher
+        self.mac_address = mac_address
+        self._heap = []
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._tokens = float(dispatcher.burst)
+        self._refilled = time.time()
+        self._closed = False
+        # alert being written, if any
+        self._sending = None
+        self._thread = threading.Thread(target=self._run, name='miband-alerts-' + mac_address)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, alert):
+        with self._cond:
+            duplicate = self._pending.get(('same', alert.kind, alert.text))
+            if duplicate is not None:
+                self.dispatcher._count('coalesced')
+                alert._finish(Alert.COALESCED)
+                return duplicate
+            if alert.key is not None:
+                older = self._pending.pop(('key', alert.key), None)
+                if older is not None:
+                    # removed from the heap lazily, when it comes up
+                    self._pending.pop(('same', older.kind, older.text), None)
+                    older._finish(Alert.SUPERSEDED)
+                    self.dispatcher._count('superseded')
+                self._pending[('key', alert.key)] = alert
+            self._pending[('same', alert.kind, alert.text)] = alert
+            heapq.heappush(self._heap, (alert.priority, next(self.dispatcher._seq), alert))
+            self._cond.notify()
+        return alert
+
+    def _take(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].state != Alert.PENDING:
+                    heapq.heappop(self._heap)
+                if self._heap or self._closed:
+                    break
+                self._cond.wait()
+            if not self._heap:
+                return None
+            alert = self._sending = heapq.heappop(self._heap)[2]
+            if self._pending.get(('same', alert.kind, alert.text)) is alert:
+                del self._pending[('same', alert.kind, alert.text)]
+            if alert.key is not None and self._pending.get(('key', alert.key)) is alert:
+                del self._pending[('key', alert.key)]
+            return alert
+
+    def _throttle(self):
+        """Token bucket: ``rate`` alerts per second with bursts of ``burst``."""
+        rate, burst = self.dispatcher.rate, self.dispatcher.burst
+        if not rate:
+            return
+        now = time.time()
+        self._tokens = min(burst, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+        if self._tokens < 1.0:
+            time.sleep((1.0 - self._tokens) / rate)
+            self._tokens, self._refilled = 1.0, time.time()
+        self._tokens -= 1.0
+
+    def _run(self):
+        dispatcher = self.dispatcher
+        while True:
+            alert = self._take()
+            if alert is None:
+                return
+            self._throttle()
+            while True:
+                alert.attempts += 1
+                try:
+                    dispatcher._write(alert)
+                except Exception as e:
+                    # only BLE errors are worth a retry; anything else fails the alert, not the sender thread
+                    if not isinstance(e, BTLEException) or alert.attempts > dispatcher.max_retries:
+                        dispatcher._log.error("%s: %s alert failed: %s", self.mac_address, alert.kind, e)
+                        dispatcher.stats.record(alert.kind, 0.0, ok=False)
+                        alert._finish(Alert.FAILED, e)
+                        break
+                    time.sleep(dispatcher.retry_delay * alert.attempts)
+                else:
+                    alert._finish(Alert.SENT)
+                    dispatcher.stats.record(alert.kind, alert.latency)
+                    break
+            with self._cond:
+                self._sending = None
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def idle(self):
+        return self._sending is None and all(entry[2].state != Alert.PENDING for entry in self._heap)
+
+
+class AlertDispatcher(object):
+
+    """Queues alerts for many bands and sends them from one thread per band.
+
+    Per band, calls go before missed calls before messages. An alert equal
+    to one still queued is coalesced into it, and one with the ``key`` of a
+    queued alert replaces it (e.g. a conversation's newest message, or a
+    missed call replacing the call). Sends are limited to ``rate`` per second
+    with bursts of ``burst``. Failed writes are retried ``max_retries`` times.
+    ``stats.summary()`` has enqueue-to-delivered latency percentiles per kind.
+
+    ``bands`` maps MAC addresses to connected MiBand3 instances, e.g.
+    ``FleetManager.bands``.
+    """
+
+    def __init__(self, bands, rate=2.0, burst=3, max_retries=2, retry_delay=0.2):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.bands = bands
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.stats = FleetStats()
+        self.coalesced = 0
+        self.superseded = 0
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _queue(self, mac_address):
+        with self._lock:
+            queue = self._queues.get(mac_address)
+            if queue is None:
+                queue = self._queues[mac_address] = _BandQueue(self, mac_address)
+            return queue
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _write(self, alert):
+        band = self.bands[alert.mac_address]
+        plain, custom = _TYPES[alert.kind]
+        if alert.text is None and plain is not None:
+            band.send_alert(plain)
+        else:
+            band.send_custom_alert(custom, alert.text or '')
+
+    def send(self, mac_address, kind, text=None, key=None):
+        """Queue an alert and return it at once (or the queued alert it was coalesced into)."""
+        if mac_address not in self.bands:
+            raise ValueError("unknown band %s" % mac_address)
+        if kind not in _TYPES:
+            raise ValueError("unknown alert kind %r" % kind)
+        return self._queue(mac_address).put(Alert(mac_address, kind, text, key))
+
+    def broadcast(self, kind, text=None, key=None, mac_addresses=None):
+        mac_addresses = mac_addresses or list(self.bands)
+        unknown = [mac for mac in mac_addresses if mac not in self.bands]
+        if unknown:
+            # nothing is queued if any address is wrong
+            raise ValueError("unknown band(s) %s" % ', '.join(unknown))
+        return [self.send(mac, kind, text, key) for mac in mac_addresses]
+
+    def pending(self):
+        return dict((mac, len(queue)) for mac, queue in self._queues.items())
+
+    def flush(self, timeout=None):
+        """Wait until every queue is empty; False on timeout."""
+        deadline = time.time() + timeout if timeout is not None else None
+        for queue in list(self._queues.values()):
+            with queue._cond:
+                while not queue.idle():
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    queue._cond.wait(remaining)
+        return True
+
+    def close(self):
+        for queue in list(self._queues.values()):
+            queue.close()
+        self._queues = {}
@@ -1,52 +1,37 @@
 import struct
 import time
 import logging
-from datetime import datetime
-from Crypto.Cipher import AES
-from Queue import Queue, Empty
-from bluepy.btle import Peripheral, DefaultDelegate, ADDR_TYPE_RANDOM, BTLEException
-import crc16
+import threading
+from datetime import datetime, timedelta
+from bluepy.btle import Peripheral, DefaultDelegate, ADDR_TYPE_RANDOM, BTLEException, BTLEGattError
 import os
-import struct
 
-from constants import UUIDS, AUTH_STATES, ALERT_TYPES, QUEUE_TYPES
+import codec
+from handshake import AuthHandshake
+from channels import make_channels
+from stream import RealtimeStream
+from backoff import Backoff
+from scheduler import Scheduler
+from gatt_cache import HandleCache, ReadCache, CachedCharacteristic, CachedDescriptor, discover_handles
+from constants import UUIDS, AUTH_STATES, ALERT_TYPES, QUEUE_TYPES, LE_PROFILES
 
 
 class AuthenticationDelegate(DefaultDelegate):
 
-    """This Class inherits DefaultDelegate to handle the authentication process."""
+    """This Class inherits DefaultDelegate to route notifications to the device's per-type channels."""
 
     def __init__(self, device):
         DefaultDelegate.__init__(self)
         self.device = device
 
     def handleNotification(self, hnd, data):
-        if hnd == self.device._char_auth.getHandle():
-            if data[:3] == b'\x10\x01\x01':
-                self.device._req_rdn()
-            elif data[:3] == b'\x10\x01\x04':
-                self.device.state = AUTH_STATES.KEY_SENDING_FAILED
-            elif data[:3] == b'\x10\x02\x01':
-                # 16 bytes
-                random_nr = data[3:]
-                self.device._send_enc_rdn(random_nr)
-            elif data[:3] == b'\x10\x02\x04':
-                self.device.state = AUTH_STATES.REQUEST_RN_ERROR
-            elif data[:3] == b'\x10\x03\x01':
-                self.device.state = AUTH_STATES.AUTH_OK
-            elif data[:3] == b'\x10\x03\x04':
-                self.device.status = AUTH_STATES.ENCRIPTION_KEY_FAILED
-                self.device._send_key()
-            else:
-                self.device.state = AUTH_STATES.AUTH_FAILED
-        elif hnd == self.device._char_heart_measure.getHandle():
-            self.device.queue.put((QUEUE_TYPES.HEART, data))
-        elif hnd == 0x38:
-            # Not sure about this, need test
-            if len(data) == 20 and struct.unpack('b', data[0])[0] == 1:
-                self.device.queue.put((QUEUE_TYPES.RAW_ACCEL, data))
-            elif len(data) == 16:
-                self.device.queue.put((QUEUE_TYPES.RAW_HEART, data))
+        # handle -> decoder table is resolved once per handle discovery
+        handler = self.device._notification_handlers.get(hnd)
+        self.device.notification_count += 1
+        if handler is not None:
+            if self.device.metrics is not None:
+                self.device._count_notification(hnd, data)
+            handler(data)
         else:
             self.device._log.error("Unhandled Response " + hex(hnd) + ": " +
                                    str(data.encode("hex")) + " len:" + str(len(data)))
@@ -58,355 +43,760 @@ class MiBand3(Peripheral):
     _send_rnd_cmd = struct.pack('<2s', b'\x02\x08')
     _send_enc_key = struct.pack('<2s', b'\x03\x08')
 
-    def __init__(self, mac_address, timeout=0.5, debug=False):
+    def __init__(self, mac_address, timeout=0.5, debug=False, handle_cache=None, auth_timeout=10.0,
+                 iface=None, read_ttls=None, metrics=None, auto_reconnect=True, reconnect_attempts=10,
+                 backoff=None):
         FORMAT = '%(asctime)-15s %(name)s (%(levelname)s) > %(message)s'
         logging.basicConfig(format=FORMAT)
         log_level = logging.WARNING if not debug else logging.DEBUG
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.setLevel(log_level)
 
+        # optional metrics.Metrics registry, every series is labelled with the MAC address
+        self.metrics = metrics
+        self._labels = (('mac', mac_address.upper()),)
+
         self._log.info('Connecting to ' + mac_address)
-        Peripheral.__init__(self, mac_address, addrType=ADDR_TYPE_RANDOM)
+        started = time.time()
+        Peripheral.__init__(self, mac_address, addrType=ADDR_TYPE_RANDOM, iface=iface)
+        if metrics is not None:
+            metrics.observe('connect_seconds', self._labels, time.time() - started)
         self._log.info('Connected')
 
         self.timeout = timeout
         self.mac_address = mac_address
+        # realtime streams reconnect by themselves after a dropped link, giving up after
+        # ``reconnect_attempts`` (None: never) so the error reaches the callers
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_attempts = reconnect_attempts
+        self.backoff = backoff or Backoff()
+        # one dict per recovered drop, see reconnect()
+        self.reconnects = []
+        self.last_notification = None
+        self.notification_count = 0
+        # connection parameter profile last requested, and one dict per profile period, see set_connection_profile()
+        self.le_profile = None
+        self.le_history = []
+        self._le_stack = []
+        self._le_period = None
+        # realtime data was started and has to be restored after a reconnect
+        self._realtime = False
+        # keep-alives, polls and user jobs, run by run_pending() on the pump thread
+        self.scheduler = Scheduler(metrics, self._labels)
+        # latest results of schedule_polls()
+        self.polled = {}
         self.state = None
-        self.queue = Queue()
+        self.auth_timeout = auth_timeout
+        self.auth_timings = {}
+        self._auth = None
+        self.channels = make_channels()
+        self._channel_labels = dict((_type, self._labels + (('channel', _type),)) for _type in self.channels)
+        self._callback_labels = dict((kind, self._labels + (('callback', kind),))
+                                     for kind in ('heart', 'batch', 'legacy'))
+        # serializes GATT traffic between the caller and the realtime pump thread
+        self._lock = threading.RLock()
+        self._stream = None
+        self._activity = None
+        self._activity_sync = None
+        self._notification_handlers = {}
+        self._handle_names = {}
+        self._notification_series = {}
         self.heart_measure_callback = None
         self.heart_raw_callback = None
         self.accel_raw_callback = None
-
-        self.svc_1 = self.getServiceByUUID(UUIDS.SERVICE_MIBAND1)
-        self.svc_2 = self.getServiceByUUID(UUIDS.SERVICE_MIBAND2)
-        self.svc_heart = self.getServiceByUUID(UUIDS.SERVICE_HEART_RATE)
-
-        self._char_auth = self.svc_2.getCharacteristics(UUIDS.CHARACTERISTIC_AUTH)[0]
-        self._desc_auth = self._char_auth.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
-
-        self._char_heart_ctrl = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)[0]
-        self._char_heart_measure = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)[0]
+        self.heart_raw_batch_callback = None
+        self.accel_raw_batch_callback = None
+        # fanout.FanOut, created by the first subscribe()
+        self.fanout = None
+        # raw sensor payloads go to raw_sink(data, timestamp) instead of the channels when set,
+        # e.g. by workers.WorkerPool.attach
+        self.raw_sink = None
+        # NumPy ring buffers, created when the first raw packet arrives
+        self._accel_buffer = None
+        self._ppg_buffer = None
+
+        self.handle_cache = handle_cache if handle_cache is not None else HandleCache.shared()
+        self.read_cache = ReadCache(read_ttls)
+        self._handles = None
+        self._load_handles()
+
+        self._char_auth = self._char('CHARACTERISTIC_AUTH')
+        self._char_heart_ctrl = self._char('CHARACTERISTIC_HEART_RATE_CONTROL')
+        self._char_heart_measure = self._char('CHARACTERISTIC_HEART_RATE_MEASURE')
 
         # Enable auth service notifications on startup
         self._auth_notif(True)
         # Let band to settle
         self.waitForNotifications(0.1)
 
+    # GATT helpers ######################################################################
+
+    def _load_handles(self):
+        entry = self.handle_cache.get(self.mac_address)
+        if entry:
+            try:
+                hnd = entry['handles']['chars']['CHARACTERISTIC_REVISION']
+                revision = self.readCharacteristic(hnd)
+                if revision == entry['revision'].encode('latin-1'):
+                    self._handles = entry['handles']
+                    self._build_notification_handlers()
+                    # the revision read doubles as the first snapshot value
+                    self.read_cache.put('CHARACTERISTIC_REVISION', revision)
+                    for name, value in entry.get('info', {}).items():
+                        self.read_cache.put(name, value.encode('latin-1'))
+                    self._log.info('Using cached GATT handles')
+                    return
+            except (BTLEGattError, KeyError):
+                pass
+            self._log.info('Cached GATT handles are stale')
+        self._discover_handles()
+
+    def _discover_handles(self):
+        self._log.info('Discovering GATT handles...')
+        self._handles = discover_handles(self)
+        self._build_notification_handlers()
+        revision = self.readCharacteristic(self._handles['chars']['CHARACTERISTIC_REVISION'])
+        self.handle_cache.store(self.mac_address, revision.decode('latin-1'), self._handles)
+        self.read_cache.invalidate()
+        self.read_cache.put('CHARACTERISTIC_REVISION', revision)
+
+    def _handle(self, name):
+        return self._handles['chars'].get(name)
+
+    def _char(self, name):
+        return CachedCharacteristic(self, name)
+
+    def _desc(self, name):
+        return CachedDescriptor(self, name)
+
+    def _lookup(self, table, name):
+        # the band's firmware does not have every characteristic, that is no reason to rediscover
+        handle = self._handles[table].get(name)
+        if handle is None:
+            raise BTLEGattError("no %s %s" % ('characteristic' if table == 'chars' else 'descriptor for', name))
+        return handle
+
+    def _handle_op(self, kind, op, table, name, *args):
+        metrics = self.metrics
+        with self._lock:
+            if metrics is not None:
+                started = time.time()
+            handle = self._lookup(table, name)
+            try:
+                res = op(handle, *args)
+            except BTLEGattError:
+                # handles moved (firmware update?), rediscover once and retry
+                self.handle_cache.invalidate(self.mac_address)
+                self._discover_handles()
+                if metrics is not None:
+                    metrics.inc('gatt_rediscoveries', self._labels)
+                res = op(self._lookup(table, name), *args)
+            if metrics is not None:
+                metrics.observe('gatt_seconds', self._labels + (('op', kind), ('char', name)),
+                                time.time() - started)
+            return res
+
+    def _read(self, name):
+        return self._handle_op('read', self.readCharacteristic, 'chars', name)
+
+    def _read_cached(self, name):
+        """``(value, read_at)`` from the read cache, reading the band on a miss."""
+        entry = self.read_cache.lookup(name)
+        if entry is None:
+            entry = self.read_cache.put(name, self._read(name))
+            if self.read_cache.is_permanent(name):
+                self.handle_cache.store_info(self.mac_address, name, entry[0].decode('latin-1'))
+        return entry
+
+    def _read_fresh(self, name):
+        # getters always read the band, but their result also serves later snapshots
+        return self.read_cache.put(name, self._read(name))[0]
+
+    def _write(self, name, data, withResponse=False):
+        return self._handle_op('write', self.writeCharacteristic, 'chars', name, data, withResponse)
+
+    def _write_desc(self, name, data):
+        # notification descriptor of the given characteristic
+        return self._handle_op('write_desc', self.writeCharacteristic, 'descs', name, data, True)
+
+    # Notification dispatch ###########################################################
+
+    def _build_notification_handlers(self):
+        handlers = {
+            'CHARACTERISTIC_AUTH': self._on_auth_notification,
+            'CHARACTERISTIC_HEART_RATE_MEASURE': self._on_heart_measure,
+            'CHARACTERISTIC_HZ': self._on_sensor_data,
+            'CHARACTERISTIC_FETCH': self._on_fetch_notification,
+            'CHARACTERISTIC_ACTIVITY_DATA': self._on_activity_data,
+        }
+        self._notification_handlers = dict((self._handle(name), handler)
+                                           for name, handler in handlers.items()
+                                           if self._handle(name) is not None)
+        self._handle_names = dict((hnd, name) for name, hnd in self._handles['chars'].items())
+        self._notification_series = {}
+
+    def _count_notification(self, hnd, data):
+        series = self._notification_series.get(hnd)
+        if series is None:
+            labels = self._labels + (('char', self._handle_names.get(hnd, hex(hnd))),)
+            series = self._notification_series[hnd] = (self.metrics.counter('notifications', labels),
+                                                        self.metrics.counter('notification_bytes', labels))
+        series[0].value += 1
+        series[1].value += len(data)
+
+    def _on_auth_notification(self, data):
+        if self._auth is not None and not self._auth.done:
+            self._auth.on_notification(data)
+        else:
+            self.channels[QUEUE_TYPES.AUTH].put((data, time.time()))
+
+    def _on_heart_measure(self, data):
+        self.last_notification = ts = time.time()
+        self.channels[QUEUE_TYPES.HEART].put((data, ts))
+
+    def _on_sensor_data(self, data):
+        self.last_notification = ts = time.time()
+        if self.raw_sink is not None:
+            self.raw_sink(data, ts)
+        elif len(data) == 20 and data[0:1] == b'\x01':
+            self.channels[QUEUE_TYPES.RAW_ACCEL].put((data, ts))
+        elif len(data) == 16:
+            self.channels[QUEUE_TYPES.RAW_HEART].put((data, ts))
+
+    def _on_fetch_notification(self, data):
+        if self._activity_sync is not None:
+            self._activity_sync.on_fetch(data)
+
+    def _on_activity_data(self, data):
+        if self._activity_sync is not None:
+            self._activity_sync.on_data(data)
+
     # Auth helpers ######################################################################
 
     def _auth_notif(self, enabled):
         if enabled:
             self._log.info("Enabling Auth Service notifications status...")
-            self._desc_auth.write(b"\x01\x00", True)
+            self._write_desc('CHARACTERISTIC_AUTH', b"\x01\x00")
         elif not enabled:
             self._log.info("Disabling Auth Service notifications status...")
-            self._desc_auth.write(b"\x00\x00", True)
+            self._write_desc('CHARACTERISTIC_AUTH', b"\x00\x00")
         else:
             self._log.error("Something went wrong while changing the Auth Service notifications status...")
 
     def _encrypt(self, message):
+        # pycrypto is only loaded by the commands that authenticate
+        from Crypto.Cipher import AES
         aes = AES.new(self._KEY, AES.MODE_ECB)
         return aes.encrypt(message)
 
     def _send_key(self):
         self._log.info("Sending Key...")
         self._char_auth.write(self._send_key_cmd)
-        self.waitForNotifications(self.timeout)
 
     def _req_rdn(self):
         self._log.info("Requesting random number...")
         self._char_auth.write(self._send_rnd_cmd)
-        self.waitForNotifications(self.timeout)
 
     def _send_enc_rdn(self, data):
         self._log.info("Sending encrypted random number")
         cmd = self._send_enc_key + self._encrypt(data)
         send_cmd = struct.pack('<18s', cmd)
         self._char_auth.write(send_cmd)
-        self.waitForNotifications(self.timeout)
+
+    def _run_auth(self, send_key):
+        self._auth = AuthHandshake(self, step_timeout=max(self.timeout, 1.0), timeout=self.auth_timeout)
+        self.setDelegate(AuthenticationDelegate(self))
+        self._auth.start(send_key)
+        while not self._auth.done:
+            # returns as soon as the band answers, the deadline only bounds the wait
+            # (bluepy blocks forever on a zero timeout)
+            self.waitForNotifications(max(self._auth.time_left(), 0.001))
+            self._auth.poll()
+        self.state = self._auth.state
+        self.auth_timings = self._auth.timings
+        if self.metrics is not None and 'total' in self.auth_timings:
+            result = 'ok' if self.state == AUTH_STATES.AUTH_OK else 'failed'
+            self.metrics.observe('auth_seconds', self._labels + (('result', result),), self.auth_timings['total'])
+        self._log.info('Auth timings: ' + ', '.join(
+            '%s=%.1fms' % (k, v * 1000) for k, v in sorted(self.auth_timings.items())))
+        return self.state == AUTH_STATES.AUTH_OK
+
+    # Reconnect #######################################################################
+
+    def reconnect(self, max_attempts=None):
+        """Reconnect after a dropped link, re-authenticate and restore realtime notifications.
+
+        Attempts are spaced by ``self.backoff``, without holding the link lock
+        in between; gives up with the last error after ``max_attempts``. Returns a dict describing the recovery, which
+        is also appended to ``self.reconnects``.
+        """
+        detected = time.time()
+        error = None
+        for attempt, delay in enumerate(self.backoff.delays(max_attempts), 1):
+            try:
+                with self._lock:
+                    self._reconnect_once()
+                break
+            except BTLEException as e:
+                error = e
+                self._log.warning("Reconnect attempt %d failed: %s", attempt, e)
+                if max_attempts is not None and attempt >= max_attempts:
+                    raise
+                # other callers fail fast on the dead link instead of waiting out the backoff
+                time.sleep(delay)
+        recovered = time.time()
+        res = {"detected": detected, "recovered": recovered, "attempts": attempt,
+               "recovery_seconds": recovered - detected, "last_notification": self.last_notification,
+               "error": str(error) if error is not None else None}
+        self.reconnects.append(res)
+        if self.metrics is not None:
+            self.metrics.inc('reconnects', self._labels)
+            self.metrics.observe('recovery_seconds', self._labels, res['recovery_seconds'])
+        self._log.info("Reconnected after %d attempt(s) in %.0f ms", attempt, res['recovery_seconds'] * 1000)
+        return res
+
+    def _reconnect_once(self):
+        try:
+            self.disconnect()
+        except BTLEException:
+            pass
+        started = time.time()
+        self._connect(self.mac_address, ADDR_TYPE_RANDOM, self.iface)
+        if self.metrics is not None:
+            self.metrics.observe('connect_seconds', self._labels, time.time() - started)
+        self._auth_notif(True)
+        if not self._run_auth(send_key=False):
+            raise BTLEException("Re-authentication failed: %s" % self.state)
+        if self.le_profile is not None:
+            # a new link starts from the parameters the host picks
+            self._request_le_params(self.le_profile)
+        if self._realtime:
+            self._enable_realtime()
+
+    # Scheduler #######################################################################
+
+    def run_pending(self, timeout=1.0):
+        """One turn of the connection's event loop.
+
+        Waits for a notification until the next scheduled job is due (at most
+        ``timeout`` seconds), hands queued data to the callbacks and runs the
+        jobs that are due. Returns the number of jobs run.
+        """
+        with self._lock:
+            self.waitForNotifications(self.scheduler.timeout(timeout))
+        self._parse_queue()
+        return self.scheduler.run_due()
+
+    def run(self, seconds=None):
+        """Run the event loop for ``seconds`` (or forever), e.g. to serve schedule_polls() without a stream."""
+        deadline = time.time() + seconds if seconds is not None else None
+        while deadline is None or time.time() < deadline:
+            self.run_pending(1.0 if deadline is None else max(0.0, min(1.0, deadline - time.time())))
+
+    def keep_alive(self):
+        """Heart rate ping, the band stops continuous measuring without one every ~15 sec."""
+        self._char_heart_ctrl.write(b'\x16', True)
+
+    def schedule_polls(self, battery=600, steps=60, time_drift=3600, callback=None):
+        """Poll battery, steps and the band clock's drift every so many seconds (None disables one).
+
+        Results land in ``self.polled`` (``time_drift`` in seconds, positive
+        when the band runs ahead) and are passed to ``callback(name, value)``;
+        with a metrics registry they are also exported as gauges.
+        """
+        polls = (('battery', battery, lambda: self.get_battery_info()),
+                 ('steps', steps, lambda: self.get_steps()),
+                 ('time_drift', time_drift, self._time_drift))
+        jobs = []
+        for name, interval, read in polls:
+            if interval is None:
+                self.scheduler.cancel('poll_' + name)
+                continue
+            jobs.append(self.scheduler.every(interval, self._poll_job(name, read, callback), name='poll_' + name,
+                                             delay=0))
+        return jobs
+
+    def _poll_job(self, name, read, callback):
+        gauge = {'battery': ('battery_level', 'level'), 'steps': ('steps', 'steps')}.get(name)
+
+        def poll():
+            value = read()
+            self.polled[name] = value
+            if self.metrics is not None:
+                if gauge is not None:
+                    self.metrics.set(gauge[0], self._labels, value[gauge[1]])
+                else:
+                    self.metrics.set('time_drift_seconds', self._labels, value)
+            if callback is not None:
+                callback(name, value)
+        return poll
+
+    def _time_drift(self):
+        with self._lock:
+            current = self.get_current_time()
+            now = datetime.now()
+        drift = (current['date'] - now).total_seconds()
+        if current['fractions256'] is not None:
+            drift += current['fractions256'] / 256.0
+        return drift
+
+    # Connection parameters ###########################################################
+
+    def set_connection_profile(self, profile):
+        """Ask the band to renegotiate the connection, with an LE_PROFILES name or a parameter tuple.
+
+        Returns the parameters read back from the band in milliseconds
+        (None if it has no CHARACTERISTIC_LE_PARAMS). The notification rate
+        seen under the previous profile is logged and kept in ``le_history``.
+        """
+        with self._lock:
+            if self._le_period is not None and profile == self.le_profile:
+                return self._le_period['achieved']
+            self._end_le_period()
+            achieved = self._request_le_params(profile)
+            self.le_profile = profile
+            self._le_period = {"profile": profile, "achieved": achieved, "started": time.time(),
+                               "notifications": self.notification_count}
+        return achieved
+
+    def push_connection_profile(self, profile):
+        """Switch to ``profile`` until the matching pop_connection_profile()."""
+        self._le_stack.append(self.le_profile)
+        return self.set_connection_profile(profile)
+
+    def pop_connection_profile(self):
+        """Restore the profile from before the last push; Gadgetbridge's high latency one if there was none."""
+        previous = self._le_stack.pop() if self._le_stack else None
+        return self.set_connection_profile(previous or 'background')
+
+    def connection_profile(self, profile):
+        """``with band.connection_profile('bulk'):`` switches for the block and restores the previous profile."""
+        return _ProfileSwitch(self, profile)
+
+    def _request_le_params(self, profile):
+        params = LE_PROFILES[profile] if isinstance(profile, basestring) else tuple(profile)
+        if self._handle('CHARACTERISTIC_LE_PARAMS') is None:
+            self._log.debug("No LE params characteristic, keeping the negotiated connection parameters")
+            return None
+        char = self._char('CHARACTERISTIC_LE_PARAMS')
+        char.write(codec.encode_le_params(*params), True)
+        try:
+            achieved = codec.decode_le_params(char.read())
+        except BTLEGattError:
+            achieved = None
+        self._log.info("Connection profile %s: requested %s, band reports %s", profile, params, achieved)
+        return achieved
+
+    def _end_le_period(self):
+        period, self._le_period = self._le_period, None
+        if period is None:
+            return
+        period['seconds'] = time.time() - period['started']
+        period['notifications'] = self.notification_count - period['notifications']
+        period['notifications_per_sec'] = period['notifications'] / period['seconds'] if period['seconds'] else 0.0
+        self.le_history.append(period)
+        self._log.info("Connection profile %s: %d notifications in %.1f s (%.1f/s)", period['profile'],
+                       period['notifications'], period['seconds'], period['notifications_per_sec'])
 
     # Parse helpers ###################################################################
 
     def _parse_raw_accel(self, bytes):
-        res = []
-        for i in xrange(3):
-            g = struct.unpack('hhh', bytes[2 + i * 6:8 + i * 6])
-            res.append({'x': g[0], 'y': g[1], 'wtf': g[2]})
-        return res
+        return codec.decode_accel(bytes)
 
     def _parse_raw_heart(self, bytes):
-        res = struct.unpack('HHHHHHH', bytes[2:])
-        return res
+        return codec.decode_ppg(bytes)
 
     def _parse_date(self, bytes):
-        year = struct.unpack('h', bytes[0:2])[0] if len(bytes) >= 2 else None
-        month = struct.unpack('b', bytes[2])[0] if len(bytes) >= 3 else None
-        day = struct.unpack('b', bytes[3])[0] if len(bytes) >= 4 else None
-        hours = struct.unpack('b', bytes[4])[0] if len(bytes) >= 5 else None
-        minutes = struct.unpack('b', bytes[5])[0] if len(bytes) >= 6 else None
-        seconds = struct.unpack('b', bytes[6])[0] if len(bytes) >= 7 else None
-        day_of_week = struct.unpack('b', bytes[7])[0] if len(bytes) >= 8 else None
-        fractions256 = struct.unpack('b', bytes[8])[0] if len(bytes) >= 9 else None
-
-        return {"date": datetime(*(year, month, day, hours, minutes, seconds)), "day_of_week": day_of_week, "fractions256": fractions256}
+        return codec.decode_current_time(bytes)
 
     def _parse_battery_response(self, bytes):
-        level = struct.unpack('b', bytes[1])[0] if len(bytes) >= 2 else None
-        last_level = struct.unpack('b', bytes[19])[0] if len(bytes) >= 20 else None
-        status = 'normal' if struct.unpack('b', bytes[2])[0] == 0 else "charging"
-        datetime_last_charge = self._parse_date(bytes[11:18])
-        datetime_last_off = self._parse_date(bytes[3:10])
-
-        res = {
-            "status": status,
-            "level": level,
-            "last_level": last_level,
-            "last_level": last_level,
-            "last_charge": datetime_last_charge,
-            "last_off": datetime_last_off
-        }
-        return res
+        return codec.decode_battery(bytes)
+
+    def _parse_serial(self, data):
+        return codec.decode_serial(data)
+
+    def _parse_steps(self, a):
+        return codec.decode_steps(a)
 
     # Queue ###################################################################
 
     def _get_from_queue(self, _type):
-        try:
-            res = self.queue.get(False)
-        except Empty:
-            return None
-        if res[0] != _type:
-            self.queue.put(res)
-            return None
-        return res[1]
+        res = self.channels[_type].get()
+        return res[0] if res is not None else None
 
     def _parse_queue(self):
-        while True:
-            try:
-                res = self.queue.get(False)
-                _type = res[0]
-                if self.heart_measure_callback and _type == QUEUE_TYPES.HEART:
-                    self.heart_measure_callback(struct.unpack('bb', res[1])[1])
-                elif self.heart_raw_callback and _type == QUEUE_TYPES.RAW_HEART:
-                    self.heart_raw_callback(self._parse_raw_heart(res[1]))
-                elif self.accel_raw_callback and _type == QUEUE_TYPES.RAW_ACCEL:
-                    self.accel_raw_callback(self._parse_raw_accel(res[1]))
-            except Empty:
-                break
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+            for _type, channel in self.channels.items():
+                metrics.set('queue_depth', self._channel_labels[_type], len(channel))
+                metrics.set('queue_dropped', self._channel_labels[_type], channel.dropped)
+        fanout = self.fanout
+        for data, ts in self.channels[QUEUE_TYPES.HEART].drain():
+            bpm = codec.decode_heart_measure(data)
+            if self.heart_measure_callback:
+                self._run_callback('heart', self.heart_measure_callback, bpm)
+            if fanout is not None:
+                fanout.publish(QUEUE_TYPES.HEART, bpm)
+        channel = self.channels[QUEUE_TYPES.RAW_HEART]
+        if len(channel):
+            ring = self.ppg_buffer
+            for data, ts in channel.drain():
+                ring.append(data, ts)
+        channel = self.channels[QUEUE_TYPES.RAW_ACCEL]
+        if len(channel):
+            ring = self.accel_buffer
+            for data, ts in channel.drain():
+                ring.append(data, ts)
+        # raw packets are decoded in one batch per drain
+        if self._ppg_buffer is not None:
+            self._dispatch_batch(QUEUE_TYPES.RAW_HEART, self._ppg_buffer.flush(), self.heart_raw_batch_callback,
+                                 self.heart_raw_callback, self._ppg_buffer.legacy)
+        if self._accel_buffer is not None:
+            self._dispatch_batch(QUEUE_TYPES.RAW_ACCEL, self._accel_buffer.flush(), self.accel_raw_batch_callback,
+                                 self.accel_raw_callback, self._accel_buffer.legacy)
+        if metrics is not None:
+            metrics.observe('parse_queue_seconds', self._labels, time.time() - started)
+
+    @property
+    def ppg_buffer(self):
+        if self._ppg_buffer is None:
+            from decode import PpgRing
+            self._ppg_buffer = PpgRing()
+        return self._ppg_buffer
+
+    @property
+    def accel_buffer(self):
+        if self._accel_buffer is None:
+            from decode import AccelRing
+            self._accel_buffer = AccelRing()
+        return self._accel_buffer
+
+    def _run_callback(self, kind, callback, *args):
+        if self.metrics is None:
+            return callback(*args)
+        started = time.time()
+        try:
+            return callback(*args)
+        finally:
+            self.metrics.observe('callback_seconds', self._callback_labels[kind], time.time() - started)
+
+    def _dispatch_batch(self, _type, columns, batch_callback, legacy_callback, legacy):
+        if columns is None:
+            return
+        if batch_callback:
+            self._run_callback('batch', batch_callback, columns)
+        if legacy_callback:
+            self._run_callback('legacy', self._call_legacy, legacy_callback, legacy(columns))
+        if self.fanout is not None:
+            self.fanout.publish(_type, columns)
+
+    def _call_legacy(self, callback, samples):
+        for sample in samples:
+            callback(sample)
 
     # API ####################################################################
 
     def initialize(self):
-        self.setDelegate(AuthenticationDelegate(self))
-        self._send_key()
-
-        while True:
-            self.waitForNotifications(0.1)
-            if self.state == AUTH_STATES.AUTH_OK:
-                self._log.info('Initialized')
-                self._auth_notif(False)
-                return True
-            elif self.state is None:
-                continue
-
-            self._log.error(self.state)
-            return False
+        if self._run_auth(send_key=True):
+            self._log.info('Initialized')
+            self._auth_notif(False)
+            return True
+        self._log.error(self.state)
+        return False
 
     def authenticate(self):
-        self.setDelegate(AuthenticationDelegate(self))
-        self._req_rdn()
-
-        while True:
-            self.waitForNotifications(0.1)
-            if self.state == AUTH_STATES.AUTH_OK:
-                self._log.info('Authenticated')
-                return True
-            elif self.state is None:
-                continue
-
-            self._log.error(self.state)
-            return False
+        # fast path: the key is already paired, go straight to the challenge
+        if self._run_auth(send_key=False):
+            self._log.info('Authenticated')
+            return True
+        self._log.error(self.state)
+        return False
 
     def get_sensor_info(self):
-        char = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_SENSOR)[0]
+        char = self._char('CHARACTERISTIC_SENSOR')
         return self._parse_raw_accel(char.read())
 
     def get_battery_info(self):
-        char = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_BATTERY)[0]
-        return self._parse_battery_response(char.read())
+        return self._parse_battery_response(self._read_fresh('CHARACTERISTIC_BATTERY'))
 
     def get_current_time(self):
-        char = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_CURRENT_TIME)[0]
-        return self._parse_date(char.read()[0:9])
+        return self._parse_date(self._read_fresh('CHARACTERISTIC_CURRENT_TIME'))
 
     def get_revision(self):
-        svc = self.getServiceByUUID(UUIDS.SERVICE_DEVICE_INFO)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_REVISION)[0]
-        data = char.read()
-        return data
+        # fixed for the lifetime of a firmware, served from the read cache
+        return self._read_cached('CHARACTERISTIC_REVISION')[0]
 
     def get_hrdw_revision(self):
-        svc = self.getServiceByUUID(UUIDS.SERVICE_DEVICE_INFO)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_HRDW_REVISION)[0]
-        data = char.read()
-        return data
+        return self._read_cached('CHARACTERISTIC_HRDW_REVISION')[0]
 
     def set_encoding(self, encoding="en_US"):
-        char = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_CONFIGURATION)[0]
-        packet = struct.pack('5s', encoding)
-        packet = b'\x06\x17\x00' + packet
-        return char.write(packet)
+        char = self._char('CHARACTERISTIC_CONFIGURATION')
+        return char.write(codec.encode_encoding(encoding))
 
     def set_heart_monitor_sleep_support(self, enabled=True, measure_minute_interval=1):
-        char_m = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)[0]
-        char_d = char_m.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
+        char_d = self._desc('CHARACTERISTIC_HEART_RATE_MEASURE')
         char_d.write(b'\x01\x00', True)
         self._char_heart_ctrl.write(b'\x15\x00\x00', True)
         # measure interval set to off
-        self._char_heart_ctrl.write(b'\x14\x00', True)
+        self._char_heart_ctrl.write(codec.encode_heart_interval(0), True)
         if enabled:
             self._char_heart_ctrl.write(b'\x15\x00\x01', True)
             # measure interval set
-            self._char_heart_ctrl.write(b'\x14' + str(measure_minute_interval).encode(), True)
+            self._char_heart_ctrl.write(codec.encode_heart_interval(measure_minute_interval), True)
         char_d.write(b'\x00\x00', True)
 
     def get_serial(self):
-        svc = self.getServiceByUUID(UUIDS.SERVICE_DEVICE_INFO)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_SERIAL)[0]
-        data = char.read()
-        serial = struct.unpack('12s', data[-12:])[0] if len(data) == 12 else None
-        return serial
+        return self._parse_serial(self._read_cached('CHARACTERISTIC_SERIAL')[0])
 
     def get_steps(self):
-        char = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_STEPS)[0]
-        a = char.read()
-        steps = struct.unpack('h', a[1:3])[0] if len(a) >= 3 else None
-        meters = struct.unpack('h', a[5:7])[0] if len(a) >= 7 else None
-        fat_gramms = struct.unpack('h', a[2:4])[0] if len(a) >= 4 else None
-        # why only 1 byte??
-        callories = struct.unpack('b', a[9])[0] if len(a) >= 10 else None
+        return self._parse_steps(self._read_fresh('CHARACTERISTIC_STEPS'))
+
+    def get_snapshot(self, refresh=False):
+        """Device info, battery, steps and time in one pass, served from the read cache where fresh.
+
+        Info fields are read once per firmware, battery/steps/time once per
+        TTL (see ``read_ttls``); ``refresh`` re-reads the latter.
+        """
+        if refresh:
+            for name in ('CHARACTERISTIC_BATTERY', 'CHARACTERISTIC_STEPS', 'CHARACTERISTIC_CURRENT_TIME'):
+                self.read_cache.invalidate(name)
+        with self._lock:
+            revision = self._read_cached('CHARACTERISTIC_REVISION')[0]
+            hrdw_revision = self._read_cached('CHARACTERISTIC_HRDW_REVISION')[0]
+            serial = self._read_cached('CHARACTERISTIC_SERIAL')[0]
+            battery = self._read_cached('CHARACTERISTIC_BATTERY')[0]
+            steps = self._read_cached('CHARACTERISTIC_STEPS')[0]
+            clock, read_at = self._read_cached('CHARACTERISTIC_CURRENT_TIME')
+        current_time = self._parse_date(clock)
+        # the band clock kept running since it was read
+        current_time['date'] += timedelta(seconds=int(self.read_cache.clock() - read_at))
         return {
-            "steps": steps,
-            "meters": meters,
-            "fat_gramms": fat_gramms,
-            "callories": callories
+            "revision": revision,
+            "hrdw_revision": hrdw_revision,
+            "serial": self._parse_serial(serial),
+            "battery": self._parse_battery_response(battery),
+            "steps": self._parse_steps(steps),
+            "time": current_time,
         }
 
     def send_alert(self, _type):
-        svc = self.getServiceByUUID(UUIDS.SERVICE_ALERT)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_ALERT)[0]
+        char = self._char('CHARACTERISTIC_ALERT')
         char.write(_type)
 
     def left_turn(self):
-        base_value = '\x05\x01'
-        turn1 = ("Left Turn!")
-        svc = self.getServiceByUUID(UUIDS.SERVICE_ALERT_NOTIFICATION)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)[0]
-        char.write(base_value+turn1, withResponse=True)
+        char = self._char('CHARACTERISTIC_CUSTOM_ALERT')
+        char.write(codec.encode_custom_alert(5, "Left Turn!"), withResponse=True)
 
     def right_turn(self):
-        base_value = '\x05\x01'
-        turn2 = ("Right Turn!")
-        svc = self.getServiceByUUID(UUIDS.SERVICE_ALERT_NOTIFICATION)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)[0]
-        char.write(base_value+turn2, withResponse=True)
-
-    def send_custom_alert(self, type):
-        if type == 5:
-            base_value = '\x05\x01'
-        elif type == 4:
-            base_value = '\x04\x01'
-        elif type == 3:
-                base_value = '\x03\x01'
-        phone = raw_input("Sender Name or Caller ID")
-        svc = self.getServiceByUUID(UUIDS.SERVICE_ALERT_NOTIFICATION)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)[0]
-        char.write(base_value+phone, withResponse=True)
+        char = self._char('CHARACTERISTIC_CUSTOM_ALERT')
+        char.write(codec.encode_custom_alert(5, "Right Turn!"), withResponse=True)
+
+    def send_custom_alert(self, type, phone=None):
+        if phone is None:
+            phone = raw_input("Sender Name or Caller ID")
+        char = self._char('CHARACTERISTIC_CUSTOM_ALERT')
+        char.write(codec.encode_custom_alert(type, phone), withResponse=True)
+
+    def set_time(self, value=None):
+        """Set the band clock to ``value`` (a datetime, default now)."""
+        value = value or datetime.now()
+        char = self._char('CHARACTERISTIC_CURRENT_TIME')
+        char.write(codec.encode_current_time(value), withResponse=True)
+        self.read_cache.invalidate('CHARACTERISTIC_CURRENT_TIME')
+        return value
 
     def change_date(self):
         print("Change date and time")
-        svc = self.getServiceByUUID(UUIDS.SERVICE_MIBAND1)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_CURRENT_TIME)[0]
         date = raw_input("Enter the date in dd-mm-yyyy format\n")
         time = raw_input("Enter the time in HH:MM:SS format\n")
-        #
-        day = int(date[:2])
-        month = int(date[3:5])
-        year = int(date[6:10])
-        fraction = year / 256
-        rem = year % 256
-        #
-        hour = int(time[:2])
-        minute = int(time[3:5])
-        seconds =  int(time[6:])
-        #
-        write_val = format(rem, '#04x') + format(fraction, '#04x') + format(month, '#04x') + format(day, '#04x') + format(hour, '#04x') + format(minute, '#04x') + format(seconds, '#04x') + format(5, '#04x') + format(0, '#04x') + format(0, '#04x') +'0x16'
-        write_val = write_val.replace('0x', '\\x')
-        print(write_val)
-        char.write(write_val, withResponse=True)
+        self.set_time(datetime.strptime(date + ' ' + time, '%d-%m-%Y %H:%M:%S'))
         raw_input("Date Changed, press any key to continue")
-    def dfuUpdate(self, fileName):
+
+    def _dfu_progress(self, sent, total, bytes_per_sec):
+        print("Writing Resource %d/%d bytes (%.1f KB/s)" % (sent, total, bytes_per_sec / 1024.0))
+
+    def dfu_update(self, fileName, progress_callback=None):
+        """Upload a .fw or .res file without prompting; returns its size, CRC and the transfer rate."""
+        from crc import crc16_file
+        from dfu import DfuTransfer, negotiate_chunk_size
+        extension = os.path.splitext(fileName)[1][1:].lower()
+        if extension not in ('fw', 'res'):
+            raise ValueError("expected a .fw or .res file: " + fileName)
+        with self.connection_profile('bulk'):
+            fileSize = os.path.getsize(fileName)
+            # calculating crc checksum of firmware
+            crc = crc16_file(fileName)
+
+            def start():
+                char = self._char('CHARACTERISTIC_DFU_FIRMWARE')
+                char.write(codec.encode_dfu_start(fileSize, resource=extension == "res"), withResponse=True)
+                char.write("\x03", withResponse=True)
+                return char, self._char('CHARACTERISTIC_DFU_FIRMWARE_WRITE')
+
+            def restart():
+                # the band drops a partial image, so the upload starts over on the new link
+                self.reconnect(self.reconnect_attempts)
+                return start()
+
+            with open(fileName, 'rb') as f:
+                data = f.read()
+            transfer = DfuTransfer(*start(), chunk_size=negotiate_chunk_size(self),
+                                   progress_callback=progress_callback, restart=restart)
+            # the final sync (\x00) is sent by the transfer after the last chunk
+            transfer.send(data)
+            char = transfer.char_ctrl
+            self.waitForNotifications(0.5)
+            char.write(codec.encode_dfu_checksum(crc), withResponse=True)
+            if extension == "fw":
+                self.waitForNotifications(0.5)
+                char.write('\x05', withResponse=True)
+            return {"size": fileSize, "crc": crc, "bytes_per_sec": transfer.bytes_per_sec,
+                    "retries": transfer.retries}
+
+    def dfuUpdate(self, fileName, progress_callback=None):
         print("Update Firmware/Resource")
-        svc = self.getServiceByUUID(UUIDS.SERVICE_DFU_FIRMWARE)
-        char = svc.getCharacteristics(UUIDS.CHARACTERISTIC_DFU_FIRMWARE)[0]
-        extension = os.path.splitext(fileName)[1][1:]
-        fileSize = os.path.getsize(fileName)
-        # calculating crc checksum of firmware
-        #crc16
-        crc = 0xFFFF
-        with open(fileName) as f:
-            while True:
-                c = f.read(1)
-                if not c:
-                    break
-                cInt = int(c.encode('hex'), 16) #converting hex to int
-                # now calculate crc
-                crc = ((crc >> 8) | (crc << 8)) & 0xFFFF
-                crc ^= (cInt & 0xff)
-                crc ^= ((crc & 0xff) >> 4)
-                crc ^= (crc << 12) & 0xFFFF
-                crc ^= ((crc & 0xFF) << 5) & 0xFFFFFF
-        crc &= 0xFFFF
-        print("CRC Value is-->", crc)
         raw_input("Press Enter to Continue")
-        if extension.lower() == "res":
-            # file size hex value is
-            char.write('\x01'+ struct.pack("<i", fileSize)[:-1] +'\x02', withResponse=True)
-        elif extension.lower() == "fw":
-            char.write('\x01' + struct.pack("<i", fileSize)[:-1], withResponse=True)
-        char.write("\x03", withResponse=True)
-        char1 = svc.getCharacteristics(UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE)[0]
-        with open(fileName) as f:
-          while True:
-            c = f.read(20) #takes 20 bytes :D
-            if not c:
-              print ("Update Over")
-              break
-            print("Writing Resource", c.encode('hex'))
-            char1.write(c)
-        # after update is done send these values
-        char.write(b'\x00', withResponse=True)
-        self.waitForNotifications(0.5)
-        print("CheckSum is --> ", hex(crc & 0xFF), hex((crc >> 8) & 0xFF))
-        checkSum = b'\x04' + chr(crc & 0xFF) + chr((crc >> 8) & 0xFF)
-        char.write(checkSum, withResponse=True)
-        if extension.lower() == "fw":
-            self.waitForNotifications(0.5)
-            char.write('\x05', withResponse=True)
+        res = self.dfu_update(fileName, progress_callback or self._dfu_progress)
+        print("Update Over", "%.1f KB/s" % (res['bytes_per_sec'] / 1024.0))
+        print("CheckSum is --> ", hex(res['crc'] & 0xFF), hex((res['crc'] >> 8) & 0xFF))
         print("Update Complete")
         raw_input("Press Enter to Continue")
-    def start_raw_data_realtime(self, heart_measure_callback=None, heart_raw_callback=None, accel_raw_callback=None):
-            char_m = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)[0]
-            char_d = char_m.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
-            char_ctrl = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)[0]
 
+    def start_raw_data_realtime(self, heart_measure_callback=None, heart_raw_callback=None, accel_raw_callback=None,
+                                heart_raw_batch_callback=None, accel_raw_batch_callback=None, ping_interval=12):
+            if self._stream is not None and not self._stream.running:
+                # one pump per link: a stream whose pump has died is stopped before a new one starts
+                self._stream.stop()
+                self._stream = None
             if heart_measure_callback:
                 self.heart_measure_callback = heart_measure_callback
             if heart_raw_callback:
                 self.heart_raw_callback = heart_raw_callback
             if accel_raw_callback:
                 self.accel_raw_callback = accel_raw_callback
-
-            char_sensor = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_SENSOR)[0]
+            # batch callbacks get dicts of NumPy columns: t, x, y, z / t, ppg
+            if heart_raw_batch_callback:
+                self.heart_raw_batch_callback = heart_raw_batch_callback
+            if accel_raw_batch_callback:
+                self.accel_raw_batch_callback = accel_raw_batch_callback
+
+            if self._stream is not None:
+                # already streaming: only the callbacks change
+                return self._stream
+            if not self._realtime:
+                self.push_connection_profile('realtime')
+            self._enable_realtime()
+            self._realtime = True
+            # notifications are pumped (and pinged every 12 sec by the scheduler) in the background
+            self._stream = RealtimeStream(self, ping_interval=ping_interval)
+            return self._stream.start()
+
+    def _enable_realtime(self):
+            # the notification state start_raw_data_realtime sets up, replayed after a reconnect
+            char_d = self._desc('CHARACTERISTIC_HEART_RATE_MEASURE')
+            char_ctrl = self._char('CHARACTERISTIC_HEART_RATE_CONTROL')
+            char_sensor = self._char('CHARACTERISTIC_SENSOR')
 
             # stop heart monitor continues & manual
             char_ctrl.write(b'\x15\x02\x00', True)
@@ -421,24 +811,44 @@ class MiBand3(Peripheral):
             char_ctrl.write(b'\x15\x01\x01', True)
             # WTF
             char_sensor.write(b'\x02')
-            t = time.time()
-            while True:
-                self.waitForNotifications(0.5)
-                self._parse_queue()
-                # send ping request every 12 sec
-                if (time.time() - t) >= 12:
-                    char_ctrl.write(b'\x16', True)
-                    t = time.time()
-
-    def stop_realtime(self):
-            char_m = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)[0]
-            char_d = char_m.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
-            char_ctrl = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)[0]
 
-            char_sensor1 = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_HZ)[0]
-            char_sens_d1 = char_sensor1.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
-
-            char_sensor2 = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_SENSOR)[0]
+    def subscribe(self, types=(QUEUE_TYPES.HEART,), **kwargs):
+        """Attach a subscriber with its own bounded buffer to the realtime samples, see fanout.FanOut.
+
+        Subscribers only see data while realtime data runs
+        (``start_raw_data_realtime``) and are kept across restarts.
+        """
+        if self.fanout is None:
+            from fanout import FanOut
+            self.fanout = FanOut()
+        return self.fanout.subscribe(types, **kwargs)
+
+    def stream(self, types=(QUEUE_TYPES.HEART,), seconds=None, **kwargs):
+        """Start realtime data and iterate ``(type, value)`` samples, stopping when the loop ends."""
+        return self.start_raw_data_realtime(**kwargs).samples(types, seconds)
+
+    def stop_realtime(self, link_lost=False):
+            """Switch realtime data off; with ``link_lost`` only the local state is reset."""
+            # reset first, so a failing write below cannot leave the band marked as streaming
+            realtime, self._realtime = self._realtime, False
+            self.heart_measure_callback = None
+            self.heart_raw_callback = None
+            self.accel_raw_callback = None
+            self.heart_raw_batch_callback = None
+            self.accel_raw_batch_callback = None
+            if link_lost:
+                # nothing to switch off on a dead link; the profile is requested again on connect
+                if realtime:
+                    self.le_profile = (self._le_stack.pop() if self._le_stack else None) or 'background'
+                return
+            if realtime:
+                self.pop_connection_profile()
+            char_d = self._desc('CHARACTERISTIC_HEART_RATE_MEASURE')
+            char_ctrl = self._char('CHARACTERISTIC_HEART_RATE_CONTROL')
+
+            char_sens_d1 = self._desc('CHARACTERISTIC_HZ')
+
+            char_sensor2 = self._char('CHARACTERISTIC_SENSOR')
 
             # stop heart monitor continues
             char_ctrl.write(b'\x15\x01\x00', True)
@@ -450,20 +860,36 @@ class MiBand3(Peripheral):
             # IMO: stop notifications from sensors
             char_sens_d1.write(b'\x00\x00', True)
 
-            self.heart_measure_callback = None
-            self.heart_raw_callback = None
-            self.accel_raw_callback = None
+    def sync_activity(self, since=None, callback=None, state=None):
+        """Fetch stored per-minute activity, by default only minutes newer than the last sync.
+
+        ``state`` (a ``store.JsonStore``) replaces the store of the high-water
+        marks from this call on.
+        """
+        if self._activity is None:
+            from activity import ActivitySync
+            self._activity = ActivitySync(self, state)
+        elif state is not None:
+            self._activity.state_store = state
+        with self.connection_profile('bulk'):
+            return self._activity.sync(since, callback)
 
     def start_get_previews_data(self, start_timestamp):
-            self._auth_previews_data_notif(True)
-            self.waitForNotifications(0.1)
-            print("Trigger activity communication")
-            year = struct.pack("<H", start_timestamp.year)
-            month = struct.pack("<H", start_timestamp.month)[0]
-            day = struct.pack("<H", start_timestamp.day)[0]
-            hour = struct.pack("<H", start_timestamp.hour)[0]
-            minute = struct.pack("<H", start_timestamp.minute)[0]
-            ts = year + month + day + hour + minute
-            trigger = b'\x01\x01' + ts + b'\x00\x08'
-            self._char_fetch.write(trigger, False)
-            self.active = True
+        return self.sync_activity(since=start_timestamp)
+
+
+class _ProfileSwitch(object):
+
+    def __init__(self, band, profile):
+        self.band = band
+        self.profile = profile
+
+    def __enter__(self):
+        return self.band.push_connection_profile(self.profile)
+
+    def __exit__(self, *exc):
+        try:
+            self.band.pop_connection_profile()
+        except BTLEException as e:
+            # e.g. the band rebooted into new firmware
+            self.band._log.warning("Could not restore the connection profile: %s", e)
@@ -0,0 +1,28 @@
+import random
+
+__all__ = ['Backoff']
+
+
+class Backoff(object):
+
+    """Jittered exponential backoff: delay ``n`` is drawn from [d/2, d] with d = min(cap, base * factor ** n).
+
+    The jitter keeps many bands that dropped together (adapter reset, user
+    walking out of range) from retrying in lockstep.
+    """
+
+    def __init__(self, base=0.05, cap=5.0, factor=2.0, rand=random.random):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.rand = rand
+
+    def delay(self, attempt):
+        ceiling = min(self.cap, self.base * self.factor ** attempt)
+        return ceiling * (0.5 + 0.5 * self.rand())
+
+    def delays(self, attempts=None):
+        n = 0
+        while attempts is None or n < attempts:
+            yield self.delay(n)
+            n += 1
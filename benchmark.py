@@ -0,0 +1,1588 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from bluepy.btle import BTLEException
+
+import crc
+from constants import UUIDS, QUEUE_TYPES
+from dfu import DfuTransfer, negotiate_chunk_size
+from gatt_cache import HandleCache
+
+
+def _rate(nbytes, seconds):
+    return (nbytes / (1024.0 * 1024.0)) / seconds if seconds else float('inf')
+
+
+def _sim_band(**kwargs):
+    from simulator import SimulatedMiBand3
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    os.remove(path)
+    try:
+        return SimulatedMiBand3(handle_cache=HandleCache(path), **kwargs)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _timed(fn, *args):
+    t = time.time()
+    res = fn(*args)
+    return res, time.time() - t
+
+
+# CRC ####################################################################
+
+def bench_crc(size_mb=4):
+    fd, path = tempfile.mkstemp(suffix='.res')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(size_mb * 1024 * 1024))
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        old, t_old = _timed(crc.crc16_bytewise, data)
+        table, t_table = _timed(crc.crc16_file, path, crc.CHUNK_SIZE, False)
+        print("crc bytewise: %.2f MB/s" % _rate(size, t_old))
+        print("crc table:    %.2f MB/s" % _rate(size, t_table))
+        assert old == table, "table crc mismatch"
+        if crc._crc16_c is not None:
+            fast, t_fast = _timed(crc.crc16_file, path)
+            print("crc C:        %.2f MB/s" % _rate(size, t_fast))
+            assert old == fast, "C crc mismatch"
+    finally:
+        os.remove(path)
+
+
+# DFU ####################################################################
+
+class FakeDfuControl(object):
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.syncs = 0
+
+    def write(self, val, withResponse=False):
+        if val == b'\x00':
+            self.syncs += 1
+
+
+class FakeDfuWrite(object):
+
+    """Stand-in for CHARACTERISTIC_DFU_FIRMWARE_WRITE that drops the link at the given write counts."""
+
+    def __init__(self, drop_at=(), latency=0.0):
+        self.received = bytearray()
+        self.writes = 0
+        self.starts = 0
+        self.drop_at = set(drop_at)
+        self.latency = latency
+
+    def start(self):
+        # a new start command makes the band discard the partial image
+        self.starts += 1
+        del self.received[:]
+
+    def write(self, val, withResponse=False):
+        self.writes += 1
+        if self.writes in self.drop_at:
+            raise BTLEException("injected drop")
+        if self.latency:
+            time.sleep(self.latency)
+        self.received.extend(val)
+
+
+def bench_dfu(size_kb=512):
+    image = os.urandom(size_kb * 1024)
+    for chunk_size, drop_at in ((20, ()), (244, ()), (244, (500, 1500))):
+        endpoint = FakeDfuWrite(drop_at=drop_at)
+        control = FakeDfuControl(endpoint)
+
+        def restart():
+            endpoint.start()
+            return control, endpoint
+        transfer = DfuTransfer(control, endpoint, chunk_size=chunk_size, max_retries=len(drop_at),
+                               restart=restart)
+        transfer.send(image)
+        assert bytes(endpoint.received) == image, "image corrupted"
+        assert transfer.retries == endpoint.starts == len(drop_at), "unexpected restarts"
+        print("dfu chunk=%d drops=%d: %.2f MB/s, %d retries" % (
+            chunk_size, len(drop_at), transfer.bytes_per_sec / (1024.0 * 1024.0), transfer.retries))
+
+    # without a way to restart, a dropped link fails the transfer
+    endpoint = FakeDfuWrite(drop_at=(10,))
+    try:
+        DfuTransfer(FakeDfuControl(endpoint), endpoint).send(image)
+    except BTLEException:
+        pass
+    else:
+        raise AssertionError("a failed transfer must not resume")
+
+
+# GATT handle cache ######################################################
+
+def _legacy_connect(band):
+    # what MiBand3.__init__ and the getters used to do through bluepy service discovery
+    band._connect(band.addr)
+    band._serviceMap = None
+    svc_1 = band.getServiceByUUID(UUIDS.SERVICE_MIBAND1)
+    svc_2 = band.getServiceByUUID(UUIDS.SERVICE_MIBAND2)
+    svc_heart = band.getServiceByUUID(UUIDS.SERVICE_HEART_RATE)
+    char_auth = svc_2.getCharacteristics(UUIDS.CHARACTERISTIC_AUTH)[0]
+    char_auth.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0].write(b'\x01\x00', True)
+    svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)
+    svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)
+    band.waitForNotifications(0.1)
+    return svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_BATTERY)[0].read()
+
+
+def bench_gatt(latency=0.0075):
+    from simulator import SimulatedMiBand3
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    os.remove(path)
+    try:
+        for label in ('cold cache', 'warm cache'):
+            t = time.time()
+            band = SimulatedMiBand3(latency=latency, handle_cache=HandleCache(path))
+            band.get_battery_info()
+            print("gatt %s: connect to first read %.1f ms, %d ATT ops" % (
+                label, (time.time() - t) * 1000, band.att_ops))
+
+        band.att_ops = 0
+        t = time.time()
+        _legacy_connect(band)
+        print("gatt service discovery: connect to first read %.1f ms, %d ATT ops" % (
+            (time.time() - t) * 1000, band.att_ops))
+
+        band.att_ops = 0
+        t = time.time()
+        band.get_battery_info()
+        print("gatt per call: %.1f ms, %d ATT ops" % ((time.time() - t) * 1000, band.att_ops))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Snapshot read cache ####################################################
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def _legacy_detail(band):
+    # main.detail_info before get_snapshot: every field read on every call
+    return (band.get_revision(), band.get_hrdw_revision(), band.get_serial(),
+            band.get_battery_info(), band.get_steps(), band.get_current_time())
+
+
+def bench_snapshot(minutes=10, every=5.0, latency=0.0075):
+    from simulator import SimulatedMiBand3
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    os.remove(path)
+    polls = int(minutes * 60 / every)
+    try:
+        for label in ('uncached', 'snapshot'):
+            band = SimulatedMiBand3(latency=latency, handle_cache=HandleCache(path),
+                                    read_ttls={} if label == 'snapshot' else dict.fromkeys(
+                                        ('CHARACTERISTIC_REVISION', 'CHARACTERISTIC_HRDW_REVISION',
+                                         'CHARACTERISTIC_SERIAL'), 0))
+            band.read_cache.clock = clock = _Clock()
+            band.att_ops = 0
+            elapsed = 0.0
+            for _ in range(polls):
+                t = time.time()
+                if label == 'snapshot':
+                    band.get_snapshot()
+                else:
+                    _legacy_detail(band)
+                elapsed += time.time() - t
+                clock.now += every
+            print("snapshot %s: %d polls over %d min, %d ATT reads, %.1f ms per poll" % (
+                label, polls, minutes, band.att_ops, elapsed / polls * 1000))
+        print("snapshot cache: %s" % band.read_cache.stats())
+
+        # reconnect: info fields come back from the handle cache file
+        band = SimulatedMiBand3(latency=latency, handle_cache=HandleCache(path))
+        band.att_ops = 0
+        band.get_snapshot()
+        print("snapshot after reconnect: %d ATT reads" % band.att_ops)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Packet codec ###########################################################
+
+def _legacy_parse_date(bytes):
+    year = struct.unpack('h', bytes[0:2])[0] if len(bytes) >= 2 else None
+    month = struct.unpack('b', bytes[2])[0] if len(bytes) >= 3 else None
+    day = struct.unpack('b', bytes[3])[0] if len(bytes) >= 4 else None
+    hours = struct.unpack('b', bytes[4])[0] if len(bytes) >= 5 else None
+    minutes = struct.unpack('b', bytes[5])[0] if len(bytes) >= 6 else None
+    seconds = struct.unpack('b', bytes[6])[0] if len(bytes) >= 7 else None
+    day_of_week = struct.unpack('b', bytes[7])[0] if len(bytes) >= 8 else None
+    fractions256 = struct.unpack('b', bytes[8])[0] if len(bytes) >= 9 else None
+    return {"date": datetime(*(year, month, day, hours, minutes, seconds)), "day_of_week": day_of_week,
+            "fractions256": fractions256}
+
+
+def _legacy_parse_battery(bytes):
+    level = struct.unpack('b', bytes[1])[0] if len(bytes) >= 2 else None
+    last_level = struct.unpack('b', bytes[19])[0] if len(bytes) >= 20 else None
+    status = 'normal' if struct.unpack('b', bytes[2])[0] == 0 else "charging"
+    return {"status": status, "level": level, "last_level": last_level,
+            "last_charge": _legacy_parse_date(bytes[11:18]), "last_off": _legacy_parse_date(bytes[3:10])}
+
+
+def _legacy_parse_steps(a):
+    steps = struct.unpack('h', a[1:3])[0] if len(a) >= 3 else None
+    meters = struct.unpack('h', a[5:7])[0] if len(a) >= 7 else None
+    fat_gramms = struct.unpack('h', a[2:4])[0] if len(a) >= 4 else None
+    callories = struct.unpack('b', a[9])[0] if len(a) >= 10 else None
+    return {"steps": steps, "meters": meters, "fat_gramms": fat_gramms, "callories": callories}
+
+
+def _legacy_parse_accel(bytes):
+    res = []
+    for i in range(3):
+        g = struct.unpack('hhh', bytes[2 + i * 6:8 + i * 6])
+        res.append({'x': g[0], 'y': g[1], 'wtf': g[2]})
+    return res
+
+
+def _legacy_parse_ppg(bytes):
+    return struct.unpack('HHHHHHH', bytes[2:])
+
+
+def _legacy_parse_heart(bytes):
+    return struct.unpack('bb', bytes)[1]
+
+
+def _expect(what, value, expected):
+    # explicit, so ``python -O`` keeps the check
+    if value != expected:
+        raise AssertionError("%s: got %r, expected %r" % (what, value, expected))
+
+
+def _codec_round_trips():
+    import codec
+    dt = datetime(2020, 2, 29, 23, 59, 58)
+    _expect('date', codec.decode_date(codec.encode_date(dt)), dt)
+    _expect('current time', codec.decode_current_time(codec.encode_current_time(dt, tz_quarters=-20)),
+            {"date": dt, "day_of_week": 6, "fractions256": 0})
+    battery = codec.decode_battery(codec.encode_battery(42, True, dt, datetime(2020, 3, 1), 99))
+    _expect('battery', (battery['level'], battery['status'], battery['last_level'], battery['last_off']['date'],
+                        battery['last_charge']['date']), (42, 'charging', 99, dt, datetime(2020, 3, 1)))
+    _expect('steps', codec.decode_steps(codec.encode_steps(70000, 52000, 3100)),
+            {"steps": 70000, "meters": 52000, "callories": 3100})
+    samples = [(-1, 2, -32768), (32767, 0, 5), (7, -7, 1000)]
+    _expect('accel', [(s['x'], s['y'], s['z']) for s in codec.decode_accel(codec.encode_accel(257, samples))],
+            samples)
+    _expect('ppg', codec.decode_ppg(codec.encode_ppg(3, range(60000, 60007))), tuple(range(60000, 60007)))
+    for bpm in (45, 180, 300):
+        _expect('heart measure', codec.decode_heart_measure(codec.encode_heart_measure(bpm)), bpm)
+    _expect('serial', codec.decode_serial(b'0123456789AB'), b'0123456789AB')
+    # command encoders against the bytes the band expects
+    _expect('heart interval', codec.encode_heart_interval(10), b'\x14\x0a')
+    _expect('custom alert', codec.encode_custom_alert(3, u'Bob'), b'\x03\x01Bob')
+    _expect('encoding', codec.encode_encoding(), b'\x06\x17\x00en_US')
+    _expect('fetch trigger', codec.encode_fetch_trigger(dt, tz_quarters=4),
+            b'\x01\x01\xe4\x07\x02\x1d\x17\x3b\x00\x04')
+    _expect('dfu start', codec.encode_dfu_start(0x012345, resource=True), b'\x01\x45\x23\x01\x02')
+    _expect('dfu checksum', codec.encode_dfu_checksum(0xBEEF), b'\x04\xef\xbe')
+    _expect('le params', codec.encode_le_params(24, 40, 0, 500, 0x20),
+            b'\x18\x00\x28\x00\x00\x00\xf4\x01\x00\x00\x20\x00')
+    _expect('le params timeout', codec.decode_le_params(codec.encode_le_params(24, 40, 0, 500))['timeout_ms'], 5000)
+
+
+def _per_packet_us(fn, packet, n):
+    t = time.time()
+    for _ in range(n):
+        fn(packet)
+    return (time.time() - t) / n * 1e6
+
+
+def bench_codec(n=100000):
+    import codec
+    from simulator import DEFAULT_VALUES
+    _codec_round_trips()
+    accel, ppg = _raw_packets(1)
+    cases = [
+        ('time', DEFAULT_VALUES[UUIDS.CHARACTERISTIC_CURRENT_TIME], _legacy_parse_date, codec.decode_current_time),
+        ('battery', DEFAULT_VALUES[UUIDS.CHARACTERISTIC_BATTERY], _legacy_parse_battery, codec.decode_battery),
+        ('steps', DEFAULT_VALUES[UUIDS.CHARACTERISTIC_STEPS], _legacy_parse_steps, codec.decode_steps),
+        ('accel', accel[0], _legacy_parse_accel, codec.decode_accel),
+        ('ppg', ppg[0], _legacy_parse_ppg, codec.decode_ppg),
+        ('heart', b'\x00\x48', _legacy_parse_heart, codec.decode_heart_measure),
+    ]
+    print("codec round trips: ok")
+    for name, packet, legacy, decode in cases:
+        before = _per_packet_us(legacy, packet, n)
+        after = _per_packet_us(decode, packet, n)
+        print("codec %-8s %.2f us -> %.2f us per packet (%.1fx)" % (name, before, after, before / after))
+
+
+# Instrumentation ########################################################
+
+def _pump(band, notifications):
+    delegate = band.delegate
+    for i, (hnd, data) in enumerate(notifications):
+        delegate.handleNotification(hnd, data)
+        if i % 16 == 15:
+            band._parse_queue()
+    band._parse_queue()
+
+
+def bench_metrics(n=100000, reads=20000):
+    from metrics import Metrics
+    accel, ppg = _raw_packets(64)
+    results = {}
+    for label, metrics in (('disabled', None), ('enabled', Metrics())):
+        band = _sim_band(metrics=metrics)
+        band.authenticate()
+        hz = band._handle('CHARACTERISTIC_HZ')
+        heart = band._handle('CHARACTERISTIC_HEART_RATE_MEASURE')
+        notifications = [(hz, accel[i % 64] if i % 2 else ppg[i % 64]) if i % 10 else (heart, b'\x00\x48')
+                         for i in range(n)]
+        band.accel_raw_batch_callback = band.heart_raw_batch_callback = lambda columns: None
+        band.heart_measure_callback = lambda bpm: None
+        _, t_pump = _timed(_pump, band, notifications)
+        t = time.time()
+        for _ in range(reads):
+            band._read('CHARACTERISTIC_BATTERY')
+        t_read = time.time() - t
+        results[label] = (t_pump, t_read)
+        print("metrics %s: %.0f notifications/s parsed, %.2f us per GATT read" % (
+            label, n / t_pump, t_read / reads * 1e6))
+    (p0, r0), (p1, r1) = results['disabled'], results['enabled']
+    print("metrics overhead when enabled: %+.1f%% notification path, %+.2f us per GATT read" % (
+        100.0 * (p1 - p0) / p0, (r1 - r0) / reads * 1e6))
+    text = metrics.to_prometheus()
+    assert 'miband_gatt_seconds_bucket{char="CHARACTERISTIC_BATTERY"' in text
+    print("metrics export: %d Prometheus lines, %d bytes of JSON" % (
+        text.count('\n'), len(metrics.to_json())))
+
+
+# Raw sample decoding ####################################################
+
+def _raw_packets(n):
+    accel = [b'\x01\x00' + os.urandom(18) for _ in range(n)]
+    ppg = [b'\x02\x00' + os.urandom(14) for _ in range(n)]
+    return accel, ppg
+
+
+def bench_decode(n=100000, batch=50):
+    from decode import AccelRing, PpgRing
+    band = _sim_band()
+    accel, ppg = _raw_packets(n)
+
+    t = time.time()
+    old_accel = [band._parse_raw_accel(p) for p in accel]
+    old_ppg = [band._parse_raw_heart(p) for p in ppg]
+    t_old = time.time() - t
+
+    accel_ring, ppg_ring = AccelRing(), PpgRing()
+    t = time.time()
+    for i in range(0, n, batch):
+        for p in accel[i:i + batch]:
+            accel_ring.append(p, 0.0)
+        for p in ppg[i:i + batch]:
+            ppg_ring.append(p, 0.0)
+        accel_ring.flush()
+        ppg_ring.flush()
+    t_new = time.time() - t
+
+    assert list(AccelRing.legacy(accel_ring.latest(300))) == old_accel[-100:], "accel mismatch"
+    assert list(PpgRing.legacy(ppg_ring.latest(700))) == [tuple(p) for p in old_ppg[-100:]], "ppg mismatch"
+    print("decode per packet: %.0f packets/s" % (2 * n / t_old))
+    print("decode batched:    %.0f packets/s (batch=%d)" % (2 * n / t_new, batch))
+
+
+# Notification dispatch ##################################################
+
+class _LegacyDelegate(object):
+
+    """The pre-dispatch-table delegate: handle lookups per notification and one shared Queue."""
+
+    def __init__(self, device):
+        from Queue import Queue
+        self.device = device
+        self.queue = Queue()
+        self.char_auth = device._char('CHARACTERISTIC_AUTH')
+        self.char_heart = device._char('CHARACTERISTIC_HEART_RATE_MEASURE')
+
+    def handleNotification(self, hnd, data):
+        if hnd == self.char_auth.getHandle():
+            pass
+        elif hnd == self.char_heart.getHandle():
+            self.queue.put((QUEUE_TYPES.HEART, data))
+        elif hnd == 0x38:
+            if len(data) == 20 and struct.unpack('b', data[0:1])[0] == 1:
+                self.queue.put((QUEUE_TYPES.RAW_ACCEL, data))
+            elif len(data) == 16:
+                self.queue.put((QUEUE_TYPES.RAW_HEART, data))
+
+
+def bench_dispatch(n=200000):
+    from auth import AuthenticationDelegate
+    from channels import make_channels
+    band = _sim_band()
+    accel, ppg = _raw_packets(100)
+    hz = band._handle('CHARACTERISTIC_HZ')
+    heart = band._handle('CHARACTERISTIC_HEART_RATE_MEASURE')
+    notifications = [(hz, accel[i % 100]) if i % 3 else (heart, b'\x00\x48') for i in range(n)]
+
+    legacy = _LegacyDelegate(band)
+    notifications_legacy = [(0x38 if h == hz else h, d) for h, d in notifications]
+    t = time.time()
+    for hnd, data in notifications_legacy:
+        legacy.handleNotification(hnd, data)
+    t_old = time.time() - t
+
+    delegate = AuthenticationDelegate(band)
+    band.channels = make_channels(n)
+    t = time.time()
+    for hnd, data in notifications:
+        delegate.handleNotification(hnd, data)
+    t_new = time.time() - t
+    assert sum(len(c) for c in band.channels.values()) == legacy.queue.qsize()
+    print("dispatch legacy delegate: %.0f notifications/s" % (n / t_old))
+    print("dispatch handle table:    %.0f notifications/s" % (n / t_new))
+
+
+# Fan-out ################################################################
+
+def bench_fanout(n=100000, slow=0.001):
+    from fanout import DROP_OLDEST, SAMPLE, BLOCK
+    accel, ppg = _raw_packets(64)
+    types = (QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_HEART, QUEUE_TYPES.RAW_ACCEL)
+
+    def notifications(band):
+        hz = band._handle('CHARACTERISTIC_HZ')
+        heart = band._handle('CHARACTERISTIC_HEART_RATE_MEASURE')
+        return [(hz, accel[i % 64] if i % 2 else ppg[i % 64]) if i % 10 else (heart, b'\x00\x48')
+                for i in range(n)]
+
+    def slow_consumer(*args):
+        time.sleep(slow)
+
+    band = _sim_band()
+    band.authenticate()
+    _, t_bare = _timed(_pump, band, notifications(band))
+
+    # a slow consumer as the one inline callback per type
+    band = _sim_band()
+    band.authenticate()
+    band.heart_measure_callback = band.heart_raw_batch_callback = band.accel_raw_batch_callback = slow_consumer
+    items = notifications(band)
+    _, t_inline = _timed(_pump, band, items[:n // 20])
+    t_inline *= 20
+
+    band = _sim_band()
+    band.authenticate()
+    received = []
+    recorder = band.subscribe(types, callback=lambda _type, value: received.append(_type), maxsize=n,
+                              name='recorder')
+    dashboard = band.subscribe(types, callback=slow_consumer, maxsize=64, policy=DROP_OLDEST, name='dashboard')
+    analytics = band.subscribe(types, maxsize=64, policy=SAMPLE, name='analytics')
+    _, t_fanout = _timed(_pump, band, notifications(band))
+    stats = dict((s['name'], s) for s in band.fanout.stats())
+    recorder.close()
+    dashboard.close()
+    blocking = band.subscribe(types, callback=slow_consumer, maxsize=64, policy=BLOCK, block_timeout=slow,
+                              name='blocking')
+    _, t_block = _timed(_pump, band, notifications(band)[:n // 20])
+    t_block *= 20
+    blocking.close()
+
+    print("fanout bare pump:                      %.0f notifications/s" % (n / t_bare))
+    print("fanout slow inline callback:           %.0f notifications/s" % (n / t_inline))
+    print("fanout 3 subscribers, one slow:        %.0f notifications/s" % (n / t_fanout))
+    print("fanout slow subscriber, block policy:  %.0f notifications/s" % (n / t_block))
+    for name in ('recorder', 'dashboard', 'analytics'):
+        s = stats[name]
+        print("fanout   %-9s %-11s published %6d delivered %6d dropped %6d max lag %d" % (
+            name, s['policy'], s['published'], s['delivered'], s['dropped'], s['max_lag']))
+    assert stats['recorder']['dropped'] == 0 and len(received) == stats['recorder']['published']
+    assert stats['dashboard']['dropped'] > 0 and stats['analytics']['lag'] == 64
+    assert t_fanout < t_inline / 5
+
+
+# Reconnect ##############################################################
+
+def _pumps():
+    return sum(thread.name.startswith('miband-pump-') for thread in threading.enumerate())
+
+
+def bench_reconnect(drops=8, interval=0.6, latency=0.0075):
+    band = _sim_band(latency=latency)
+    band.authenticate()
+    received = []
+    sub = band.subscribe((QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_ACCEL), callback=lambda _type, value: received.append(
+        (time.time(), _type)), name='monitor')
+    stream = band.start_raw_data_realtime()
+    # starting again only swaps callbacks: one pump per link
+    if band.start_raw_data_realtime() is not stream or _pumps() != 1:
+        raise AssertionError("second start created another pump (%d running)" % _pumps())
+    for i in range(drops):
+        time.sleep(interval)
+        # every other drop also fails the first connect attempts
+        band.connect_failures = i % 3
+        band.schedule_drop(0)
+    time.sleep(interval)
+    stream.stop()
+    sub.close()
+    assert stream.error is None, stream.error
+    assert len(band.reconnects) == drops == band.drops, (len(band.reconnects), band.drops)
+    recovery = sorted(r['recovery_seconds'] for r in band.reconnects)
+    gaps = sorted(r['data_gap_seconds'] for r in band.reconnects)
+    # realtime data flows again after each drop
+    for r in band.reconnects:
+        assert any(t > r['recovered'] and _type == QUEUE_TYPES.RAW_ACCEL for t, _type in received)
+    print("reconnect %d drops: recovery p50 %.0f ms max %.0f ms, %d attempts, data gap p50 %.0f ms max %.0f ms" % (
+        drops, recovery[len(recovery) // 2] * 1000, recovery[-1] * 1000,
+        sum(r['attempts'] for r in band.reconnects), gaps[len(gaps) // 2] * 1000, gaps[-1] * 1000))
+    assert recovery[-1] < 1.0 and gaps[-1] < 1.0
+
+    # without auto reconnect the pump stops; stopping the stream must not write to the dead link
+    band = _sim_band(latency=latency, auto_reconnect=False)
+    band.authenticate()
+    with band.start_raw_data_realtime() as stream:
+        band.drop_link()
+        deadline = time.time() + 5
+        while stream.running and time.time() < deadline:
+            time.sleep(0.01)
+    if stream.error is None or band._realtime or band.le_profile != 'background':
+        raise AssertionError("dead stream not reset: error %r, realtime %r, profile %r" % (
+            stream.error, band._realtime, band.le_profile))
+
+
+# Scheduler ##############################################################
+
+def _count_wakeups(band):
+    """Count notification waits that timed out without data."""
+    wait = band.waitForNotifications
+    counts = [0, 0]
+
+    def counted(timeout):
+        got = wait(timeout)
+        counts[0] += 1
+        counts[1] += not got
+        return got
+    band.waitForNotifications = counted
+    return counts
+
+
+def _lateness_line(label, jobs):
+    for job in jobs:
+        print("%-28s %-15s runs %3d missed %d lateness p50 %6.2f ms p99 %6.2f ms max %6.2f ms" % (
+            label, job['name'], job['runs'], job['missed'], (job['lateness_p50'] or 0) * 1000,
+            (job['lateness_p99'] or 0) * 1000, (job['lateness_max'] or 0) * 1000))
+
+
+def bench_scheduler(seconds=3.0, latency=0.0075):
+    intervals = {'keep_alive': 0.25, 'poll_battery': 0.5, 'poll_steps': 0.3, 'poll_time_drift': 1.0}
+
+    # idle link, the way the ping was done: wake up every 0.5 s and check each timer
+    band = _sim_band(latency=latency)
+    band.authenticate()
+    wakeups = _count_wakeups(band)
+    polls = [('keep_alive', band.keep_alive), ('poll_battery', band.get_battery_info),
+             ('poll_steps', band.get_steps), ('poll_time_drift', band.get_current_time)]
+    started = time.time()
+    last = dict((name, started) for name, _ in polls)
+    late = dict((name, []) for name, _ in polls)
+    while time.time() - started < seconds:
+        band.waitForNotifications(0.5)
+        for name, poll in polls:
+            now = time.time()
+            if now - last[name] >= intervals[name]:
+                late[name].append(now - last[name] - intervals[name])
+                poll()
+                last[name] = time.time()
+    legacy = [{'name': name, 'runs': len(late[name]), 'missed': 0, 'lateness_p50': sorted(late[name])[len(late[name]) // 2],
+               'lateness_p99': max(late[name]), 'lateness_max': max(late[name])} for name, _ in polls]
+    _lateness_line("scheduler idle, 0.5 s loop:", legacy)
+    print("scheduler idle, 0.5 s loop:  %d jobs run, %d wakeups, %d empty" % ((sum(map(len, late.values())),) +
+                                                                         tuple(wakeups)))
+    band.disconnect()
+
+    # idle link, one timer heap: waits end at the next deadline
+    band = _sim_band(latency=latency)
+    band.authenticate()
+    wakeups = _count_wakeups(band)
+    band.scheduler.every(intervals['keep_alive'], band.keep_alive, name='keep_alive')
+    band.schedule_polls(battery=intervals['poll_battery'], steps=intervals['poll_steps'],
+                        time_drift=intervals['poll_time_drift'])
+    band.run(seconds)
+    stats = band.scheduler.stats()
+    _lateness_line("scheduler idle, timer heap:", stats)
+    print("scheduler idle, timer heap:  %d jobs run, %d wakeups, %d empty" % ((sum(job['runs'] for job in stats),) +
+                                                                         tuple(wakeups)))
+    # jobs due together queue behind each other's GATT round trips, but never by a whole interval
+    assert all(job['missed'] == 0 and job['lateness_p99'] < 0.1 for job in stats), stats
+    assert set(band.polled) == set(['battery', 'steps', 'time_drift'])
+    band.disconnect()
+
+    # the same jobs next to realtime data on the pump thread
+    band = _sim_band(latency=latency)
+    band.authenticate()
+    received = []
+    band.subscribe((QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_ACCEL), callback=lambda _type, value: received.append(_type))
+    band.schedule_polls(battery=intervals['poll_battery'], steps=intervals['poll_steps'],
+                        time_drift=intervals['poll_time_drift'])
+    stream = band.start_raw_data_realtime(ping_interval=intervals['keep_alive'])
+    time.sleep(seconds)
+    stats = band.scheduler.stats()
+    stream.stop()
+    _lateness_line("scheduler realtime:", stats)
+    print("scheduler realtime: %d samples delivered, %d writes of the keep-alive" % (
+        len(received), sum(1 for _, val in band.writes if val == b'\x16')))
+    assert stream.error is None and received
+    assert all(job['missed'] == 0 and job['lateness_p99'] < 0.1 for job in stats), stats
+    assert 'keep_alive' not in band.scheduler
+
+
+# Connection parameters ##################################################
+
+def bench_connparams(reads=5, latency=0.0075, size_kb=64):
+    band = _sim_band(latency=latency, interval_latency=True)
+    band.authenticate()
+    for profile in ('idle', 'background', 'realtime'):
+        achieved = band.set_connection_profile(profile)
+        t_reads = sorted(_timed(band.get_battery_info)[1] for _ in range(reads))
+        print("connparams %-10s interval %6.2f ms latency %d: GATT read p50 %6.1f ms" % (
+            profile, achieved['max_interval_ms'], achieved['latency'], t_reads[len(t_reads) // 2] * 1000))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'bench.res')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+        band.set_connection_profile('idle')
+        switch = band.connection_profile
+        # what dfu_update did before: upload over whatever the link is running
+        band.connection_profile = lambda profile: switch('idle')
+        t_idle = _timed(band.dfu_update, path)[1]
+        band.connection_profile = switch
+        t_bulk = _timed(band.dfu_update, path)[1]
+        assert band.le_profile == 'idle' and band.le_history[-1]['profile'] == 'bulk', band.le_history[-1]
+        print("connparams dfu %d KB: %.2f s on the idle profile, %.2f s switching to bulk (%.1fx)" % (
+            size_kb, t_idle, t_bulk, t_idle / t_bulk))
+    finally:
+        shutil.rmtree(workdir)
+
+    stream = band.start_raw_data_realtime()
+    time.sleep(2.0)
+    stream.stop()
+    assert band.le_profile == 'idle'
+    for period in band.le_history:
+        print("connparams period %-10s %5.2f s %5d notifications (%.1f/s)" % (
+            period['profile'], period['seconds'], period['notifications'], period['notifications_per_sec']))
+    realtime = [period for period in band.le_history if period['profile'] == 'realtime']
+    assert realtime and realtime[-1]['notifications_per_sec'] > 0
+
+
+# Fleet ##################################################################
+
+def bench_fleet(n=24, latency=0.0075):
+    from fleet import FleetManager
+    macs = ['AA:BB:CC:DD:%02X:%02X' % (i // 256, i % 256) for i in range(n)]
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        from simulator import SimulatedMiBand3
+        for label, per_adapter in (('serial', 1), ('concurrent', 8)):
+            fleet = FleetManager(macs, per_adapter=per_adapter, band_factory=SimulatedMiBand3,
+                                 latency=latency, handle_cache=HandleCache(path))
+            t = time.time()
+            fleet.connect_all()
+            t_connect = time.time() - t
+            t = time.time()
+            results = fleet.poll()
+            t_poll = time.time() - t
+            assert len(results) == n and not fleet.errors
+            summary = fleet.stats.summary()
+            print("fleet %s (%d bands): connect+auth %.2f s, poll sweep %.2f s (%.0f reads/s), "
+                  "read p95 %.1f ms" % (label, n, t_connect, t_poll, 3 * n / t_poll,
+                                        summary['get_steps']['p95'] * 1000))
+            fleet.disconnect_all()
+    finally:
+        os.remove(path)
+
+
+# Command line ###########################################################
+
+HEAVY_MODULES = ('bluepy', 'Crypto', 'numpy', 'cursesmenu', 'crc16', 'auth')
+
+
+def _startup(code, runs=5):
+    """Best wall clock of ``python -c code`` and the heavy modules it leaves imported."""
+    probe = code + '; import sys; print(",".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,)
+    best, loaded = None, None
+    for _ in range(runs):
+        t = time.time()
+        loaded = subprocess.check_output([sys.executable, '-c', probe], cwd=os.path.dirname(os.path.abspath(__file__)))
+        best = min(best or float('inf'), time.time() - t)
+    return best, loaded.strip()
+
+
+def _importtime(module):
+    """Cumulative import time in us from ``-X importtime`` (Python 3.7+), None elsewhere."""
+    if sys.version_info < (3, 7):
+        return None
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    _, err = proc.communicate()
+    for line in err.decode().splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    return None
+
+
+def bench_cli(latency=0.0075):
+    import cli
+    from StringIO import StringIO
+    t_cli, loaded_cli = _startup('import cli; cli.build_parser()')
+    t_auth, loaded_auth = _startup('import auth')
+    print("cli startup %.0f ms (heavy modules: %s), eager auth import %.0f ms (%s)" % (
+        t_cli * 1000, loaded_cli or 'none', t_auth * 1000, loaded_auth))
+    assert not loaded_cli, loaded_cli
+    for module in ('cli', 'auth'):
+        us = _importtime(module)
+        if us is not None:
+            print("-X importtime %s: %.1f ms cumulative" % (module, us / 1000.0))
+
+    commands = ['info', 'alert message "Hello"', 'set-time --time "2019-05-01 12:00:00"', 'info --refresh',
+                'alert call']
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as f:
+        f.write('# nightly\n' + '\n'.join(commands) + '\n')
+
+    def factory(mac_address, debug=False):
+        return _sim_band(mac_address=mac_address, latency=latency)
+    try:
+        out = StringIO()
+        t = time.time()
+        assert cli.main(['--mac', 'AA:BB:CC:DD:EE:FF', 'batch', path], band_factory=factory, stream=out) == 0
+        t_batch = time.time() - t
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert [r['command'] for r in records] == commands and all(r['ok'] for r in records), records
+        assert records[3]['result']['time']['date'].startswith('2019-05-01T12:00')
+        t = time.time()
+        for command in commands:
+            cli.main(['--mac', 'AA:BB:CC:DD:EE:FF', '--ndjson'] + shlex.split(command), band_factory=factory,
+                     stream=StringIO())
+        t_single = time.time() - t
+        print("cli %d commands: batch over one connection %.0f ms, one connection each %.0f ms" % (
+            len(commands), t_batch * 1000, t_single * 1000))
+    finally:
+        os.remove(path)
+
+    # a band that goes quiet must not keep ``stream --seconds`` waiting, a failed pump is an error
+    def quiet(mac_address, debug=False):
+        return _sim_band(mac_address=mac_address, latency=latency, rates={QUEUE_TYPES.HEART: 0.01})
+
+    def dropping(mac_address, debug=False):
+        band = _sim_band(mac_address=mac_address, latency=latency, auto_reconnect=False)
+        band.schedule_drop(1.0)
+        return band
+    out = StringIO()
+    t = time.time()
+    assert cli.main(['--mac', 'AA:BB:CC:DD:EE:FF', 'stream', '--seconds', '0.5'], band_factory=quiet, stream=out) == 0
+    t_quiet = time.time() - t
+    assert t_quiet < 2.0, t_quiet
+    assert json.loads(out.getvalue().splitlines()[-1])['samples'] <= 1
+    try:
+        cli.main(['--mac', 'AA:BB:CC:DD:EE:FF', 'stream', '--seconds', '30'], band_factory=dropping,
+                 stream=StringIO())
+    except BTLEException:
+        pass
+    else:
+        raise AssertionError("stream ended without the pump error")
+    print("cli stream --seconds 0.5 on a quiet band: %.2f s" % t_quiet)
+
+
+# Daemon #################################################################
+
+def bench_daemon(requests=200, clients=8, latency=0.0075):
+    from daemon import BandDaemon, DaemonClient, DaemonError
+    from simulator import SimulatedMiBand3
+    mac = 'AA:BB:CC:DD:EE:FF'
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'daemon.sock')
+    daemon = BandDaemon(path, band_factory=SimulatedMiBand3, latency=latency,
+                        handle_cache=HandleCache(os.path.join(workdir, 'handles.json'))).start()
+    try:
+        # what every main.py/connect.py run pays before its first answer
+        t = time.time()
+        band = SimulatedMiBand3(mac, latency=latency, handle_cache=HandleCache(os.path.join(workdir, 'cold.json')))
+        band.authenticate()
+        band.get_battery_info()
+        t_standalone = time.time() - t
+        band.disconnect()
+
+        with DaemonClient(path) as client:
+            _, t_first = _timed(client.call, 'battery', mac)
+        latencies = []
+        for _ in range(requests):
+            t = time.time()
+            # short-lived client: connect, ask, hang up
+            with DaemonClient(path) as client:
+                client.call('steps', mac)
+            latencies.append(time.time() - t)
+        latencies.sort()
+        print("daemon: standalone connect+auth+read %.1f ms, first daemon request %.1f ms, "
+              "warm request p50 %.2f ms p95 %.2f ms" % (
+                  t_standalone * 1000, t_first * 1000, latencies[len(latencies) // 2] * 1000,
+                  latencies[int(len(latencies) * 0.95)] * 1000))
+
+        errors = []
+
+        def worker():
+            try:
+                with DaemonClient(path) as client:
+                    for _ in range(requests // clients):
+                        assert client.call('battery', mac)['level'] is not None
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in range(clients)]
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        t_concurrent = time.time() - t
+        assert not errors, errors
+        session = daemon.sessions[mac]
+        print("daemon: %d concurrent clients, %d requests serialized onto one connection in %.2f s (%.0f req/s)" % (
+            clients, requests, t_concurrent, requests / t_concurrent))
+
+        with DaemonClient(path) as client:
+            bpms = list(client.subscribe_heart(mac, seconds=2))
+        assert bpms and all(bpm == session.band.heart_bpm for bpm in bpms), bpms
+        with DaemonClient(path) as client:
+            status = client.call('sessions')
+        assert status[0]['requests'] == 1 + 2 * requests and status[0]['heart_subscribers'] == 0, status
+        print("daemon: heart subscription delivered %d BPM values in 2 s" % len(bpms))
+
+        # malformed requests get an error reply; the connection stays usable unless it was a subscription
+        bad = ['[1]', json.dumps({'id': 1, 'mac': mac, 'op': 'snapshot', 'args': [1]}),
+               json.dumps({'id': 2, 'op': 'subscribe_heart'})]
+        for line in bad:
+            with DaemonClient(path, timeout=10) as client:
+                client._file.write(line + '\n')
+                client._file.flush()
+                reply = json.loads(client._file.readline())
+                if reply['ok'] or ('subscribe_heart' not in line and client.call('ping') != 'pong'):
+                    raise AssertionError("bad request %s: %r" % (line, reply))
+        print("daemon: %d malformed requests answered with errors" % len(bad))
+
+        # a stream that fails to start leaves no subscriber behind
+        band = session.band
+
+        def fail(**kwargs):
+            del band.start_raw_data_realtime
+            raise BTLEException("injected failure")
+        band.start_raw_data_realtime = fail
+        try:
+            session.subscribe()
+        except BTLEException:
+            pass
+        if session.status()['heart_subscribers'] or session.streaming:
+            raise AssertionError("failed subscription left behind: %r" % session.status())
+        with DaemonClient(path) as client:
+            if not list(client.subscribe_heart(mac, seconds=1.5)):
+                raise AssertionError("no heart rate after a failed stream start")
+
+        # a stream that dies under a subscriber is an error for it; the next subscriber gets a live stream
+        band.auto_reconnect = False
+        with DaemonClient(path) as client:
+            bpms = client.subscribe_heart(mac, seconds=30)
+            next(bpms)
+            band.drop_link()
+            try:
+                list(bpms)
+            except DaemonError:
+                pass
+            else:
+                raise AssertionError("subscription ended normally on a dead stream")
+        band.auto_reconnect = True
+        with DaemonClient(path) as client:
+            if not list(client.subscribe_heart(mac, seconds=1.5)):
+                raise AssertionError("no heart rate after the stream died")
+        print("daemon: dead stream reported to its subscriber and restarted for the next one")
+    finally:
+        daemon.close()
+        shutil.rmtree(workdir)
+
+
+# Alert dispatch #########################################################
+
+def bench_alerts(bands=12, per_band=12, latency=0.0075, rate=50.0):
+    from alerts import AlertDispatcher, Alert
+    macs = ['AA:BB:CC:DD:00:%02X' % i for i in range(bands)]
+    fleet = dict((mac, _sim_band(mac_address=mac, latency=latency)) for mac in macs)
+    for band in fleet.values():
+        band.authenticate()
+    # per band: messages, one repeated, a conversation updated twice, then a call
+    burst = [('message', 'Lunch?', None), ('message', 'Lunch?', None), ('message', 'Build 1 red', 'ci'),
+             ('message', 'Build 2 red', 'ci'), ('message', 'Build 3 green', 'ci')]
+    burst += [('message', 'Mail %d' % i, None) for i in range(per_band - len(burst) - 1)]
+    burst += [('call', 'Alice', None)]
+
+    t = time.time()
+    for mac in macs:
+        for kind, text, key in burst:
+            fleet[mac].send_custom_alert({'message': 5, 'call': 3}[kind], text)
+    t_serial = time.time() - t
+
+    # every 5th write to a band fails, its retry goes through
+    for band in fleet.values():
+        def flaky(_type, phone=None, send=band.send_custom_alert, writes=[0]):
+            writes[0] += 1
+            if writes[0] % 5 == 0:
+                raise BTLEException("injected write failure")
+            return send(_type, phone)
+        band.send_custom_alert = flaky
+    dispatcher = AlertDispatcher(fleet, rate=rate, burst=3, retry_delay=0.005)
+    t = time.time()
+    tickets = [dispatcher.send(mac, kind, text, key) for mac in macs for kind, text, key in burst]
+    assert dispatcher.flush(30)
+    t_dispatch = time.time() - t
+    dispatcher.close()
+    # a coalesced send returns the alert it was merged into
+    sent = [a for a in set(tickets) if a.state == Alert.SENT]
+    assert all(a.state in (Alert.SENT, Alert.COALESCED, Alert.SUPERSEDED) for a in tickets), tickets
+    # the first alert of a burst may already be on its way when its duplicate arrives
+    assert len(sent) + dispatcher.superseded == len(tickets) - dispatcher.coalesced
+    assert dispatcher.superseded >= bands
+    # the call overtakes the messages queued before it
+    for mac in macs:
+        delivered = sorted((a for a in sent if a.mac_address == mac), key=lambda a: a.delivered_at)
+        assert [a.kind for a in delivered].index('call') <= 3, delivered
+    summary = dispatcher.stats.summary()
+    print("alerts %d bands x %d alerts: serial sends %.2f s, dispatcher %.2f s (rate limit %.0f/s per band)" % (
+        bands, len(burst), t_serial, t_dispatch, rate))
+    print("alerts sent %d, coalesced %d, superseded %d, retried writes %d" % (
+        len(sent), dispatcher.coalesced, dispatcher.superseded, sum(a.attempts - 1 for a in sent)))
+    for kind in ('call', 'message'):
+        s = summary[kind]
+        print("alerts %-7s latency p50 %.1f ms p95 %.1f ms p99 %.1f ms" % (
+            kind, s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000))
+
+    # an unknown MAC is refused; a band gone from the dict or a non-BLE error fails one alert, not the queue
+    try:
+        dispatcher.send('00:00:00:00:00:00', 'message', 'lost')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("alert to an unknown band accepted")
+    band, fleet[macs[1]] = fleet[macs[1]], None
+    gone = dispatcher.send(macs[1], 'message', 'gone')
+    if gone.wait(5) or gone.state != Alert.FAILED:
+        raise AssertionError("a failing write did not fail the alert: %r" % gone)
+    fleet[macs[1]] = band
+    later = dispatcher.send(macs[1], 'message', 'later')
+    if not later.wait(5) or not dispatcher.flush(5):
+        raise AssertionError("queue stopped after a failed alert: %r" % later)
+    dispatcher.close()
+
+
+# Recording ##############################################################
+
+def bench_recorder(n=1000000):
+    from recorder import Recorder, RecordingReader, replay, INDEX_ENTRY
+    accel, ppg = _raw_packets(64)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'session.mbr')
+    try:
+        # ~3 days of samples spread evenly
+        start, step = 1.5e9, 3 * 86400.0 / n
+        with Recorder(path) as rec:
+            t = time.time()
+            for i in range(n):
+                if i % 2:
+                    rec.write(QUEUE_TYPES.RAW_ACCEL, accel[i % 64], start + i * step)
+                else:
+                    rec.write(QUEUE_TYPES.RAW_HEART, ppg[i % 64], start + i * step)
+            t_write = time.time() - t
+        print("recorder write: %.2f us/record, %.1f MB" % (
+            t_write / n * 1e6, os.path.getsize(path) / (1024.0 * 1024.0)))
+
+        reader = RecordingReader(path)
+        t = time.time()
+        hits = list(reader.query(start + 86400, start + 86400 + 600))
+        print("recorder 10 min query over 3 days: %.2f ms, %d records" % ((time.time() - t) * 1000, len(hits)))
+        reader.close()
+
+        band = _sim_band()
+        got = []
+        band.accel_raw_batch_callback = lambda columns: got.append(len(columns['x']))
+        t = time.time()
+        replay(path, band, start + 86400, start + 86400 + 600)
+        print("recorder replay: %.0f records/s" % (len(hits) / (time.time() - t)))
+        assert sum(got) == 3 * sum(1 for h in hits if h[1] == QUEUE_TYPES.RAW_ACCEL)
+
+        # a crash mid-write: the torn record and an index entry past the end are cut off on reopen
+        torn = os.path.join(directory, 'torn.mbr')
+        with Recorder(torn, index_every=2) as rec:
+            for i in range(2):
+                rec.write(QUEUE_TYPES.RAW_ACCEL, accel[i], start + i)
+        with open(torn, 'ab') as f:
+            f.write(b'\xff' * 10)
+        with open(torn + '.idx', 'ab') as f:
+            f.write(INDEX_ENTRY.pack(start + 2, 2) + b'\xff' * 3)
+        with Recorder(torn) as rec:
+            rec.write(QUEUE_TYPES.RAW_HEART, ppg[0], start + 2)
+        reader = RecordingReader(torn)
+        records = list(reader.query())
+        if [(ts, _type) for ts, _type, _ in records] != [
+                (start, QUEUE_TYPES.RAW_ACCEL), (start + 1, QUEUE_TYPES.RAW_ACCEL), (start + 2, QUEUE_TYPES.RAW_HEART)]:
+            raise AssertionError("torn recording misread: %r" % records)
+        if reader._index_rec != [0, 2]:
+            raise AssertionError("stale index entries kept: %r" % reader._index_rec)
+        reader.close()
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+# Worker processes #######################################################
+
+def _raw_streams(bands, packets):
+    """Per band, ``packets`` raw notifications at the band's accel:PPG ratio (7:3)."""
+    accel, ppg = _raw_packets(64)
+    return [[accel[i % 64] if i % 10 < 7 else ppg[i % 64] for i in range(packets)] for _ in range(bands)]
+
+
+class _SampleCount(object):
+
+    """Analytics engine reporting how many samples it has seen."""
+
+    def __init__(self):
+        self.samples = 0
+
+    def update(self, columns):
+        self.samples += len(columns['t'])
+        return {'samples': self.samples}
+
+
+def _workers_reuse(packets=2000, batch=50):
+    """A ring reused by another band starts with fresh engines and none of the old band's records."""
+    from workers import WorkerPool, ANALYTICS
+    ppg = _raw_packets(64)[1]
+    pool = WorkerPool(workers=1, max_bands=1, analytics={QUEUE_TYPES.RAW_HEART: _SampleCount})
+    try:
+        for n, mac in enumerate(('AA:BB:CC:DD:00:01', 'AA:BB:CC:DD:00:02')):
+            band = _sim_band(mac_address=mac)
+            results = []
+            pool.attach(band)
+            band.subscribe((ANALYTICS,), callback=lambda _type, value: results.append(value), maxsize=1 << 16)
+            for i in range(0, packets, batch):
+                for p in ppg[:batch]:
+                    band._on_sensor_data(p)
+                band._parse_queue()
+            if n:
+                deadline = time.time() + 30
+                while (not results or results[-1][1]['samples'] < packets * 7) and time.time() < deadline:
+                    time.sleep(0.005)
+                if results[-1][1]['samples'] != packets * 7:
+                    raise AssertionError("reused ring saw %d samples, expected %d" % (
+                        results[-1][1]['samples'], packets * 7))
+            pool.detach(band)
+    finally:
+        pool.close()
+
+
+def bench_workers(bands=4, packets=20000, batch=50):
+    from heartrate import HeartRateEstimator
+    from motion import MotionEngine
+    from workers import WorkerPool, ANALYTICS
+    analytics = {QUEUE_TYPES.RAW_HEART: HeartRateEstimator, QUEUE_TYPES.RAW_ACCEL: MotionEngine}
+    streams = _raw_streams(bands, packets)
+    samples = sum(3 if len(p) == 20 else 7 for stream in streams for p in stream)
+
+    # everything on the pump thread: decode in _parse_queue, analytics in the batch callbacks
+    sims = [_sim_band(mac_address='AA:BB:CC:DD:00:%02X' % i) for i in range(bands)]
+    for band in sims:
+        hr, motion = HeartRateEstimator(), MotionEngine()
+        band.heart_raw_batch_callback, band.accel_raw_batch_callback = hr.update, motion.update
+    t = time.time()
+    for i in range(0, packets, batch):
+        for band, stream in zip(sims, streams):
+            for p in stream[i:i + batch]:
+                band._on_sensor_data(p)
+            band._parse_queue()
+    t_inline = time.time() - t
+    print("workers inline: pump busy %.2f s, %.0f samples/s, %.1f us per notification" % (
+        t_inline, samples / t_inline, t_inline / (bands * packets) * 1e6))
+
+    for workers in (1, 2, 4):
+        pool = WorkerPool(workers=workers, max_bands=bands, capacity=1 << 15, analytics=analytics)
+        results = []
+        for band in sims:
+            pool.attach(band)
+            band.subscribe((ANALYTICS,), callback=lambda _type, value: results.append(value), maxsize=1 << 16)
+        t = time.time()
+        for i in range(0, packets, batch):
+            for band, stream in zip(sims, streams):
+                for p in stream[i:i + batch]:
+                    band._on_sensor_data(p)
+                band._parse_queue()
+        t_pump = time.time() - t
+        while pool.samples < samples and time.time() - t < 60:
+            time.sleep(0.005)
+        t_total = time.time() - t
+        stats = pool.stats()
+        pool.close()
+        for band in sims:
+            band.fanout = None
+        print("workers %d proc: pump busy %.2f s (%.1f us per notification), %.0f samples/s end to end, "
+              "%d analytics results" % (workers, t_pump, t_pump / (bands * packets) * 1e6, samples / t_total,
+                                        len(results)))
+        assert pool.samples == samples, (pool.samples, samples)
+        assert not any(ring['dropped'] for ring in stats['bands'].values()), stats
+    _workers_reuse()
+    print("workers: ring reuse starts a new generation: ok")
+    print("workers: %d CPU core(s) here" % multiprocessing.cpu_count())
+
+
+# Columnar export ########################################################
+
+def bench_export(bands=4, days=3, batch=3600, accel_hours=2):
+    import numpy as np
+    import codec
+    from export import ColumnExporter, ColumnStore
+    from recorder import Recorder
+    macs = ['AA:BB:CC:DD:00:%02X' % i for i in range(bands)]
+    # midnight UTC, 1 Hz heart rate for every band and day, 25 Hz accelerometer for a few hours a day
+    start = 1556668800.0
+    t_heart = start + np.arange(days * 86400, dtype=np.float64)
+    bpm = (70 + 20 * np.sin(np.arange(len(t_heart)) / 3600.0)).astype(np.uint16)
+    t_accel = start + np.arange(accel_hours * 3600 * 25, dtype=np.float64) / 25
+    accel = np.arange(len(t_accel)) % 1000
+    workdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(workdir, 'export')
+        exporter = ColumnExporter(root, format='npy')
+        t = time.time()
+        for mac in macs:
+            for i in range(0, len(t_heart), batch):
+                exporter.write(mac, QUEUE_TYPES.HEART, {'t': t_heart[i:i + batch], 'bpm': bpm[i:i + batch]})
+            for i in range(0, len(t_accel), batch):
+                exporter.write(mac, QUEUE_TYPES.RAW_ACCEL, {'t': t_accel[i:i + batch], 'x': accel[i:i + batch],
+                                                            'y': accel[i:i + batch], 'z': accel[i:i + batch]})
+        exporter.close()
+        t_write = time.time() - t
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+        print("export %d rows in %d parts: %.0f rows/s, %.1f MB, at most %d rows buffered" % (
+            exporter.rows_written, exporter.parts_written, exporter.rows_written / t_write, size / 1048576.0,
+            exporter.max_buffered))
+        assert exporter.max_buffered <= exporter.max_buffered_rows + batch
+        assert exporter.rows_written == bands * (len(t_heart) + len(t_accel))
+
+        store = ColumnStore(root)
+        day_start, day_end = start + 86400, start + 2 * 86400
+        t = time.time()
+        res = store.aggregate(QUEUE_TYPES.HEART, 'bpm', every=60, how='mean', start=day_start, end=day_end,
+                              bands=[macs[1]])
+        t_query = time.time() - t
+        # the same, reading every partition and column and filtering afterwards
+        t = time.time()
+        everything = store.query(QUEUE_TYPES.HEART)
+        rows = (everything['band'] == macs[1]) & (everything['t'] >= day_start) & (everything['t'] < day_end)
+        naive = np.bincount(((everything['t'][rows] - day_start) // 60).astype(int),
+                            weights=everything['bpm'][rows]) / 60
+        t_naive = time.time() - t
+        day = (t_heart >= day_start) & (t_heart < day_end)
+        assert len(res['t']) == 1440 and (res['count'] == 60).all()
+        assert np.allclose(res['bpm'], bpm[day].reshape(-1, 60).mean(axis=1)) and np.allclose(res['bpm'], naive)
+        touched = len(list(store.parts(QUEUE_TYPES.HEART, day_start, day_end, [macs[1]])))
+        print("export per-minute mean BPM, one band one day: %.1f ms over %d parts, full scan %.1f ms (%.0fx)" % (
+            t_query * 1000, touched, t_naive * 1000, t_naive / t_query))
+
+        # a recording converts in bounded chunks
+        path = os.path.join(workdir, 'session.mbr')
+        with Recorder(path) as rec:
+            for i in range(20000):
+                rec.write(QUEUE_TYPES.HEART, codec.encode_heart_measure(60 + i % 40), start + i)
+                rec.write(QUEUE_TYPES.RAW_ACCEL, codec.encode_accel(i & 0xFF, [(i % 100, 0, 1000)] * 3), start + i)
+        exporter = ColumnExporter(os.path.join(workdir, 'recording'), format='npy', chunk_rows=8192)
+        t = time.time()
+        exporter.write_recording(path, macs[0], chunk_records=4096)
+        exporter.close()
+        store = ColumnStore(os.path.join(workdir, 'recording'))
+        heart = store.query(QUEUE_TYPES.HEART)
+        print("export recording: %d packets converted in %.0f ms, at most %d rows buffered" % (
+            40000, (time.time() - t) * 1000, exporter.max_buffered))
+        assert len(heart['t']) == 20000 and heart['bpm'][:40].tolist() == list(range(60, 100))
+        assert len(store.query(QUEUE_TYPES.RAW_ACCEL, ['x'])['x']) == 60000
+
+        # steps polls of an older firmware without meters and calories
+        exporter = ColumnExporter(os.path.join(workdir, 'polls'), format='npy')
+        on_poll = exporter.poll_callback(macs[0])
+        on_poll('steps', codec.decode_steps(codec.encode_steps(1234)[:5]))
+        on_poll('steps', codec.decode_steps(codec.encode_steps(1500, 1100)[:9]))
+        exporter.close()
+        steps = ColumnStore(os.path.join(workdir, 'polls')).query('steps')
+        if (steps['steps'].tolist(), steps['meters'].tolist(), steps['calories'].tolist()) != (
+                [1234, 1500], [0, 1100], [0, 0]):
+            raise AssertionError("steps polls exported wrong: %r" % (steps,))
+
+        # live export next to a realtime stream
+        band = _sim_band()
+        band.authenticate()
+        exporter = ColumnExporter(os.path.join(workdir, 'live'), format='npy')
+        exporter.attach(band)
+        band.schedule_polls(battery=0.5, steps=0.5, time_drift=None, callback=exporter.poll_callback(band.mac_address))
+        stream = band.start_raw_data_realtime()
+        time.sleep(1.5)
+        stream.stop()
+        exporter.close()
+        store = ColumnStore(os.path.join(workdir, 'live'))
+        counts = dict((table, len(store.query(table)['t'])) for table in store.tables())
+        print("export live 1.5 s: %s" % ', '.join('%s %d' % item for item in sorted(counts.items())))
+        assert counts[QUEUE_TYPES.HEART] and counts[QUEUE_TYPES.RAW_ACCEL] and counts['battery']
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Activity history #######################################################
+
+def bench_activity():
+    from store import JsonStore
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'activity_sync.json')
+    try:
+        band = _sim_band()
+        band.authenticate()
+        for label in ('first sync (7 days)', 'incremental sync'):
+            t = time.time()
+            records = band.sync_activity(state=JsonStore(path))
+            elapsed = time.time() - t
+            print("activity %s: %d records in %.3f s (%.0f records/s)" % (
+                label, len(records), elapsed, len(records) / elapsed))
+            if label.startswith('first'):
+                last = datetime.fromtimestamp(int(records['t'][-1])).strftime('%Y-%m-%d %H:%M')
+                expected = [band.history_record(i) for i in range(len(records))]
+                if records['heart_rate'][0] != ord(expected[0][3:4]):
+                    raise AssertionError("activity records decoded wrong")
+            with open(path) as f:
+                stored = json.load(f)
+            if stored != {band.mac_address.upper(): last}:
+                raise AssertionError("high-water mark on disk %r, expected %r" % (stored, last))
+        if len(records):
+            raise AssertionError("incremental sync fetched %d records again" % len(records))
+        # a store passed later is used too: an empty one means a full first sync again
+        records = band.sync_activity(state=JsonStore(os.path.join(workdir, 'other.json')))
+        if len(records) < 7 * 24 * 60:
+            raise AssertionError("sync ignored the state store it was given (%d records)" % len(records))
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Heart rate estimation ##################################################
+
+def _synthetic_wrist(hours, fs, seed=1):
+    # PPG with a drifting pulse rate, baseline wander and noise, plus 20 s of wrist motion every 10 min
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(hours * 3600 * fs)) / float(fs)
+    bpm = 75 + 25 * np.sin(2 * np.pi * t / 1800.0)
+    phase = np.cumsum(2 * np.pi * bpm / 60.0 / fs)
+    ppg = 2000 + 300 * np.sin(phase) + 200 * np.sin(2 * np.pi * 0.05 * t) + rng.normal(0, 20, len(t))
+    moving = (t % 600) < 20
+    ppg[moving] += rng.normal(0, 400, moving.sum())
+    accel = rng.normal(0, 5, (len(t), 3))
+    accel[:, 2] += 1000
+    accel[moving] += rng.normal(0, 300, (moving.sum(), 3))
+    return t, bpm, np.clip(ppg, 0, 65535).astype('<u2'), accel.astype('<i2'), moving
+
+
+def bench_heartrate(hours=3, fs=25, batch=25):
+    import numpy as np
+    from heartrate import HeartRateEstimator
+    t, bpm, ppg, accel, moving = _synthetic_wrist(hours, fs)
+    estimator = HeartRateEstimator(sample_rate=fs)
+    errors, motion_updates, motion_rejected = [], 0, 0
+    updates = confident = 0
+    elapsed = 0.0
+    for i in range(0, len(t), batch):
+        s = slice(i, i + batch)
+        ppg_columns = {'t': t[s], 'ppg': ppg[s]}
+        accel_columns = {'t': t[s], 'x': accel[s, 0], 'y': accel[s, 1], 'z': accel[s, 2]}
+        started = time.time()
+        # same order as MiBand3._parse_queue: PPG batch first, then accel
+        estimate = estimator.update(ppg_columns)
+        estimator.update_motion(accel_columns)
+        elapsed += time.time() - started
+        updates += 1
+        if moving[s].all():
+            motion_updates += 1
+            motion_rejected += estimate is None or estimate.motion or estimate.confidence < 0.5
+        elif estimate is not None and estimate.confidence >= 0.5:
+            confident += 1
+            errors.append(abs(estimate.bpm - bpm[min(i + batch, len(t)) - 1]))
+    print("heartrate %d h at %d Hz: %.0f samples/s, %.2f us/sample" % (
+        hours, fs, len(t) / elapsed, elapsed / len(t) * 1e6))
+    print("heartrate confident estimates: %d of %d updates, mean abs error %.2f bpm" % (
+        confident, updates, np.mean(errors)))
+    print("heartrate updates during motion rejected or flagged: %d of %d" % (motion_rejected, motion_updates))
+
+
+# Motion #################################################################
+
+# (seconds, steps per minute, vertical amplitude in g, expected intensity)
+MOTION_SCENARIO = [
+    (2400, 0, 0.0, 'sedentary'),
+    (600, 80, 0.2, 'light'),
+    (600, 110, 0.45, 'moderate'),
+    (600, 160, 1.5, 'vigorous'),
+    (300, 0, 0.0, 'sedentary'),
+]
+# falls land in the first rest period, after the inactivity alarm
+MOTION_FALLS = (1900, 2000, 2100)
+
+
+def _synthetic_motion(fs, counts_per_g=1000, seed=2):
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    parts, labels, steps = [], [], 0
+    for seconds, cadence, amplitude, label in MOTION_SCENARIO:
+        t = np.arange(seconds * fs) / float(fs)
+        xyz = np.zeros((len(t), 3))
+        xyz[:, 2] = 1.0 + amplitude * np.sin(2 * np.pi * cadence / 60.0 * t)
+        # arm swing, one cycle per two steps
+        xyz[:, 0] = 0.5 * amplitude * np.sin(np.pi * cadence / 60.0 * t)
+        parts.append(xyz)
+        labels.extend([label] * seconds)
+        steps += seconds * cadence // 60
+    xyz = np.concatenate(parts) + rng.normal(0, 0.01, (sum(len(p) for p in parts), 3))
+    for at in MOTION_FALLS:
+        i = at * fs
+        xyz[i:i + int(0.3 * fs)] = 0.05
+        xyz[i + int(0.3 * fs):i + int(0.4 * fs)] = (0.5, 0.5, 3.5)
+    t = np.arange(len(xyz)) / float(fs)
+    return t, (xyz * counts_per_g).astype('<i2'), labels, steps
+
+
+def bench_motion(fs=25, batch=25):
+    import numpy as np
+    from motion import MotionEngine
+    t, xyz, labels, true_steps = _synthetic_motion(fs)
+    engine = MotionEngine(sample_rate=fs)
+    epochs = []
+    started = time.time()
+    for i in range(0, len(t), batch):
+        s = slice(i, i + batch)
+        epochs.extend(engine.update({'t': t[s], 'x': xyz[s, 0], 'y': xyz[s, 1], 'z': xyz[s, 2]}))
+    elapsed = time.time() - started
+
+    # skip the first few seconds of each segment while the filters settle
+    settled, offset = [], 0
+    for seconds, _, _, _ in MOTION_SCENARIO:
+        settled.extend(range(offset + 3, offset + seconds))
+        offset += seconds
+    correct = sum(1 for i in settled if i < len(epochs) and epochs[i].intensity == labels[i])
+    kinds = [e.kind for e in engine.events]
+    print("motion %.1f h at %d Hz: %.0f samples/s (%d bands per core)" % (
+        len(t) / float(fs) / 3600, fs, len(t) / elapsed, len(t) / elapsed / fs))
+    print("motion steps: %d counted, %d expected (%+.1f%%)" % (
+        engine.steps, true_steps, 100.0 * (engine.steps - true_steps) / true_steps))
+    offset = 0
+    for seconds, cadence, _, label in MOTION_SCENARIO:
+        if cadence:
+            measured = np.median([e.cadence for e in epochs[offset + 15:offset + seconds]])
+            print("motion %s cadence: %.1f spm, expected %d" % (label, measured, cadence))
+        offset += seconds
+    print("motion intensity accuracy: %.1f%% of %d epochs" % (100.0 * correct / len(settled), len(settled)))
+    print("motion falls: %d detected, %d expected; inactivity alarms: %d" % (
+        kinds.count('fall'), len(MOTION_FALLS), kinds.count('inactive')))
+
+
+# End-to-end suite #######################################################
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# name, unit, higher is better, changes smaller than this are noise
+SUITE_METRICS = [
+    ('notifications_per_sec', 'notifications/s', True, 0),
+    ('parse_latency_p50_ms', 'ms', False, 1.0),
+    ('parse_latency_p95_ms', 'ms', False, 1.0),
+    ('parse_latency_p99_ms', 'ms', False, 1.0),
+    ('connect_auth_ms', 'ms', False, 5.0),
+    ('dfu_kb_per_sec', 'KB/s', True, 0),
+]
+# a metric this much worse than the baseline counts as a regression
+REGRESSION_THRESHOLD = 0.2
+
+
+def _suite_throughput(n=60000, runs=5):
+    return sorted(_suite_throughput_once(n) for _ in range(runs))[runs // 2]
+
+
+def _suite_throughput_once(n):
+    # notifications already queued on the link: delegate -> channels -> decode -> callbacks
+    band = _sim_band()
+    band.authenticate()
+    accel, ppg = _raw_packets(64)
+    for i in range(n):
+        band.notify(UUIDS.CHARACTERISTIC_HZ, ppg[i % 64] if i % 2 else accel[i % 64])
+    samples = [0]
+    band.accel_raw_batch_callback = lambda columns: samples.__setitem__(0, samples[0] + len(columns['t']))
+    delivered = 0
+    t = time.time()
+    while band.waitForNotifications(0):
+        delivered += 1
+        if delivered % 64 == 0:
+            band._parse_queue()
+    band._parse_queue()
+    elapsed = time.time() - t
+    assert delivered == n and samples[0] == 3 * (n // 2), "notifications lost"
+    return n / elapsed
+
+
+def _suite_latency(duration=3.0, rate=200.0):
+    import numpy as np
+    band = _sim_band(rates={QUEUE_TYPES.RAW_ACCEL: rate, QUEUE_TYPES.RAW_HEART: rate})
+    band.authenticate()
+    latencies = []
+
+    def record(columns):
+        latencies.append(time.time() - columns['t'])
+    stream = band.start_raw_data_realtime(accel_raw_batch_callback=record, heart_raw_batch_callback=record)
+    time.sleep(duration)
+    stream.stop()
+    assert latencies, "no realtime data"
+    return np.percentile(np.concatenate(latencies) * 1000, [50, 95, 99])
+
+
+def _suite_connect_auth(runs=5, latency=0.0075):
+    times = []
+    for _ in range(runs):
+        t = time.time()
+        band = _sim_band(latency=latency)
+        assert band.authenticate()
+        times.append(time.time() - t)
+    return sorted(times)[runs // 2] * 1000
+
+
+def _suite_dfu(size_kb=256, latency=0.0075, runs=5):
+    rates = []
+    for _ in range(runs):
+        band = _sim_band(latency=latency)
+        image = os.urandom(size_kb * 1024)
+        transfer = DfuTransfer(band._char('CHARACTERISTIC_DFU_FIRMWARE'),
+                               band._char('CHARACTERISTIC_DFU_FIRMWARE_WRITE'),
+                               chunk_size=negotiate_chunk_size(band))
+        transfer.send(image)
+        assert bytes(band.dfu_image) == image, "image corrupted"
+        rates.append(transfer.bytes_per_sec / 1024.0)
+    return sorted(rates)[runs // 2]
+
+
+def run_suite():
+    p50, p95, p99 = _suite_latency()
+    return {
+        'notifications_per_sec': _suite_throughput(),
+        'parse_latency_p50_ms': p50,
+        'parse_latency_p95_ms': p95,
+        'parse_latency_p99_ms': p99,
+        'connect_auth_ms': _suite_connect_auth(),
+        'dfu_kb_per_sec': _suite_dfu(),
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print results next to the baseline, return the names of regressed metrics."""
+    regressions = []
+    for name, unit, higher_is_better, noise in SUITE_METRICS:
+        value, base = results[name], baseline.get(name)
+        if not base:
+            print("%-24s %12.2f %s" % (name, value, unit))
+            continue
+        change = (value - base) / float(base)
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold and abs(value - base) > noise:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-24s %12.2f %s  (baseline %.2f, %+.0f%%)%s" % (name, value, unit, base, change * 100, flag))
+    return regressions
+
+
+def bench_suite(baseline_path=BASELINE_PATH, save=False):
+    results = run_suite()
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline)
+    if save:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline saved to %s" % baseline_path)
+    return regressions
+
+
+BENCHMARKS = {
+    'activity': bench_activity,
+    'alerts': bench_alerts,
+    'cli': bench_cli,
+    'codec': bench_codec,
+    'connparams': bench_connparams,
+    'crc': bench_crc,
+    'daemon': bench_daemon,
+    'decode': bench_decode,
+    'dfu': bench_dfu,
+    'dispatch': bench_dispatch,
+    'export': bench_export,
+    'fanout': bench_fanout,
+    'fleet': bench_fleet,
+    'gatt': bench_gatt,
+    'heartrate': bench_heartrate,
+    'metrics': bench_metrics,
+    'motion': bench_motion,
+    'reconnect': bench_reconnect,
+    'recorder': bench_recorder,
+    'scheduler': bench_scheduler,
+    'snapshot': bench_snapshot,
+    'suite': bench_suite,
+    'workers': bench_workers,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks against the simulated band")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all)")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="suite baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="store this suite run as the baseline")
+    args = parser.parse_args()
+    failed = False
+    for name in args.names or sorted(BENCHMARKS):
+        print("== %s" % name)
+        if name == 'suite':
+            failed = bool(bench_suite(args.baseline, args.save_baseline))
+        else:
+            BENCHMARKS[name]()
+    sys.exit(1 if failed else 0)
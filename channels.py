@@ -0,0 +1,49 @@
+from collections import deque
+
+from constants import QUEUE_TYPES
+
+__all__ = ['Channel', 'make_channels']
+
+DEFAULT_CHANNEL_SIZE = 4096
+
+
+class Channel(object):
+
+    """Bounded FIFO for one notification type, drops the oldest item when full.
+
+    deque.append/popleft are atomic, so one producer and one consumer thread
+    can share a channel without a lock.
+    """
+
+    def __init__(self, maxlen=DEFAULT_CHANNEL_SIZE):
+        self._items = deque(maxlen=maxlen)
+        self.maxlen = maxlen
+        self.dropped = 0
+        # optional callable seeing every item as it is put (e.g. a Recorder)
+        self.tap = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        if self.tap is not None:
+            self.tap(item)
+        if len(self._items) == self.maxlen:
+            self.dropped += 1
+        self._items.append(item)
+
+    def get(self):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            return None
+
+    def drain(self):
+        items = self._items
+        while items:
+            yield items.popleft()
+
+
+def make_channels(maxlen=DEFAULT_CHANNEL_SIZE):
+    return dict((_type, Channel(maxlen)) for _type in
+                (QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_ACCEL, QUEUE_TYPES.RAW_HEART, QUEUE_TYPES.AUTH))
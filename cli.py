@@ -0,0 +1,216 @@
+"""Non-interactive command line interface, one JSON document (or NDJSON line) per result.
+
+    python cli.py --mac AA:BB:CC:DD:EE:FF info
+    python cli.py alert message "Dinner is ready"
+    python cli.py set-time --time "2019-05-01 12:00:00"
+    python cli.py dfu Mili_wuhan.fw
+    python cli.py stream --seconds 60 --raw
+    python cli.py batch commands.txt
+
+The MAC address can also come from $MIBAND_MAC. Only argparse and json are
+imported up front; bluepy, pycrypto and NumPy are loaded by the commands
+that talk to the band, so ``--help`` and argument errors return at once.
+"""
+import argparse
+import json
+import os
+import shlex
+import sys
+import time
+from datetime import datetime
+
+__all__ = ['main', 'build_parser']
+
+# kind -> (plain alert type name, custom alert type used when a text is given)
+ALERTS = {
+    'message': ('MESSAGE', 5),
+    'call': ('PHONE', 3),
+    'missed-call': (None, 4),
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'tolist'):
+        # NumPy columns of raw batches
+        return value.tolist()
+    raise TypeError(repr(value))
+
+
+class Output(object):
+
+    """Writes results as indented JSON, or as one line each with ``ndjson``."""
+
+    def __init__(self, stream=sys.stdout, ndjson=False):
+        self.stream = stream
+        self.ndjson = ndjson
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record, default=_json_default, sort_keys=True,
+                                     indent=None if self.ndjson else 2) + '\n')
+        self.stream.flush()
+
+
+# Commands ###############################################################
+
+def cmd_info(band, args, out):
+    return band.get_snapshot(refresh=args.refresh)
+
+
+def cmd_alert(band, args, out):
+    from constants import ALERT_TYPES
+    plain, custom = ALERTS[args.kind]
+    if args.text is None and plain is not None:
+        band.send_alert(getattr(ALERT_TYPES, plain))
+    else:
+        band.send_custom_alert(custom, args.text or '')
+    return {'kind': args.kind, 'text': args.text}
+
+
+def cmd_set_time(band, args, out):
+    return {'time': band.set_time(args.time)}
+
+
+def cmd_dfu(band, args, out):
+    def progress(sent, total, bytes_per_sec):
+        sys.stderr.write("dfu %d/%d bytes (%.1f KB/s)\n" % (sent, total, bytes_per_sec / 1024.0))
+    return band.dfu_update(args.file, progress if args.progress else None)
+
+
+def cmd_stream(band, args, out):
+    from constants import QUEUE_TYPES
+    types = (QUEUE_TYPES.HEART,)
+    if args.raw:
+        types += (QUEUE_TYPES.RAW_HEART, QUEUE_TYPES.RAW_ACCEL)
+    samples = 0
+    # the stream ends after --seconds even if the band sends nothing, and raises if the pump failed
+    for _type, value in band.stream(types, seconds=args.seconds or None):
+        out.emit({'t': time.time(), 'type': _type, 'value': value})
+        samples += 1
+        if args.count and samples >= args.count:
+            break
+    return {'samples': samples}
+
+
+def _timestamp(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected YYYY-MM-DD HH:MM:SS, got %r" % value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Scriptable Mi Band 3 commands with JSON output")
+    parser.add_argument('--mac', default=os.environ.get('MIBAND_MAC'),
+                        help="band MAC address (default: $MIBAND_MAC)")
+    parser.add_argument('--ndjson', action='store_true', help="one JSON object per line")
+    parser.add_argument('--initialize', action='store_true', help="pair (send the key) before authenticating")
+    parser.add_argument('--debug', action='store_true')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    info = commands.add_parser('info', help="revisions, serial, battery, steps and time")
+    info.add_argument('--refresh', action='store_true', help="bypass the read cache")
+    info.set_defaults(fn=cmd_info)
+
+    alert = commands.add_parser('alert', help="vibrate with an optional text")
+    alert.add_argument('kind', choices=sorted(ALERTS))
+    alert.add_argument('text', nargs='?')
+    alert.set_defaults(fn=cmd_alert)
+
+    set_time = commands.add_parser('set-time', help="set the band clock")
+    set_time.add_argument('--time', type=_timestamp, help="YYYY-MM-DD HH:MM:SS (default: now)")
+    set_time.set_defaults(fn=cmd_set_time)
+
+    dfu = commands.add_parser('dfu', help="upload a .fw or .res file")
+    dfu.add_argument('file')
+    dfu.add_argument('--progress', action='store_true', help="report progress on stderr")
+    dfu.set_defaults(fn=cmd_dfu)
+
+    stream = commands.add_parser('stream', help="realtime heart rate (and raw data) as NDJSON")
+    stream.add_argument('--seconds', type=float, help="stop after this many seconds")
+    stream.add_argument('--count', type=int, help="stop after this many samples")
+    stream.add_argument('--raw', action='store_true', help="include raw PPG and accelerometer batches")
+    stream.set_defaults(fn=cmd_stream)
+
+    batch = commands.add_parser('batch', help="run the commands in FILE ('-' for stdin) over one connection")
+    batch.add_argument('file')
+    batch.set_defaults(fn=None)
+    return parser
+
+
+# Running ################################################################
+
+def connect(args, band_factory=None):
+    if band_factory is None:
+        from auth import MiBand3 as band_factory
+    band = band_factory(args.mac, debug=args.debug)
+    band.setSecurityLevel(level="medium")
+    if args.initialize:
+        ok = band.initialize()
+    else:
+        ok = band.authenticate()
+    if not ok:
+        band.disconnect()
+        raise RuntimeError("%s: %s" % (args.mac, band.state))
+    return band
+
+
+def _read_batch(parser, path):
+    """Parse every line of a batch file up front, so a typo fails before connecting."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        lines = [line.strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    commands = []
+    for number, line in enumerate(lines, 1):
+        if not line or line.startswith('#'):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+        except SystemExit:
+            raise RuntimeError("%s:%d: invalid command %r" % (path, number, line))
+        if args.fn is None:
+            raise RuntimeError("%s:%d: batches cannot be nested" % (path, number))
+        commands.append((line, args))
+    return commands
+
+
+def main(argv=None, band_factory=None, stream=sys.stdout):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.mac:
+        parser.error("--mac (or $MIBAND_MAC) is required")
+    if args.fn is None:
+        commands = _read_batch(build_parser(), args.file)
+        out = Output(stream, ndjson=True)
+    else:
+        commands = [(None, args)]
+        out = Output(stream, ndjson=args.ndjson or args.command == 'stream')
+
+    band = connect(args, band_factory)
+    failed = 0
+    try:
+        for line, command in commands:
+            try:
+                result = command.fn(band, command, out)
+            except Exception as e:
+                if line is None:
+                    raise
+                failed += 1
+                out.emit({'command': line, 'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)})
+            else:
+                out.emit({'command': line, 'ok': True, 'result': result} if line is not None else result)
+    finally:
+        band.disconnect()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        sys.stderr.write("error: %s: %s\n" % (e.__class__.__name__, e))
+        sys.exit(1)
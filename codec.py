@@ -0,0 +1,203 @@
+import struct
+import time
+from datetime import datetime
+
+__all__ = [
+    'decode_date', 'encode_date', 'decode_current_time', 'encode_current_time',
+    'decode_battery', 'encode_battery', 'decode_steps', 'encode_steps', 'decode_serial',
+    'decode_accel', 'encode_accel', 'decode_ppg', 'encode_ppg', 'decode_heart_measure', 'encode_heart_measure',
+    'encode_heart_interval', 'encode_custom_alert', 'encode_encoding', 'encode_fetch_trigger',
+    'encode_dfu_start', 'encode_dfu_checksum', 'encode_le_params', 'decode_le_params', 'local_tz_quarters',
+]
+
+# Layouts ################################################################
+
+# year, month, day, hour, minute, second
+DATE = struct.Struct('<HBBBBB')
+# date, day of week (1 = Monday), fractions of a second in 1/256, adjust reason, timezone in quarter hours
+CURRENT_TIME = struct.Struct('<HBBBBBBBBb')
+CURRENT_TIME_READ = struct.Struct('<HBBBBBBB')
+# flags, level, charging, last off date, ?, last charge date, ?, level at last charge
+BATTERY = struct.Struct('<xBB' + 'HBBBBB' + 'x' + 'HBBBBB' + 'xB')
+# flags, steps, meters, calories
+STEPS = struct.Struct('<xIII')
+SERIAL = struct.Struct('12s')
+# packet type, counter, 3 x (x, y, z)
+ACCEL = struct.Struct('<BB9h')
+ACCEL_SAMPLES = struct.Struct('<2x9h')
+# packet type, counter, 7 PPG samples
+PPG = struct.Struct('<BB7H')
+PPG_SAMPLES = struct.Struct('<2x7H')
+# flags, bpm (uint8 unless bit 0 of the flags is set)
+HEART_MEASURE = struct.Struct('<BB')
+HEART_MEASURE_16 = struct.Struct('<BH')
+HEART_INTERVAL = struct.Struct('<BB')
+# 01 01, start date (minute resolution), second, timezone
+FETCH_TRIGGER = struct.Struct('<BBHBBBBBb')
+CONFIG_ENCODING = struct.Struct('<3s5s')
+# 01, image size (uint24), optional 02 for resource files
+DFU_START = struct.Struct('<BHB')
+DFU_CHECKSUM = struct.Struct('<BH')
+# min interval, max interval, slave latency, supervision timeout (uint16 each), two zero bytes,
+# advertising interval: the 12 byte payload Gadgetbridge writes
+LE_PARAMS = struct.Struct('<4H2xH')
+
+CUSTOM_ALERT_TYPES = {
+    3: b'\x03\x01',  # call
+    4: b'\x04\x01',  # missed call
+    5: b'\x05\x01',  # message
+}
+
+
+def local_tz_quarters():
+    offset = time.altzone if time.localtime().tm_isdst else time.timezone
+    return -offset // 900
+
+
+# Time ###################################################################
+
+def decode_date(buf, offset=0):
+    return datetime(*DATE.unpack_from(buf, offset))
+
+
+def encode_date(dt):
+    return DATE.pack(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+
+def decode_current_time(buf, offset=0):
+    """CHARACTERISTIC_CURRENT_TIME as returned by MiBand3.get_current_time."""
+    if len(buf) - offset >= CURRENT_TIME_READ.size:
+        fields = CURRENT_TIME_READ.unpack_from(buf, offset)
+        return {"date": datetime(*fields[:6]), "day_of_week": fields[6], "fractions256": fields[7]}
+    return {"date": decode_date(buf, offset), "day_of_week": None, "fractions256": None}
+
+
+def encode_current_time(dt, tz_quarters=None):
+    if tz_quarters is None:
+        tz_quarters = local_tz_quarters()
+    return CURRENT_TIME.pack(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+                             dt.isoweekday(), dt.microsecond * 256 // 1000000, 0, tz_quarters)
+
+
+# Battery, steps, info ###################################################
+
+def decode_battery(buf):
+    if len(buf) < BATTERY.size:
+        return {"status": None, "level": None, "last_level": None, "last_charge": None, "last_off": None}
+    fields = BATTERY.unpack_from(buf)
+    return {
+        "status": 'normal' if fields[1] == 0 else "charging",
+        "level": fields[0],
+        "last_level": fields[14],
+        "last_charge": {"date": datetime(*fields[8:14]), "day_of_week": None, "fractions256": None},
+        "last_off": {"date": datetime(*fields[2:8]), "day_of_week": None, "fractions256": None},
+    }
+
+
+def encode_battery(level, charging=False, last_off=None, last_charge=None, last_level=100):
+    last_off = last_off or datetime(2019, 1, 1, 12)
+    last_charge = last_charge or last_off
+    return BATTERY.pack(level, 1 if charging else 0,
+                        last_off.year, last_off.month, last_off.day, last_off.hour, last_off.minute,
+                        last_off.second, last_charge.year, last_charge.month, last_charge.day,
+                        last_charge.hour, last_charge.minute, last_charge.second, last_level)
+
+
+def decode_steps(buf):
+    if len(buf) >= STEPS.size:
+        steps, meters, calories = STEPS.unpack_from(buf)
+    else:
+        # older firmwares send fewer fields
+        padded = bytes(buf) + b'\x00' * (STEPS.size - len(buf))
+        steps, meters, calories = STEPS.unpack_from(padded)
+        steps = steps if len(buf) >= 5 else None
+        meters = meters if len(buf) >= 9 else None
+        calories = None
+    return {"steps": steps, "meters": meters, "callories": calories}
+
+
+def encode_steps(steps, meters=0, calories=0):
+    return b'\x0c' + STEPS.pack(steps, meters, calories)[1:]
+
+
+def decode_serial(buf):
+    return SERIAL.unpack_from(buf)[0] if len(buf) == SERIAL.size else None
+
+
+# Realtime notifications #################################################
+
+def decode_accel(buf):
+    """One raw accelerometer packet as three {'x', 'y', 'z'} samples ('wtf' is the old name of z)."""
+    x0, y0, z0, x1, y1, z1, x2, y2, z2 = ACCEL_SAMPLES.unpack_from(buf)
+    return [{'x': x0, 'y': y0, 'z': z0, 'wtf': z0},
+            {'x': x1, 'y': y1, 'z': z1, 'wtf': z1},
+            {'x': x2, 'y': y2, 'z': z2, 'wtf': z2}]
+
+
+def encode_accel(counter, samples):
+    """``samples``: three (x, y, z) tuples."""
+    return ACCEL.pack(1, counter & 0xFF, *[v for sample in samples for v in sample])
+
+
+def decode_ppg(buf):
+    return PPG_SAMPLES.unpack_from(buf)
+
+
+def encode_ppg(counter, samples):
+    return PPG.pack(2, counter & 0xFF, *samples)
+
+
+def decode_heart_measure(buf):
+    flags, bpm = HEART_MEASURE.unpack_from(buf)
+    return HEART_MEASURE_16.unpack_from(buf)[1] if flags & 0x01 else bpm
+
+
+def encode_heart_measure(bpm):
+    if bpm > 0xFF:
+        return HEART_MEASURE_16.pack(1, bpm)
+    return HEART_MEASURE.pack(0, bpm)
+
+
+# Commands ###############################################################
+
+def encode_heart_interval(minutes):
+    # 14 <minutes>, 0 switches periodic measurement off
+    return HEART_INTERVAL.pack(0x14, minutes)
+
+
+def encode_custom_alert(kind, text):
+    if isinstance(text, type(u'')):
+        text = text.encode('utf-8')
+    return CUSTOM_ALERT_TYPES[kind] + text
+
+
+def encode_encoding(encoding="en_US"):
+    return CONFIG_ENCODING.pack(b'\x06\x17\x00', encoding.encode('ascii'))
+
+
+def encode_fetch_trigger(since, tz_quarters=None):
+    if tz_quarters is None:
+        tz_quarters = local_tz_quarters()
+    return FETCH_TRIGGER.pack(1, 1, since.year, since.month, since.day, since.hour, since.minute, 0, tz_quarters)
+
+
+def encode_dfu_start(size, resource=False):
+    packet = DFU_START.pack(0x01, size & 0xFFFF, size >> 16)
+    return packet + b'\x02' if resource else packet
+
+
+def encode_dfu_checksum(crc):
+    return DFU_CHECKSUM.pack(0x04, crc)
+
+
+def encode_le_params(min_interval, max_interval, latency, timeout, advertising_interval=0):
+    return LE_PARAMS.pack(min_interval, max_interval, latency, timeout, advertising_interval)
+
+
+def decode_le_params(buf):
+    """CHARACTERISTIC_LE_PARAMS in milliseconds, None if the band answered something shorter."""
+    if len(buf) < LE_PARAMS.size:
+        return None
+    min_interval, max_interval, latency, timeout, advertising_interval = LE_PARAMS.unpack_from(buf)
+    return {"min_interval_ms": min_interval * 1.25, "max_interval_ms": max_interval * 1.25,
+            "latency": latency, "timeout_ms": timeout * 10, "advertising_interval": advertising_interval}
@@ -40,6 +40,8 @@ class UUIDS(object):
     CHARACTERISTIC_HRDW_REVISION = 0x2a27
     CHARACTERISTIC_CONFIGURATION = "00000003-0000-3512-2118-0009af100700"
     CHARACTERISTIC_DEVICEEVENT = "00000010-0000-3512-2118-0009af100700"
+    CHARACTERISTIC_FETCH = "00000004-0000-3512-2118-0009af100700"
+    CHARACTERISTIC_ACTIVITY_DATA = "00000005-0000-3512-2118-0009af100700"
 
     CHARACTERISTIC_CURRENT_TIME = BASE % '2A2B'
     CHARACTERISTIC_AGE = BASE % '2A80'
@@ -61,6 +63,7 @@ class AUTH_STATES(object):
     ENCRIPTION_KEY_FAILED = "Encryption key auth fail, sending new key"
     KEY_SENDING_FAILED = "Key sending failed"
     REQUEST_RN_ERROR = "Something went wrong when requesting the random number"
+    AUTH_TIMEOUT = "Auth timed out"
 
 
 class ALERT_TYPES(object):
@@ -78,3 +81,16 @@ class QUEUE_TYPES(object):
     HEART = 'heart'
     RAW_ACCEL = 'raw_accel'
     RAW_HEART = 'raw_heart'
+    AUTH = 'auth'
+
+
+# CHARACTERISTIC_LE_PARAMS requests: min and max connection interval (1.25 ms units), slave latency
+# (connection events the band may skip), supervision timeout (10 ms units), advertising interval.
+# realtime/bulk and background are Gadgetbridge's low and high latency settings.
+LE_PROFILES = {
+    'realtime': (39, 49, 0, 500, 0),
+    'bulk': (39, 49, 0, 500, 0),
+    'background': (460, 500, 0, 500, 0),
+    # the timeout has to outlast 2 * (1 + 4 skipped events) * 625 ms
+    'idle': (460, 500, 4, 700, 0),
+}
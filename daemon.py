@@ -0,0 +1,399 @@
+import json
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import time
+from datetime import datetime
+from Queue import Empty
+
+from bluepy.btle import BTLEException, BTLEDisconnectError
+
+from auth import MiBand3
+from constants import ALERT_TYPES, QUEUE_TYPES
+from fanout import DROP_OLDEST
+from store import STATE_DIR
+
+__all__ = ['BandDaemon', 'BandSession', 'DaemonClient', 'DaemonError', 'SOCKET_PATH']
+
+SOCKET_PATH = os.path.join(STATE_DIR, 'daemon.sock')
+
+_ALERTS = {'none': ALERT_TYPES.NONE, 'message': ALERT_TYPES.MESSAGE, 'phone': ALERT_TYPES.PHONE}
+_CUSTOM_ALERTS = {'call': 3, 'missed_call': 4, 'message': 5}
+
+
+class DaemonError(RuntimeError):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def _dumps(message):
+    return json.dumps(message, default=_json_default) + '\n'
+
+
+# Operations #############################################################
+
+# op -> fn(band, args); each runs with the session lock held
+OPS = {
+    'battery': lambda band, args: band.get_battery_info(),
+    'steps': lambda band, args: band.get_steps(),
+    'time': lambda band, args: band.get_current_time(),
+    'snapshot': lambda band, args: band.get_snapshot(refresh=args.get('refresh', False)),
+    'alert': lambda band, args: band.send_alert(_ALERTS[args.get('type', 'message')]),
+    'custom_alert': lambda band, args: band.send_custom_alert(_CUSTOM_ALERTS[args.get('type', 'message')],
+                                                              args.get('text', '')),
+}
+
+
+class BandSession(object):
+
+    """One pooled, authenticated connection to a band.
+
+    Requests run one at a time under ``lock``; the band is connected and
+    authenticated on first use. A dropped link is reconnected in place, other
+    BLE errors drop the connection until the next request. Heart rate
+    subscribers share a single realtime stream, started for the first
+    subscriber and stopped after the last one leaves.
+    """
+
+    def __init__(self, mac_address, band_factory=MiBand3, **band_kwargs):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.mac_address = mac_address
+        self.band_factory = band_factory
+        self.band_kwargs = band_kwargs
+        self.band = None
+        self.lock = threading.RLock()
+        self.connected_at = None
+        self.requests = 0
+        self._stream = None
+        # set when a stream stopped on a link error, the next stream reconnects first
+        self._link_lost = False
+        self._subscribers = []
+
+    def _connect(self):
+        if self.band is None:
+            band = self.band_factory(self.mac_address, **self.band_kwargs)
+            band.setSecurityLevel(level="medium")
+            if not band.authenticate():
+                band.disconnect()
+                raise DaemonError("%s: %s" % (self.mac_address, band.state))
+            self.band = band
+            self.connected_at = time.time()
+        return self.band
+
+    def call(self, fn, *args):
+        with self.lock:
+            self.requests += 1
+            band = self._connect()
+            try:
+                return fn(band, *args)
+            except BTLEDisconnectError:
+                # transient drop: reconnect in place, keeping the band's stream and subscribers
+                try:
+                    band.reconnect(max_attempts=3)
+                except BTLEException:
+                    self.close()
+                    raise
+                self._link_lost = False
+                return fn(band, *args)
+            except BTLEException:
+                # the next request reconnects from scratch
+                self.close()
+                raise
+
+    def close(self):
+        with self.lock:
+            self._stop_stream()
+            if self.band is not None:
+                try:
+                    self.band.disconnect()
+                except BTLEException:
+                    pass
+                self.band = None
+            self._link_lost = False
+
+    def status(self):
+        return {'mac': self.mac_address, 'connected': self.band is not None, 'connected_at': self.connected_at,
+                'requests': self.requests, 'heart_subscribers': len(self._subscribers)}
+
+    # heart rate subscriptions ###############################################
+
+    def _stop_stream(self):
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            if stream.error is not None:
+                self._link_lost = True
+            try:
+                stream.stop()
+            except BTLEException:
+                pass
+
+    @property
+    def streaming(self):
+        return self._stream is not None and self._stream.running
+
+    def subscribe(self, maxsize=64):
+        with self.lock:
+            band = self._connect()
+            # a client that stops reading only loses its own oldest values
+            sub = band.subscribe((QUEUE_TYPES.HEART,), maxsize=maxsize, policy=DROP_OLDEST, name='daemon')
+            if self._stream is None or not self._stream.running:
+                try:
+                    self._stop_stream()
+                    if self._link_lost:
+                        # the last stream died with its link: reconnect in place, keeping the subscribers
+                        band.reconnect(max_attempts=3)
+                        self._link_lost = False
+                    self._stream = band.start_raw_data_realtime()
+                except Exception:
+                    # no stream, no subscriber: the next subscribe starts it again
+                    sub.close()
+                    raise
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self.lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            if not self._subscribers:
+                self._stop_stream()
+
+
+# Server #################################################################
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.band_daemon
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self._send({'ok': False, 'error': 'bad request: %s' % e})
+                continue
+            if not isinstance(request, dict):
+                self._send({'ok': False, 'error': 'bad request: expected a JSON object'})
+                continue
+            if request.get('op') == 'subscribe_heart':
+                self._subscribe(daemon, request)
+                return
+            self._send(daemon.handle(request))
+
+    def _send(self, message):
+        self.wfile.write(_dumps(message))
+        self.wfile.flush()
+
+    def _subscribe(self, daemon, request):
+        try:
+            deadline = time.time() + float(request['seconds']) if request.get('seconds') else None
+            session = daemon.session(request['mac'])
+            sub = session.subscribe()
+            stream = session._stream
+        except Exception as e:
+            daemon._log.error("%s subscribe_heart: %s", request.get('mac'), e)
+            self._send({'id': request.get('id'), 'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)})
+            return
+        try:
+            while (deadline is None or time.time() < deadline) and session.streaming:
+                try:
+                    _, bpm = sub.get(timeout=0.5)
+                except Empty:
+                    continue
+                self._send({'id': request.get('id'), 'ok': True, 'result': bpm})
+        except socket.error:
+            # client went away
+            return
+        finally:
+            session.unsubscribe(sub)
+        # only after unsubscribing, so the session status a client asks for next is settled
+        if deadline is None or time.time() < deadline:
+            # the stream stopped under the client, that is no normal end
+            error = stream.error or DaemonError("realtime stream stopped")
+            daemon._log.error("%s subscribe_heart: %s", session.mac_address, error)
+            self._send({'id': request.get('id'), 'ok': False, 'error': '%s: %s' % (error.__class__.__name__, error)})
+        else:
+            self._send({'id': request.get('id'), 'ok': True, 'end': True})
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class BandDaemon(object):
+
+    """Serves requests for pooled band sessions over a Unix socket.
+
+    The protocol is one JSON object per line in each direction. Requests are
+    ``{"id": 1, "mac": "...", "op": "battery"}`` plus op arguments; replies
+    are ``{"id": 1, "ok": true, "result": ...}`` or ``{"ok": false, "error":
+    "..."}``. ``subscribe_heart`` keeps answering with one reply per BPM
+    until ``seconds`` pass or the client disconnects. Connections may pipeline
+    requests; requests for the same band are serialized onto its session.
+    """
+
+    def __init__(self, path=SOCKET_PATH, band_factory=MiBand3, **band_kwargs):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.band_factory = band_factory
+        self.band_kwargs = band_kwargs
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def session(self, mac_address):
+        mac_address = mac_address.upper()
+        with self._lock:
+            session = self.sessions.get(mac_address)
+            if session is None:
+                session = self.sessions[mac_address] = BandSession(mac_address, self.band_factory,
+                                                                   **self.band_kwargs)
+            return session
+
+    def handle(self, request):
+        reply = {'id': request.get('id')}
+        op = request.get('op')
+        try:
+            if op == 'ping':
+                result = 'pong'
+            elif op == 'sessions':
+                result = [session.status() for _, session in sorted(self.sessions.items())]
+            elif op == 'disconnect':
+                result = self.session(request['mac']).close()
+            elif op in OPS:
+                result = self.session(request['mac']).call(OPS[op], request.get('args') or {})
+            else:
+                raise DaemonError("unknown op %r" % op)
+        except (BTLEException, DaemonError, KeyError, ValueError) as e:
+            self._log.error("%s %s: %s", request.get('mac'), op, e)
+            reply.update(ok=False, error='%s: %s' % (e.__class__.__name__, e))
+        except Exception as e:
+            # bad arguments (wrong types) must not cost the client its reply
+            self._log.exception("%s %s failed", request.get('mac'), op)
+            reply.update(ok=False, error='%s: %s' % (e.__class__.__name__, e))
+        else:
+            reply.update(ok=True, result=result)
+        return reply
+
+    def _bind(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            # stale socket from a previous run, unless a daemon still answers on it
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise DaemonError("a daemon is already listening on " + self.path)
+            finally:
+                probe.close()
+        self._server = _Server(self.path, _Handler)
+        self._server.band_daemon = self
+        os.chmod(self.path, 0o600)
+
+    def start(self):
+        """Serve from a background thread."""
+        self._bind()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='miband-daemon')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._bind()
+        self._log.info("Listening on %s", self.path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._server is not None:
+            if self._thread is not None:
+                self._server.shutdown()
+                self._thread = None
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        for session in list(self.sessions.values()):
+            session.close()
+
+
+# Client #################################################################
+
+class DaemonClient(object):
+
+    """Blocking client for BandDaemon, one socket per client."""
+
+    def __init__(self, path=SOCKET_PATH, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rw')
+        self._ids = 0
+
+    def _request(self, op, mac=None, **args):
+        self._ids += 1
+        self._file.write(_dumps({'id': self._ids, 'mac': mac, 'op': op, 'args': args}))
+        self._file.flush()
+
+    def _reply(self):
+        line = self._file.readline()
+        if not line:
+            raise DaemonError("daemon closed the connection")
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise DaemonError(reply['error'])
+        return reply
+
+    def call(self, op, mac=None, **args):
+        self._request(op, mac, **args)
+        return self._reply().get('result')
+
+    def subscribe_heart(self, mac, seconds=None):
+        """Yield BPM values until ``seconds`` pass (or forever)."""
+        self._ids += 1
+        self._file.write(_dumps({'id': self._ids, 'mac': mac, 'op': 'subscribe_heart', 'seconds': seconds}))
+        self._file.flush()
+        while True:
+            reply = self._reply()
+            if reply.get('end'):
+                return
+            yield reply['result']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Keep authenticated Mi Band connections behind a Unix socket")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="socket path (default: %(default)s)")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)-15s %(name)s (%(levelname)s) > %(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+    BandDaemon(args.socket, debug=args.debug).serve_forever()
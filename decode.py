@@ -0,0 +1,121 @@
+import time
+from array import array
+
+import numpy as np
+
+__all__ = ['AccelRing', 'PpgRing']
+
+# 20 byte raw accelerometer notification: 2 byte header, 3 samples of x, y, z int16
+ACCEL_PACKET = np.dtype([('header', 'u1', (2,)), ('xyz', '<i2', (3, 3))])
+# 16 byte raw PPG notification: 2 byte header, 7 uint16 samples
+PPG_PACKET = np.dtype([('header', 'u1', (2,)), ('ppg', '<u2', (7,))])
+
+
+class _SampleRing(object):
+
+    """Preallocated columnar ring buffer fed with raw notification payloads.
+
+    ``append`` only copies the payload bytes, ``flush`` decodes everything
+    appended since the last flush with one ``np.frombuffer`` call, stores the
+    samples in the ring and returns the new batch as a dict of columns.
+    Subclasses set the dtypes and ``samples_per_packet`` and define
+    ``_decode(packets, out)``.
+    """
+
+    packet_dtype = None
+    sample_dtype = None
+    samples_per_packet = None
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.ring = np.zeros(capacity, dtype=self.sample_dtype)
+        self.count = 0
+        self._pending = bytearray()
+        self._pending_ts = array('d')
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, data, timestamp=None):
+        if len(data) != self.packet_dtype.itemsize:
+            return False
+        self._pending += data
+        self._pending_ts.append(time.time() if timestamp is None else timestamp)
+        return True
+
+    def flush(self):
+        if not self._pending_ts:
+            return None
+        packets = np.frombuffer(bytes(self._pending), dtype=self.packet_dtype)
+        batch = self.decode(packets, np.frombuffer(self._pending_ts, dtype='<f8'))
+        del self._pending[:]
+        self._pending_ts = array('d')
+        self._store(batch)
+        return self.columns(batch)
+
+    def decode(self, packets, timestamps):
+        """Samples of a ``packet_dtype`` array, one timestamp per packet; the ring is left alone."""
+        batch = np.empty(len(packets) * self.samples_per_packet, dtype=self.sample_dtype)
+        batch['t'] = np.repeat(timestamps, self.samples_per_packet)
+        self._decode(packets, batch)
+        return batch
+
+    def _store(self, batch):
+        n = len(batch)
+        if n >= self.capacity:
+            batch = batch[-self.capacity:]
+            n = self.capacity
+        start = self.count % self.capacity
+        first = min(n, self.capacity - start)
+        self.ring[start:start + first] = batch[:first]
+        self.ring[:n - first] = batch[first:]
+        self.count += len(batch)
+
+    def latest(self, n=None):
+        """Most recent ``n`` samples in order, as columns (views unless the ring wrapped)."""
+        size = len(self)
+        n = size if n is None else min(n, size)
+        end = self.count % self.capacity or (self.capacity if self.count else 0)
+        if n <= end:
+            return self.columns(self.ring[end - n:end])
+        return self.columns(np.concatenate((self.ring[self.capacity - (n - end):], self.ring[:end])))
+
+    def columns(self, samples):
+        return dict((name, samples[name]) for name in samples.dtype.names)
+
+
+class AccelRing(_SampleRing):
+
+    packet_dtype = ACCEL_PACKET
+    sample_dtype = np.dtype([('t', '<f8'), ('x', '<i2'), ('y', '<i2'), ('z', '<i2')])
+    samples_per_packet = 3
+
+    def _decode(self, packets, out):
+        xyz = packets['xyz'].reshape(-1, 3)
+        out['x'] = xyz[:, 0]
+        out['y'] = xyz[:, 1]
+        out['z'] = xyz[:, 2]
+
+    @staticmethod
+    def legacy(columns):
+        # old accel_raw_callback payload: one list of three {'x', 'y', 'z'} dicts per packet
+        x, y, z = columns['x'].tolist(), columns['y'].tolist(), columns['z'].tolist()
+        for i in range(0, len(x), 3):
+            yield [{'x': x[j], 'y': y[j], 'z': z[j], 'wtf': z[j]} for j in range(i, i + 3)]
+
+
+class PpgRing(_SampleRing):
+
+    packet_dtype = PPG_PACKET
+    sample_dtype = np.dtype([('t', '<f8'), ('ppg', '<u2')])
+    samples_per_packet = 7
+
+    def _decode(self, packets, out):
+        out['ppg'] = packets['ppg'].ravel()
+
+    @staticmethod
+    def legacy(columns):
+        # old heart_raw_callback payload: one 7-tuple per packet
+        ppg = columns['ppg'].tolist()
+        for i in range(0, len(ppg), 7):
+            yield tuple(ppg[i:i + 7])
@@ -0,0 +1,96 @@
+import logging
+import time
+
+from bluepy.btle import BTLEException
+
+__all__ = ['DfuTransfer', 'negotiate_chunk_size']
+
+ATT_HEADER_SIZE = 3
+DEFAULT_CHUNK_SIZE = 20
+# the band acknowledges a sync command after every N data packets
+SYNC_EVERY = 100
+
+
+def negotiate_chunk_size(peripheral, mtu=247):
+    """Request a larger ATT MTU and return the usable payload per write."""
+    try:
+        resp = peripheral.setMTU(mtu)
+    except (BTLEException, AttributeError):
+        return DEFAULT_CHUNK_SIZE
+    if isinstance(resp, dict) and resp.get('mtu'):
+        mtu = resp['mtu'][0]
+    return max(DEFAULT_CHUNK_SIZE, mtu - ATT_HEADER_SIZE)
+
+
+class DfuTransfer(object):
+
+    """Streams a firmware image to CHARACTERISTIC_DFU_FIRMWARE_WRITE.
+
+    Data packets are sent as write-without-response and every ``sync_every``
+    packets a sync command is written with response on the control
+    characteristic. A sync only means the write went through, the band does
+    not acknowledge the bytes before it, so a failed transfer is never
+    resumed: ``restart()`` is called to reconnect and send the DFU start
+    commands again, returning the new ``(char_ctrl, char_data)``, and the
+    image is sent again from offset 0. Without ``restart`` the error is
+    raised. ``retries`` counts the restarts of the last ``send``.
+    """
+
+    def __init__(self, char_ctrl, char_data, chunk_size=DEFAULT_CHUNK_SIZE,
+                 sync_every=SYNC_EVERY, progress_callback=None, max_retries=3, restart=None):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.char_ctrl = char_ctrl
+        self.char_data = char_data
+        self.chunk_size = chunk_size
+        self.sync_every = sync_every
+        self.progress_callback = progress_callback
+        self.max_retries = max_retries
+        self.restart = restart
+        self.confirmed_offset = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.elapsed = 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.confirmed_offset / self.elapsed if self.elapsed else 0.0
+
+    def _sync(self, offset):
+        self.char_ctrl.write(b'\x00', withResponse=True)
+        self.confirmed_offset = offset
+
+    def _send(self, data, started):
+        total = len(data)
+        offset = 0
+        packets = 0
+        while offset < total:
+            end = min(offset + self.chunk_size, total)
+            self.char_data.write(data[offset:end])
+            self.bytes_sent += end - offset
+            offset = end
+            packets += 1
+            if packets % self.sync_every == 0 or offset == total:
+                self._sync(offset)
+                self.elapsed = time.time() - started
+                if self.progress_callback:
+                    self.progress_callback(offset, total, self.bytes_per_sec)
+
+    def send(self, data):
+        """Send ``data``, restarting the whole transfer after a failure (at most ``max_retries`` times)."""
+        self.retries = 0
+        started = time.time()
+        restart = False
+        while True:
+            try:
+                if restart:
+                    self.char_ctrl, self.char_data = self.restart()
+                self.confirmed_offset = 0
+                self._send(data, started)
+                return self.confirmed_offset
+            except BTLEException as e:
+                if self.restart is None or self.retries >= self.max_retries:
+                    raise
+                self.retries += 1
+                restart = True
+                self._log.warning("DFU transfer failed at %d of %d (%s), restarting it (%d/%d)",
+                                  self.confirmed_offset, len(data), e, self.retries, self.max_retries)
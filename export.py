@@ -0,0 +1,367 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import codec
+from constants import QUEUE_TYPES
+
+__all__ = ['ColumnExporter', 'ColumnStore', 'SCHEMAS', 'AGGREGATIONS']
+
+try:
+    import pyarrow
+    import pyarrow.parquet as _parquet
+except ImportError:
+    pyarrow = _parquet = None
+
+# one table per kind of data; every table has 't', epoch seconds
+SCHEMAS = {
+    QUEUE_TYPES.HEART: np.dtype([('t', '<f8'), ('bpm', '<u2')]),
+    QUEUE_TYPES.RAW_HEART: np.dtype([('t', '<f8'), ('ppg', '<u2')]),
+    QUEUE_TYPES.RAW_ACCEL: np.dtype([('t', '<f8'), ('x', '<i2'), ('y', '<i2'), ('z', '<i2')]),
+    'battery': np.dtype([('t', '<f8'), ('level', 'u1'), ('charging', 'u1')]),
+    'steps': np.dtype([('t', '<f8'), ('steps', '<u4'), ('meters', '<u4'), ('calories', '<u4')]),
+    'activity': np.dtype([('t', '<f8'), ('kind', 'u1'), ('intensity', 'u1'), ('steps', 'u1'),
+                          ('heart_rate', 'u1')]),
+}
+AGGREGATIONS = ('mean', 'sum', 'count', 'min', 'max')
+DAY = 86400
+CHUNK_ROWS = 1 << 16
+
+
+def _band_dir(mac_address):
+    # colons are not portable in paths
+    return 'band=' + mac_address.upper().replace(':', '-')
+
+
+def _day_dir(day):
+    return 'date=' + datetime.utcfromtimestamp(day * DAY).strftime('%Y-%m-%d')
+
+
+def _parse_day(name):
+    return int((datetime.strptime(name[5:], '%Y-%m-%d') - datetime(1970, 1, 1)).total_seconds()) // DAY
+
+
+# Export #################################################################
+
+class ColumnExporter(object):
+
+    """Writes band data as columns, partitioned by table, band and UTC day.
+
+    ``root/<table>/band=AA-BB-../date=2019-05-01/`` holds one part per chunk
+    of up to ``chunk_rows`` rows: a Parquet file when pyarrow is installed
+    (or ``format='parquet'``), otherwise a directory with one ``.npy`` file
+    per column. Rows are buffered per partition and written as soon as a
+    chunk is full, a band's stream moves on to the next day, or more than
+    ``max_buffered_rows`` are held (then the fullest partition goes first),
+    so memory stays bounded however long the export runs. Parts are renamed
+    into place once complete; readers never see half of one.
+    """
+
+    def __init__(self, root, format=None, chunk_rows=CHUNK_ROWS, max_buffered_rows=4 * CHUNK_ROWS):
+        if format is None:
+            format = 'parquet' if _parquet is not None else 'npy'
+        if format not in ('parquet', 'npy'):
+            raise ValueError("unknown format %r" % format)
+        if format == 'parquet' and _parquet is None:
+            raise ImportError("pyarrow is needed for Parquet export")
+        self.root = root
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self.max_buffered_rows = max_buffered_rows
+        self.rows_written = 0
+        self.parts_written = 0
+        # most rows held in memory at once
+        self.max_buffered = 0
+        # (table, band, day) -> [record arrays], rows
+        self._buffers = {}
+        self._rows = {}
+        self._buffered = 0
+        # (table, band) -> latest day written
+        self._days = {}
+        self._next_part = {}
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def write(self, mac_address, table, columns):
+        """Append rows; ``columns`` maps the table's column names to equal-length arrays (or is a record array)."""
+        dtype = SCHEMAS[table]
+        n = len(columns['t'])
+        if not n:
+            return
+        rows = np.empty(n, dtype=dtype)
+        for name in dtype.names:
+            rows[name] = columns[name]
+        days = (rows['t'] // DAY).astype(np.int64)
+        with self._lock:
+            if (days == days[0]).all():
+                self._append((table, mac_address.upper(), int(days[0])), rows)
+            else:
+                for day in np.unique(days):
+                    self._append((table, mac_address.upper(), int(day)), rows[days == day])
+
+    def _append(self, key, rows):
+        table, mac_address, day = key
+        latest = self._days.get((table, mac_address))
+        if latest is None or day > latest:
+            self._days[(table, mac_address)] = day
+            if latest is not None:
+                # streams are mostly in time order, the previous day is complete
+                self._flush_partition((table, mac_address, latest))
+        self._buffers.setdefault(key, []).append(rows)
+        self._rows[key] = self._rows.get(key, 0) + len(rows)
+        self._buffered += len(rows)
+        if self._rows[key] >= self.chunk_rows:
+            self._flush_partition(key)
+        while self._buffered > self.max_buffered_rows:
+            self._flush_partition(max(self._rows, key=self._rows.get))
+
+    def _flush_partition(self, key):
+        chunks = self._buffers.pop(key, None)
+        self._rows.pop(key, None)
+        if not chunks:
+            return
+        rows = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        self._buffered -= len(rows)
+        table, mac_address, day = key
+        directory = os.path.join(self.root, table, _band_dir(mac_address), _day_dir(day))
+        for start in range(0, len(rows), self.chunk_rows):
+            self._write_part(directory, rows[start:start + self.chunk_rows])
+
+    def _write_part(self, directory, rows):
+        number = self._next_part.get(directory)
+        if number is None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # appending to an existing export continues its numbering
+            number = len([name for name in os.listdir(directory) if name.startswith('part-')])
+        self._next_part[directory] = number + 1
+        path = os.path.join(directory, 'part-%05d' % number)
+        if self.format == 'parquet':
+            tmp = path + '.parquet.tmp'
+            arrays = [pyarrow.array(rows[name]) for name in rows.dtype.names]
+            _parquet.write_table(pyarrow.Table.from_arrays(arrays, names=list(rows.dtype.names)), tmp)
+            os.rename(tmp, path + '.parquet')
+        else:
+            tmp = path + '.tmp'
+            os.mkdir(tmp)
+            for name in rows.dtype.names:
+                np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(rows[name]))
+            os.rename(tmp, path)
+        self.rows_written += len(rows)
+        self.parts_written += 1
+        self.max_buffered = max(self.max_buffered, self._buffered + len(rows))
+
+    def flush(self):
+        with self._lock:
+            for key in list(self._buffers):
+                self._flush_partition(key)
+
+    # sources ################################################################
+
+    def attach(self, band, types=(QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_HEART, QUEUE_TYPES.RAW_ACCEL),
+               maxsize=4096):
+        """Export a band's realtime samples from a fanout subscriber, off the BLE pump."""
+        mac_address = band.mac_address
+
+        def export(_type, value):
+            if _type == QUEUE_TYPES.HEART:
+                self.write(mac_address, _type, {'t': [time.time()], 'bpm': [value]})
+            else:
+                self.write(mac_address, _type, value)
+        sub = band.subscribe(types, callback=export, maxsize=maxsize, name='export')
+        self._subscriptions.append(sub)
+        return sub
+
+    def poll_callback(self, mac_address):
+        """A ``callback`` for ``MiBand3.schedule_polls`` that exports battery and steps readings."""
+        def on_poll(name, value):
+            now = [time.time()]
+            if name == 'battery' and value['level'] is not None:
+                self.write(mac_address, 'battery', {'t': now, 'level': [value['level']],
+                                                    'charging': [value['status'] == 'charging']})
+            elif name == 'steps' and value['steps'] is not None:
+                # older firmwares do not report meters and calories: stored as 0
+                self.write(mac_address, 'steps', {'t': now, 'steps': [value['steps']],
+                                                  'meters': [value['meters'] or 0],
+                                                  'calories': [value['callories'] or 0]})
+        return on_poll
+
+    def write_activity(self, mac_address, records):
+        """Export ``MiBand3.sync_activity`` records."""
+        self.write(mac_address, 'activity', records)
+
+    def write_recording(self, path, mac_address, start=None, end=None, chunk_records=CHUNK_ROWS):
+        """Convert a recorder.Recorder file, ``chunk_records`` packets at a time."""
+        from decode import AccelRing, PpgRing
+        from recorder import RecordingReader
+        reader = RecordingReader(path)
+        rings = {QUEUE_TYPES.RAW_HEART: PpgRing(), QUEUE_TYPES.RAW_ACCEL: AccelRing()}
+        heart_t, heart_bpm = [], []
+
+        def drain():
+            if heart_t:
+                self.write(mac_address, QUEUE_TYPES.HEART, {'t': heart_t, 'bpm': heart_bpm})
+                del heart_t[:], heart_bpm[:]
+            for _type, ring in rings.items():
+                columns = ring.flush()
+                if columns is not None:
+                    self.write(mac_address, _type, columns)
+        try:
+            for n, (ts, _type, payload) in enumerate(reader.query(start, end), 1):
+                if _type == QUEUE_TYPES.HEART:
+                    heart_t.append(ts)
+                    heart_bpm.append(codec.decode_heart_measure(payload))
+                else:
+                    rings[_type].append(payload, ts)
+                if n % chunk_records == 0:
+                    drain()
+            drain()
+        finally:
+            reader.close()
+
+    def close(self):
+        for sub in self._subscriptions:
+            sub.close()
+        self._subscriptions = []
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Query ##################################################################
+
+class ColumnStore(object):
+
+    """Reads a ColumnExporter directory.
+
+    Queries pick partitions by their ``band=``/``date=`` directory names and
+    load only the requested columns (plus ``t``) of the parts inside them;
+    ``scan`` yields one part at a time, so aggregations run in the memory of
+    one part.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def tables(self):
+        return sorted(name for name in os.listdir(self.root) if name in SCHEMAS) if os.path.isdir(self.root) else []
+
+    def bands(self, table):
+        directory = os.path.join(self.root, table)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[5:].replace('-', ':') for name in os.listdir(directory) if name.startswith('band='))
+
+    def parts(self, table, start=None, end=None, bands=None):
+        """``(mac address, part path)`` of every part that may hold rows in [start, end)."""
+        first = int(start // DAY) if start is not None else None
+        # end is exclusive, midnight belongs to the day before
+        last = int(-(-end // DAY)) - 1 if end is not None else None
+        for mac_address in (self.bands(table) if bands is None else [mac.upper() for mac in bands]):
+            band_dir = os.path.join(self.root, table, _band_dir(mac_address))
+            if not os.path.isdir(band_dir):
+                continue
+            for day_name in sorted(os.listdir(band_dir)):
+                day = _parse_day(day_name)
+                if (first is not None and day < first) or (last is not None and day > last):
+                    continue
+                day_dir = os.path.join(band_dir, day_name)
+                for part in sorted(os.listdir(day_dir)):
+                    if part.startswith('part-') and not part.endswith('.tmp'):
+                        yield mac_address, os.path.join(day_dir, part)
+
+    def _read_part(self, path, columns):
+        if path.endswith('.parquet'):
+            if _parquet is None:
+                raise ImportError("pyarrow is needed to read " + path)
+            table = _parquet.read_table(path, columns=columns)
+            return dict((name, table.column(name).to_numpy()) for name in columns)
+        return dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in columns)
+
+    def scan(self, table, columns=None, start=None, end=None, bands=None):
+        """Yield ``(mac address, {column: array})`` per part, rows limited to start <= t < end."""
+        columns = list(columns or SCHEMAS[table].names)
+        wanted = columns if 't' in columns else ['t'] + columns
+        for mac_address, path in self.parts(table, start, end, bands):
+            data = self._read_part(path, wanted)
+            t = data['t']
+            if start is not None or end is not None:
+                mask = np.ones(len(t), dtype=bool)
+                if start is not None:
+                    mask &= t >= start
+                if end is not None:
+                    mask &= t < end
+                if not mask.any():
+                    continue
+                data = dict((name, np.asarray(data[name])[mask]) for name in wanted)
+            yield mac_address, dict((name, np.asarray(data[name])) for name in wanted)
+
+    def query(self, table, columns=None, start=None, end=None, bands=None):
+        """Matching rows as one dict of arrays, with a ``band`` column, sorted by band and time."""
+        columns = list(columns or SCHEMAS[table].names)
+        names = columns if 't' in columns else ['t'] + columns
+        dtype = SCHEMAS[table]
+        parts, macs = [], []
+        for mac_address, data in self.scan(table, columns, start, end, bands):
+            parts.append(data)
+            macs.append(np.repeat(np.array([mac_address]), len(data['t'])))
+        if not parts:
+            res = dict((name, np.empty(0, dtype=dtype[name])) for name in names)
+            res['band'] = np.empty(0, dtype='S17')
+            return res
+        res = dict((name, np.concatenate([part[name] for part in parts])) for name in names)
+        res['band'] = np.concatenate(macs)
+        order = np.lexsort((res['t'], res['band']))
+        return dict((name, values[order]) for name, values in res.items())
+
+    def aggregate(self, table, column, every=60, how='mean', start=None, end=None, bands=None):
+        """Aggregate ``column`` per band over ``every`` second buckets, e.g. per-minute mean BPM.
+
+        Returns ``{'band', 't' (bucket start), column, 'count'}`` arrays sorted by band and time.
+        """
+        if how not in AGGREGATIONS:
+            raise ValueError("unknown aggregation %r" % how)
+        # (band, bucket) -> [sum, count, min, max]
+        acc = {}
+        for mac_address, data in self.scan(table, [column], start, end, bands):
+            buckets = (data['t'] // every).astype(np.int64)
+            keys, inverse = np.unique(buckets, return_inverse=True)
+            values = data[column].astype(np.float64)
+            sums = np.bincount(inverse, weights=values, minlength=len(keys))
+            counts = np.bincount(inverse, minlength=len(keys))
+            mins = np.full(len(keys), np.inf)
+            maxs = np.full(len(keys), -np.inf)
+            np.minimum.at(mins, inverse, values)
+            np.maximum.at(maxs, inverse, values)
+            for key, s, c, lo, hi in zip(keys.tolist(), sums.tolist(), counts.tolist(), mins.tolist(), maxs.tolist()):
+                entry = acc.get((mac_address, key))
+                if entry is None:
+                    acc[(mac_address, key)] = [s, c, lo, hi]
+                else:
+                    entry[0] += s
+                    entry[1] += c
+                    entry[2] = min(entry[2], lo)
+                    entry[3] = max(entry[3], hi)
+        items = sorted(acc.items())
+        sums = np.array([entry[0] for _, entry in items], dtype=np.float64)
+        counts = np.array([entry[1] for _, entry in items], dtype=np.int64)
+        if how == 'mean':
+            values = sums / np.maximum(counts, 1)
+        elif how == 'sum':
+            values = sums
+        elif how == 'count':
+            values = counts
+        elif how == 'min':
+            values = np.array([entry[2] for _, entry in items], dtype=np.float64)
+        else:
+            values = np.array([entry[3] for _, entry in items], dtype=np.float64)
+        return {'band': np.array([mac for (mac, _), _ in items], dtype='S17'),
+                't': np.array([bucket * every for (_, bucket), _ in items], dtype=np.float64),
+                column: values, 'count': counts}
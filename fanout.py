@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Empty
+
+__all__ = ['FanOut', 'Subscription', 'POLICIES', 'DROP_OLDEST', 'DROP_NEWEST', 'BLOCK', 'SAMPLE']
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+SAMPLE = 'sample'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, SAMPLE)
+
+
+class Subscription(object):
+
+    """One subscriber's bounded buffer of ``(type, value)`` items.
+
+    When the buffer is full the ``policy`` decides: ``drop_oldest`` evicts the
+    oldest item, ``drop_newest`` discards the new one, ``sample`` admits one
+    new item in ``sample_every`` (evicting the oldest) and discards the rest,
+    ``block`` makes the publisher wait up to ``block_timeout`` seconds for
+    room before discarding. Only ``block`` can slow the BLE pump down.
+    """
+
+    def __init__(self, hub, types, maxsize=1024, policy=DROP_OLDEST, sample_every=4, block_timeout=0.1,
+                 name=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown overflow policy %r" % policy)
+        self.hub = hub
+        self.types = frozenset(types)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_every = sample_every
+        self.block_timeout = block_timeout
+        self.name = name
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_lag = 0
+        self.closed = False
+        # (published at, type, value)
+        self._items = deque()
+        self._overflow = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def _offer(self, _type, value):
+        with self._cond:
+            self.published += 1
+            items = self._items
+            if len(items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if self.policy == SAMPLE:
+                    self._overflow += 1
+                    if self._overflow % self.sample_every:
+                        self.dropped += 1
+                        return
+                if self.policy == BLOCK:
+                    deadline = time.time() + self.block_timeout
+                    while len(items) >= self.maxsize and not self.closed:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if len(items) >= self.maxsize:
+                        self.dropped += 1
+                        return
+                else:
+                    items.popleft()
+                    self.dropped += 1
+            else:
+                self._overflow = 0
+            items.append((time.time(), _type, value))
+            if len(items) > self.max_lag:
+                self.max_lag = len(items)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Next ``(type, value)``; raises Queue.Empty after ``timeout`` seconds or once closed and drained."""
+        with self._cond:
+            if not self._items and not self.closed:
+                if timeout is None:
+                    while not self._items and not self.closed:
+                        self._cond.wait()
+                else:
+                    self._cond.wait(timeout)
+            if not self._items:
+                raise Empty
+            _, _type, value = self._items.popleft()
+            self.delivered += 1
+            self._cond.notify_all()
+            return _type, value
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except Empty:
+                if self.closed:
+                    return
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def lag(self):
+        """Items published to this subscriber and not consumed yet."""
+        return len(self._items)
+
+    @property
+    def lag_seconds(self):
+        """Age of the oldest unconsumed item."""
+        items = self._items
+        try:
+            return time.time() - items[0][0]
+        except IndexError:
+            return 0.0
+
+    def stats(self):
+        return {'name': self.name, 'policy': self.policy, 'published': self.published,
+                'delivered': self.delivered, 'dropped': self.dropped, 'lag': self.lag,
+                'lag_seconds': self.lag_seconds, 'max_lag': self.max_lag}
+
+    def close(self):
+        self.hub.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, callback):
+        log = logging.getLogger(self.__class__.__name__)
+        for _type, value in self:
+            try:
+                callback(_type, value)
+            except Exception:
+                log.exception("subscriber %s failed", self.name)
+
+
+class FanOut(object):
+
+    """Publishes a band's realtime samples to any number of subscribers.
+
+    ``publish`` runs in the BLE pump: it only appends to each interested
+    subscriber's buffer, so a slow consumer costs the pump nothing unless it
+    chose the ``block`` policy. Heart rate arrives as BPM values, raw PPG and
+    accelerometer data as the column batches ``_parse_queue`` builds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # copied on (un)subscribe, so publish iterates without the lock
+        self._subscribers = ()
+
+    def subscribe(self, types, callback=None, **kwargs):
+        """Add a subscriber for ``types``; with ``callback(type, value)`` it is drained by its own thread."""
+        sub = Subscription(self, types, **kwargs)
+        with self._lock:
+            self._subscribers += (sub,)
+        if callback is not None:
+            sub._thread = threading.Thread(target=sub._run, args=(callback,),
+                                           name='miband-sub-%s' % (sub.name or id(sub)))
+            sub._thread.daemon = True
+            sub._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def wants(self, _type):
+        return any(_type in sub.types for sub in self._subscribers)
+
+    def publish(self, _type, value):
+        for sub in self._subscribers:
+            if _type in sub.types:
+                sub._offer(_type, value)
+
+    def stats(self):
+        return [sub.stats() for sub in self._subscribers]
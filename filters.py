@@ -0,0 +1,20 @@
+import numpy as np
+
+__all__ = ['MovingAverage']
+
+
+class MovingAverage(object):
+
+    """Trailing moving average of a stream fed in chunks, keeps the last ``n - 1`` inputs."""
+
+    def __init__(self, n):
+        self.n = n
+        self._tail = None
+
+    def __call__(self, x):
+        if self._tail is None:
+            self._tail = np.repeat(x[:1], self.n - 1)
+        ext = np.concatenate((self._tail, x))
+        cs = np.concatenate(([0.0], np.cumsum(ext)))
+        self._tail = ext[len(ext) - (self.n - 1):]
+        return (cs[self.n:] - cs[:-self.n]) / self.n
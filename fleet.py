@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from auth import MiBand3
+
+__all__ = ['FleetManager', 'FleetStats']
+
+DEFAULT_POLLS = ('get_battery_info', 'get_steps', 'get_current_time')
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class FleetStats(object):
+
+    """Latency samples and success/failure counts per operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+
+    def record(self, op, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(op, []).append(seconds)
+            else:
+                self.failures[op] = self.failures.get(op, 0) + 1
+
+    def summary(self):
+        res = {}
+        for op in set(self.latencies) | set(self.failures):
+            values = self.latencies.get(op, [])
+            res[op] = {
+                'ok': len(values),
+                'failed': self.failures.get(op, 0),
+                'p50': _percentile(values, 50),
+                'p95': _percentile(values, 95),
+                'p99': _percentile(values, 99),
+                'max': max(values) if values else None,
+            }
+        return res
+
+
+class FleetManager(object):
+
+    """Connects, authenticates and polls many bands concurrently.
+
+    At most ``per_adapter`` bands talk to each HCI adapter at a time. A band
+    that fails is logged and skipped, it is reconnected on the next sweep.
+    """
+
+    def __init__(self, mac_addresses, adapters=(None,), per_adapter=4, band_factory=MiBand3, **band_kwargs):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.mac_addresses = list(mac_addresses)
+        self.adapters = list(adapters)
+        self.band_factory = band_factory
+        self.band_kwargs = band_kwargs
+        self.bands = {}
+        self.errors = {}
+        self.stats = FleetStats()
+        self._iface = dict((mac, self.adapters[i % len(self.adapters)])
+                           for i, mac in enumerate(self.mac_addresses))
+        self._slots = dict((iface, threading.Semaphore(per_adapter)) for iface in self.adapters)
+
+    def _timed(self, op, fn, *args, **kwargs):
+        t = time.time()
+        try:
+            res = fn(*args, **kwargs)
+        except Exception:
+            self.stats.record(op, time.time() - t, ok=False)
+            raise
+        self.stats.record(op, time.time() - t)
+        return res
+
+    def _each(self, fn, macs):
+        """Run ``fn(mac)`` for every band in its own thread, bounded per adapter."""
+        results = {}
+
+        def worker(mac):
+            with self._slots[self._iface[mac]]:
+                try:
+                    results[mac] = fn(mac)
+                    self.errors.pop(mac, None)
+                except Exception as e:
+                    self._log.error("%s: %s", mac, e)
+                    self.errors[mac] = e
+                    self._drop(mac)
+
+        threads = [threading.Thread(target=worker, args=(mac,)) for mac in macs]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _drop(self, mac):
+        band = self.bands.pop(mac, None)
+        if band is not None:
+            try:
+                band.disconnect()
+            except Exception:
+                pass
+
+    def _connect(self, mac):
+        band = self._timed('connect', self.band_factory, mac, iface=self._iface[mac], **self.band_kwargs)
+        band.setSecurityLevel(level="medium")
+        if not self._timed('auth', band.authenticate):
+            band.disconnect()
+            raise RuntimeError(band.state)
+        self.bands[mac] = band
+        return band
+
+    def connect_all(self):
+        missing = [mac for mac in self.mac_addresses if mac not in self.bands]
+        return self._each(self._connect, missing)
+
+    def poll(self, polls=DEFAULT_POLLS):
+        """One sweep: reconnect missing bands, then read ``polls`` from every band."""
+        self.connect_all()
+
+        def read(mac):
+            band = self.bands[mac]
+            return dict((op, self._timed(op, getattr(band, op))) for op in polls)
+        return self._each(read, list(self.bands))
+
+    def run(self, interval=60.0, sweeps=None, callback=None, polls=DEFAULT_POLLS):
+        done = 0
+        while sweeps is None or done < sweeps:
+            started = time.time()
+            results = self.poll(polls)
+            if callback:
+                callback(results)
+            done += 1
+            if sweeps is None or done < sweeps:
+                time.sleep(max(0.0, interval - (time.time() - started)))
+
+    def disconnect_all(self):
+        for mac in list(self.bands):
+            self._drop(mac)
+
+
+if __name__ == '__main__':
+    import sys
+
+    def report(results):
+        for mac, values in sorted(results.items()):
+            print(mac, values)
+        for mac, error in sorted(fleet.errors.items()):
+            print(mac, "FAILED", error)
+        print(fleet.stats.summary())
+
+    # usage: fleet.py macs.txt [interval]  (one MAC address per line)
+    with open(sys.argv[1]) as f:
+        macs = [line.strip() for line in f if line.strip()]
+    fleet = FleetManager(macs)
+    fleet.run(interval=float(sys.argv[2]) if len(sys.argv) > 2 else 60.0, callback=report)
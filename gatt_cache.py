@@ -0,0 +1,184 @@
+import os
+import logging
+import time
+
+from bluepy.btle import UUID
+
+from constants import UUIDS
+from store import JsonStore, STATE_DIR
+
+__all__ = ['HandleCache', 'ReadCache', 'CachedCharacteristic', 'CachedDescriptor', 'discover_handles']
+
+DEFAULT_CACHE_PATH = os.path.join(STATE_DIR, 'gatt_cache.json')
+# seconds a read value stays valid, None: until the firmware changes
+DEFAULT_TTLS = {
+    'CHARACTERISTIC_REVISION': None,
+    'CHARACTERISTIC_HRDW_REVISION': None,
+    'CHARACTERISTIC_SERIAL': None,
+    'CHARACTERISTIC_BATTERY': 300.0,
+    'CHARACTERISTIC_STEPS': 30.0,
+    'CHARACTERISTIC_CURRENT_TIME': 3600.0,
+}
+
+
+def _uuid_names(prefix):
+    names = {}
+    for name, value in sorted(vars(UUIDS).items()):
+        if name.startswith(prefix) and value != "":
+            names.setdefault(UUID(value), name)
+    return names
+
+
+def discover_handles(peripheral):
+    """Map every characteristic in UUIDS to its value and notification descriptor handles.
+
+    Three GATT round trips for the whole table: services, characteristics, descriptors.
+    """
+    char_names = _uuid_names('CHARACTERISTIC_')
+    known_services = _uuid_names('SERVICE_')
+    services = sorted(peripheral.discoverServices().values(), key=lambda s: s.hndStart)
+    chars = sorted(peripheral.getCharacteristics(), key=lambda c: c.valHandle)
+
+    def in_known_service(char):
+        for svc in services:
+            if svc.hndStart <= char.handle <= svc.hndEnd:
+                return svc.uuid in known_services
+        return False
+
+    handles = {}
+    owners = {}
+    for char in chars:
+        name = char_names.get(char.uuid)
+        if name is None:
+            continue
+        # the same UUID may show up in several services, prefer the one we know about
+        if name not in handles or (in_known_service(char) and not in_known_service(owners[name])):
+            handles[name] = char.valHandle
+            owners[name] = char
+
+    descriptors = {}
+    char_by_handle = dict((c.valHandle, c) for c in chars)
+    value_handles = sorted(char_by_handle)
+    for desc in peripheral.getDescriptors():
+        if desc.uuid != UUIDS.NOTIFICATION_DESCRIPTOR:
+            continue
+        owner = None
+        for hnd in value_handles:
+            if hnd >= desc.handle:
+                break
+            owner = char_by_handle[hnd]
+        name = char_names.get(owner.uuid) if owner else None
+        if name and owners.get(name) is owner:
+            descriptors[name] = desc.handle
+
+    return {'chars': handles, 'descs': descriptors}
+
+
+class HandleCache(JsonStore):
+
+    """Per MAC address GATT handle table, persisted as JSON and keyed by firmware revision.
+
+    Bands without an explicit cache use ``HandleCache.shared()``, one cache
+    per file for the whole process.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        JsonStore.__init__(self, path)
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def shared(cls, path=DEFAULT_CACHE_PATH):
+        return super(HandleCache, cls).shared(path)
+
+    def store(self, mac_address, revision, handles):
+        self.set(mac_address, {'revision': revision, 'handles': handles})
+
+    def store_info(self, mac_address, name, value):
+        """Remember a value that only changes with the firmware next to the handles."""
+        with self._lock:
+            entry = self.get(mac_address)
+            if entry is not None:
+                entry.setdefault('info', {})[name] = value
+                self.set(mac_address, entry)
+
+    def invalidate(self, mac_address):
+        if self.pop(mac_address) is not None:
+            self._log.info("Invalidated handle cache for " + mac_address)
+
+
+class ReadCache(object):
+
+    """Characteristic values read from one band, each valid for its TTL in ``ttls``.
+
+    Names without a TTL are never cached, a TTL of None means the value is
+    permanent. ``hits`` and ``misses`` count lookups.
+    """
+
+    def __init__(self, ttls=None, clock=time.time):
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+
+    def is_permanent(self, name):
+        return name in self.ttls and self.ttls[name] is None
+
+    def lookup(self, name):
+        """``(value, read_at)`` if a fresh value is cached, else None."""
+        entry = self._values.get(name)
+        if entry is not None:
+            ttl = self.ttls.get(name, 0)
+            if ttl is None or self.clock() - entry[1] < ttl:
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, name, value, read_at=None):
+        entry = (value, self.clock() if read_at is None else read_at)
+        if name in self.ttls:
+            self._values[name] = entry
+        return entry
+
+    def invalidate(self, name=None):
+        if name is None:
+            self._values.clear()
+        else:
+            self._values.pop(name, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else None}
+
+
+class CachedCharacteristic(object):
+
+    """Minimal bluepy Characteristic look-alike backed by a cached handle."""
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+
+    def getHandle(self):
+        return self.device._handle(self.name)
+
+    def read(self):
+        return self.device._read(self.name)
+
+    def write(self, val, withResponse=False):
+        return self.device._write(self.name, val, withResponse)
+
+
+class CachedDescriptor(object):
+
+    """Notification descriptor of a cached characteristic."""
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+
+    def write(self, val, withResponse=True):
+        return self.device._write_desc(self.name, val)
@@ -0,0 +1,128 @@
+import time
+
+from constants import AUTH_STATES
+
+__all__ = ['AuthHandshake']
+
+
+class AuthHandshake(object):
+
+    """Non-blocking auth state machine driven by CHARACTERISTIC_AUTH notifications.
+
+    ``start`` sends the first command and returns, ``on_notification`` advances the
+    handshake and ``poll`` enforces the per-step deadline, retries and the overall
+    timeout. Nothing in here waits for the band.
+    """
+
+    KEY_SENT = 'key sent'
+    RN_REQUESTED = 'random number requested'
+    ENC_SENT = 'encrypted random number sent'
+
+    def __init__(self, device, step_timeout=1.0, timeout=10.0, max_retries=2, clock=time.time):
+        self.device = device
+        self.step_timeout = step_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.clock = clock
+        self.step = None
+        self.state = None
+        self.retries = 0
+        self.timings = {}
+        self.started = self.deadline = self.step_deadline = None
+        self._fell_back = False
+
+    @property
+    def done(self):
+        return self.state is not None
+
+    def start(self, send_key=False):
+        """Begin with the key exchange, or go straight to the challenge if already paired."""
+        self.started = self.clock()
+        self.deadline = self.started + self.timeout
+        if send_key:
+            self._send_key()
+        else:
+            self._req_rdn()
+
+    def time_left(self):
+        now = self.clock()
+        return max(0.0, min(self.deadline, self.step_deadline) - now)
+
+    # steps ##################################################################
+
+    def _enter(self, step):
+        self.step = step
+        self.step_started = self.clock()
+        self.step_deadline = self.step_started + self.step_timeout
+
+    def _finish_step(self, phase):
+        self.timings[phase] = self.clock() - self.step_started
+
+    def _send_key(self):
+        self._enter(self.KEY_SENT)
+        self.device._send_key()
+
+    def _req_rdn(self):
+        self._enter(self.RN_REQUESTED)
+        self.device._req_rdn()
+
+    def _send_enc_rdn(self, random_nr):
+        self._enter(self.ENC_SENT)
+        self.device._send_enc_rdn(random_nr)
+        self.timings['encrypted_reply'] = self.clock() - self.step_started
+
+    def _finish(self, state):
+        self.state = state
+        self.timings['total'] = self.clock() - self.started
+
+    def _fall_back_to_key(self):
+        # band forgot our key, pair again once
+        if self._fell_back:
+            return False
+        self._fell_back = True
+        self._send_key()
+        return True
+
+    # events #################################################################
+
+    def on_notification(self, data):
+        if self.done:
+            return
+        cmd = data[:3]
+        if cmd == b'\x10\x01\x01':
+            self._finish_step('key_send')
+            self._req_rdn()
+        elif cmd == b'\x10\x01\x04':
+            self._finish(AUTH_STATES.KEY_SENDING_FAILED)
+        elif cmd == b'\x10\x02\x01':
+            # 16 bytes
+            self._finish_step('rn_request')
+            self._send_enc_rdn(data[3:])
+        elif cmd == b'\x10\x02\x04':
+            if not self._fall_back_to_key():
+                self._finish(AUTH_STATES.REQUEST_RN_ERROR)
+        elif cmd == b'\x10\x03\x01':
+            self._finish_step('ok')
+            self._finish(AUTH_STATES.AUTH_OK)
+        elif cmd == b'\x10\x03\x04':
+            self.device._log.info(AUTH_STATES.ENCRIPTION_KEY_FAILED)
+            if not self._fall_back_to_key():
+                self._finish(AUTH_STATES.ENCRIPTION_KEY_FAILED)
+        else:
+            self._finish(AUTH_STATES.AUTH_FAILED)
+
+    def poll(self):
+        if self.done:
+            return
+        now = self.clock()
+        if now >= self.deadline:
+            self._finish(AUTH_STATES.AUTH_TIMEOUT)
+        elif now >= self.step_deadline:
+            self.retries += 1
+            if self.retries > self.max_retries:
+                self._finish(AUTH_STATES.AUTH_TIMEOUT)
+            elif self.step == self.KEY_SENT:
+                self._send_key()
+            else:
+                # a lost challenge can't be replayed, ask for a fresh one
+                self._req_rdn()
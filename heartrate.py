@@ -0,0 +1,146 @@
+import math
+from collections import deque, namedtuple
+
+import numpy as np
+
+from filters import MovingAverage
+
+__all__ = ['HeartRateEstimator', 'HeartRateEstimate']
+
+HeartRateEstimate = namedtuple('HeartRateEstimate', 't bpm confidence motion')
+
+
+class HeartRateEstimator(object):
+
+    """Host side BPM estimate from the raw PPG stream.
+
+    Feed it the batch columns ``_parse_queue`` produces: ``update`` with PPG
+    batches, ``update_motion`` with accelerometer batches, e.g.
+    ``band.start_raw_data_realtime(heart_raw_batch_callback=hr.update,
+    accel_raw_batch_callback=hr.update_motion)``.
+
+    Each batch is band-passed with two running moving averages, local maxima
+    above an adaptive threshold become beats, and the BPM is the median beat
+    interval over the last ``window`` seconds. Beats during wrist motion are
+    discarded. Work per batch only depends on the batch and filter lengths,
+    the history is never revisited.
+    """
+
+    def __init__(self, sample_rate=25.0, window=8.0, min_bpm=40, max_bpm=200,
+                 motion_threshold=0.05, motion_holdoff=2.0, callback=None):
+        self.sample_rate = float(sample_rate)
+        self.window = window
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.motion_threshold = motion_threshold
+        self.motion_holdoff = motion_holdoff
+        self.callback = callback
+        # high-pass: subtract the mean over the slowest beat; low-pass: ~4 Hz smoothing
+        self._baseline = MovingAverage(max(2, int(round(self.sample_rate * 60.0 / min_bpm))))
+        self._smooth = MovingAverage(max(1, int(round(self.sample_rate / 8.0))))
+        self._refractory = self.sample_rate * 60.0 / max_bpm
+        self._tail = np.zeros(0)
+        self._power = None
+        self._n = 0
+        self._last_peak = -float('inf')
+        # (sample position, wall clock time) of detected beats inside the window
+        self._peaks = deque()
+        # (start, end) wall clock spans with wrist motion
+        self._motion = deque()
+        self.latest = None
+
+    # PPG ####################################################################
+
+    def update(self, columns):
+        """Consume a ``{'t', 'ppg'}`` batch, return the new estimate (or None)."""
+        ppg = columns['ppg']
+        if not len(ppg):
+            return None
+        x = ppg.astype(np.float64)
+        filtered = self._smooth(x - self._baseline(x))
+        self._track_power(filtered)
+        now = float(columns['t'][-1])
+        self._find_peaks(filtered, now)
+        self._n += len(x)
+        self._prune(now)
+        estimate = self._estimate(now)
+        if estimate is not None:
+            self.latest = estimate
+            if self.callback:
+                self.callback(estimate)
+        return estimate
+
+    def _track_power(self, filtered):
+        power = float(np.mean(filtered * filtered))
+        if self._power is None:
+            self._power = power
+        else:
+            alpha = 1.0 - math.exp(-len(filtered) / (self.sample_rate * self.window))
+            self._power += alpha * (power - self._power)
+
+    def _find_peaks(self, filtered, now):
+        # the last two samples of the previous batch let peaks straddle batches
+        ext = np.concatenate((self._tail, filtered))
+        self._tail = ext[-2:]
+        if len(ext) < 3:
+            return
+        first = self._n - (len(ext) - len(filtered))
+        mid = ext[1:-1]
+        threshold = 0.5 * math.sqrt(self._power)
+        candidates = np.nonzero((mid > ext[:-2]) & (mid >= ext[2:]) & (mid > threshold))[0] + 1
+        if not len(candidates):
+            return
+        # parabolic interpolation for a sub-sample peak position
+        a, b, c = ext[candidates - 1], ext[candidates], ext[candidates + 1]
+        curvature = a - 2 * b + c
+        offset = np.where(curvature < 0, 0.5 * (a - c) / np.where(curvature < 0, curvature, 1.0), 0.0)
+        end = self._n + len(filtered) - 1
+        for pos in (first + candidates + offset).tolist():
+            if pos - self._last_peak < self._refractory:
+                continue
+            self._last_peak = pos
+            self._peaks.append((pos, now - (end - pos) / self.sample_rate))
+
+    def _prune(self, now):
+        oldest = self._n - self.window * self.sample_rate
+        while self._peaks and self._peaks[0][0] < oldest:
+            self._peaks.popleft()
+        while self._motion and self._motion[0][1] < now - self.window:
+            self._motion.popleft()
+
+    def _in_motion(self, t):
+        return any(start <= t <= end for start, end in self._motion)
+
+    def _estimate(self, now):
+        if len(self._peaks) < 4:
+            return None
+        positions = np.array([p[0] for p in self._peaks])
+        valid = np.array([not self._in_motion(p[1]) for p in self._peaks])
+        intervals = np.diff(positions) / self.sample_rate
+        keep = valid[1:] & valid[:-1] & (intervals >= 60.0 / self.max_bpm) & (intervals <= 60.0 / self.min_bpm)
+        intervals = intervals[keep]
+        if len(intervals) < 3:
+            return None
+        mean = float(np.mean(intervals))
+        regularity = max(0.0, 1.0 - 3.0 * float(np.std(intervals)) / mean)
+        coverage = min(1.0, float(np.sum(intervals)) / self.window)
+        return HeartRateEstimate(now, 60.0 / float(np.median(intervals)), regularity * coverage,
+                                 self._in_motion(now))
+
+    # accelerometer ##########################################################
+
+    def update_motion(self, columns):
+        """Consume a ``{'t', 'x', 'y', 'z'}`` batch, marking its span as motion if the wrist moved."""
+        if not len(columns['t']):
+            return False
+        x, y, z = (columns[axis].astype(np.float64) for axis in ('x', 'y', 'z'))
+        magnitude = np.sqrt(x * x + y * y + z * z)
+        mean = float(np.mean(magnitude))
+        if not mean or float(np.std(magnitude)) / mean < self.motion_threshold:
+            return False
+        start, end = float(columns['t'][0]), float(columns['t'][-1]) + self.motion_holdoff
+        if self._motion and start <= self._motion[-1][1]:
+            self._motion[-1] = (self._motion[-1][0], max(end, self._motion[-1][1]))
+        else:
+            self._motion.append((start, end))
+        return True
@@ -17,11 +17,14 @@ def msg_immediate():
     band.send_alert(ALERT_TYPES.MESSAGE)
 
 def detail_info():
+    info = band.get_snapshot()
     print ("Mi Band")
-    print ("Soft revision: ",band.get_revision())
-    print ("Hardware revision: ",band.get_hrdw_revision())
-    print ("Battery: ", band.get_battery_info())
-    print ("Steps: ", band.get_steps())
+    print ("Soft revision: ", info['revision'])
+    print ("Hardware revision: ", info['hrdw_revision'])
+    print ("Serial: ", info['serial'])
+    print ("Battery: ", info['battery'])
+    print ("Steps: ", info['steps'])
+    print ("Time: ", info['time']['date'])
     input("Press Enter to continue")
 
 def custom_message():
@@ -37,12 +40,14 @@ def l(x):
     print ("Realtime heart BPM: ", x)
 
 def heart_beat():
-    band.start_raw_data_realtime(heart_measure_callback=l)
+    stream = band.start_raw_data_realtime(heart_measure_callback=l)
     input("Press Enter to continue")
+    stream.stop()
 
 def sensor():
-    band.start_raw_data_realtime(accel_raw_callback=l)
+    stream = band.start_raw_data_realtime(accel_raw_callback=l)
     input("Press Enter to continue")
+    stream.stop()
 
 def change_date():
     band.change_date()
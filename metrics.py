@@ -0,0 +1,230 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+
+__all__ = ['Metrics', 'Histogram', 'Counter', 'serve_metrics']
+
+# seconds, from 100 us BLE-helper round trips to multi-second auth
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'gatt_seconds': "GATT read/write latency per characteristic",
+    'notifications': "Notifications received per characteristic",
+    'notification_bytes': "Notification payload bytes received per characteristic",
+    'parse_queue_seconds': "Time spent in MiBand3._parse_queue, callbacks included",
+    'callback_seconds': "Time spent in user callbacks",
+    'queue_depth': "Items waiting in a notification channel when _parse_queue ran",
+    'queue_dropped': "Items dropped by a full notification channel",
+    'connect_seconds': "Time to connect (and reconnect) to the band",
+    'auth_seconds': "Time to authenticate",
+    'gatt_rediscoveries': "GATT handle rediscoveries after stale handles",
+    'reconnects': "Links recovered after a drop",
+    'recovery_seconds': "Time from detecting a dropped link to restored notifications",
+    'job_lateness_seconds': "Delay between a scheduled job's deadline and its start",
+    'job_missed': "Deadlines a scheduled job skipped because it ran a whole interval late",
+    'battery_level': "Battery level in percent, from schedule_polls",
+    'steps': "Steps today, from schedule_polls",
+    'time_drift_seconds': "Band clock minus host clock, from schedule_polls",
+}
+
+
+class Histogram(object):
+
+    """Fixed-bucket latency histogram, cheap to update and to merge into Prometheus buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the ``pct`` percentile."""
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        cumulative, seen = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            cumulative.append([bound, seen])
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': cumulative,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+class Counter(object):
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+class Metrics(object):
+
+    """Registry of histograms, counters and gauges keyed by name and a label tuple.
+
+    One registry can be shared by many bands (pass it as
+    ``MiBand3(metrics=...)``); bands label everything with their MAC address.
+    Bands without a registry skip instrumentation entirely. Series are created
+    under a lock and then updated without one: a series is only ever written
+    by the band it is labelled with.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, labels):
+        """The histogram series for ``name``/``labels``; hot paths can hold on to it."""
+        key = (name, labels)
+        hist = self._histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(key, Histogram(self.buckets))
+        return hist
+
+    def counter(self, name, labels):
+        key = (name, labels)
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def observe(self, name, labels, value):
+        self.histogram(name, labels).observe(value)
+
+    def inc(self, name, labels, value=1):
+        self.counter(name, labels).value += value
+
+    def set(self, name, labels, value):
+        self._gauges[(name, labels)] = value
+
+    def timer(self, name, labels):
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    # export #################################################################
+
+    def snapshot(self):
+        with self._lock:
+            histograms = [(k, h.to_dict()) for k, h in self._histograms.items()]
+            counters = [(k, c.value) for k, c in self._counters.items()]
+            gauges = list(self._gauges.items())
+
+        def entries(items):
+            return [dict(value, name=name, labels=dict(labels)) if isinstance(value, dict)
+                    else {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(items, key=lambda item: item[0])]
+        return {'time': time.time(), 'histograms': entries(histograms),
+                'counters': entries(counters), 'gauges': entries(gauges)}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='miband'):
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in HELP:
+                    lines.append('# HELP %s_%s %s' % (prefix, name, HELP[name]))
+                lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        for hist in snapshot['histograms']:
+            name = hist['name']
+            header(name, 'histogram')
+            for bound, count in hist['buckets']:
+                lines.append('%s_%s_bucket%s %d' % (prefix, name, _labels(hist['labels'], le=repr(bound)), count))
+            lines.append('%s_%s_bucket%s %d' % (prefix, name, _labels(hist['labels'], le='+Inf'), hist['count']))
+            lines.append('%s_%s_sum%s %r' % (prefix, name, _labels(hist['labels']), hist['sum']))
+            lines.append('%s_%s_count%s %d' % (prefix, name, _labels(hist['labels']), hist['count']))
+        for counter in snapshot['counters']:
+            header(counter['name'], 'counter')
+            lines.append('%s_%s_total%s %r' % (prefix, counter['name'], _labels(counter['labels']), counter['value']))
+        for gauge in snapshot['gauges']:
+            header(gauge['name'], 'gauge')
+            lines.append('%s_%s%s %r' % (prefix, gauge['name'], _labels(gauge['labels']), gauge['value']))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.labels, time.time() - self.started)
+
+
+def _labels(labels, **extra):
+    items = sorted(labels.items()) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in items)
+
+
+def serve_metrics(metrics, port=9464, host=''):
+    """Serve ``/metrics`` (Prometheus text) and ``/metrics.json`` from a daemon thread."""
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = metrics.to_json(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='miband-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,204 @@
+from collections import deque, namedtuple
+
+import numpy as np
+
+from filters import MovingAverage
+
+__all__ = ['MotionEngine', 'MotionEpoch', 'MotionEvent', 'INTENSITIES']
+
+INTENSITIES = ('sedentary', 'light', 'moderate', 'vigorous')
+# lower ENMO bound of each intensity in g (wrist cut points)
+INTENSITY_THRESHOLDS = np.array([0.0, 0.045, 0.1, 0.4])
+
+MotionEpoch = namedtuple('MotionEpoch', 't enmo intensity steps cadence')
+MotionEvent = namedtuple('MotionEvent', 't kind')
+
+
+class MotionEngine(object):
+
+    """Activity analysis over the raw accelerometer stream.
+
+    Feed it the ``{'t', 'x', 'y', 'z'}`` batches ``_parse_queue`` produces,
+    e.g. ``band.start_raw_data_realtime(accel_raw_batch_callback=engine.update)``.
+    Every ``epoch`` seconds it emits a MotionEpoch: mean ENMO (vector
+    magnitude minus 1 g), its intensity bucket, steps and cadence. Falls
+    (free fall followed by an impact) and long inactivity are reported as
+    MotionEvents; a fall is only reported once the wrist has stayed still for
+    ``fall_confirm`` seconds after the impact. All per-sample work is done on NumPy arrays; the state
+    carried between batches is a few filter tails and counters.
+
+    ``counts_per_g`` is the raw reading for 1 g; by default it is calibrated
+    from the magnitude while the wrist is at rest.
+    """
+
+    def __init__(self, sample_rate=25.0, epoch=1.0, counts_per_g=None, step_threshold=0.08,
+                 max_cadence=240, freefall_g=0.5, impact_g=2.5, fall_window=1.0, fall_confirm=2.0,
+                 inactivity_timeout=1800.0, cadence_window=10.0, epoch_callback=None, event_callback=None):
+        self.sample_rate = float(sample_rate)
+        self.epoch_samples = max(1, int(round(sample_rate * epoch)))
+        self.counts_per_g = counts_per_g
+        self._calibrate = counts_per_g is None
+        self.step_threshold = step_threshold
+        self.freefall_g = freefall_g
+        self.impact_g = impact_g
+        self.fall_window = fall_window
+        self.fall_confirm = fall_confirm
+        self.inactivity_timeout = inactivity_timeout
+        self.cadence_window = cadence_window
+        self.epoch_callback = epoch_callback
+        self.event_callback = event_callback
+        # step signal: magnitude minus its ~1 s mean, smoothed to ~5 Hz
+        self._baseline = MovingAverage(max(2, int(round(self.sample_rate))))
+        self._smooth = MovingAverage(max(1, int(round(self.sample_rate / 10.0))))
+        self._step_refractory = self.sample_rate * 60.0 / max_cadence
+        self._tail = np.zeros(0)
+        self._n = 0
+        self._last_step = -float('inf')
+        self._last_freefall = -float('inf')
+        self._last_fall = -float('inf')
+        # (impact sample position, time, still epochs so far) of an unconfirmed fall
+        self._fall = None
+        # partial epoch carried to the next batch
+        self._epoch_enmo = np.zeros(0)
+        self._epoch_steps = 0
+        # sample positions of recent steps, for cadence
+        self._steps = deque()
+        self._last_active = None
+        self._inactive = False
+        self.steps = 0
+        self.cadence = 0.0
+        self.time_in = dict((name, 0.0) for name in INTENSITIES)
+        self.events = []
+
+    def update(self, columns):
+        """Consume an accelerometer batch, return the MotionEpochs it completed."""
+        t = columns['t']
+        if not len(t):
+            return []
+        x, y, z = (columns[axis].astype(np.float64) for axis in ('x', 'y', 'z'))
+        magnitude = np.sqrt(x * x + y * y + z * z)
+        if self.counts_per_g is None:
+            self.counts_per_g = float(np.median(magnitude)) or 1.0
+        g = magnitude / self.counts_per_g
+        now = float(t[-1])
+        end = self._n + len(g) - 1
+
+        self._detect_falls(g, now, end)
+        steps = self._detect_steps(g, end)
+        self._n += len(g)
+        if self._calibrate and float(np.std(g)) < 0.02:
+            # wrist at rest: the magnitude is gravity alone
+            self.counts_per_g *= 1.0 + 0.05 * (float(np.median(g)) - 1.0)
+        return self._epochs(g, steps, now, end)
+
+    def _time(self, pos, now, end):
+        return now - (end - pos) / self.sample_rate
+
+    def _emit(self, t, kind):
+        event = MotionEvent(t, kind)
+        self.events.append(event)
+        if self.event_callback:
+            self.event_callback(event)
+
+    # falls ##################################################################
+
+    def _detect_falls(self, g, now, end):
+        first = self._n
+        freefall = first + np.nonzero(g < self.freefall_g)[0]
+        impacts = first + np.nonzero(g > self.impact_g)[0]
+        if len(impacts):
+            # most recent free fall sample before each impact
+            k = np.searchsorted(freefall, impacts) - 1
+            previous = np.where(k >= 0, freefall[np.maximum(k, 0)] if len(freefall) else 0, self._last_freefall)
+            window = self.fall_window * self.sample_rate
+            for pos in impacts[(impacts - previous) <= window].tolist():
+                # one fall per impact burst
+                if pos - self._last_fall > 2 * window:
+                    self._fall = [pos, self._time(pos, now, end), 0]
+                self._last_fall = pos
+        if len(freefall):
+            self._last_freefall = freefall[-1]
+
+    # steps ##################################################################
+
+    def _detect_steps(self, g, end):
+        filtered = self._smooth(g - self._baseline(g))
+        ext = np.concatenate((self._tail, filtered))
+        self._tail = ext[-2:]
+        if len(ext) < 3:
+            return np.zeros(0, dtype=int)
+        first = self._n - (len(ext) - len(filtered))
+        mid = ext[1:-1]
+        candidates = first + 1 + np.nonzero((mid > ext[:-2]) & (mid >= ext[2:]) & (mid > self.step_threshold))[0]
+        steps = []
+        for pos in candidates.tolist():
+            if pos - self._last_step >= self._step_refractory:
+                self._last_step = pos
+                steps.append(pos)
+        self.steps += len(steps)
+        self._steps.extend(steps)
+        oldest = end - self.cadence_window * self.sample_rate
+        while self._steps and self._steps[0] < oldest:
+            self._steps.popleft()
+        if len(self._steps) >= 4:
+            span = self._steps[-1] - self._steps[0]
+            self.cadence = 60.0 * self.sample_rate * (len(self._steps) - 1) / span
+        else:
+            self.cadence = 0.0
+        return np.array(steps, dtype=int)
+
+    # epochs #################################################################
+
+    def _epochs(self, g, steps, now, end):
+        enmo = np.concatenate((self._epoch_enmo, np.maximum(g - 1.0, 0.0)))
+        n = len(enmo) // self.epoch_samples
+        # sample position where the first pending epoch starts
+        start = self._n - len(enmo)
+        self._epoch_enmo = enmo[n * self.epoch_samples:]
+        if not n:
+            self._epoch_steps += len(steps)
+            return []
+        means = enmo[:n * self.epoch_samples].reshape(n, self.epoch_samples).mean(axis=1)
+        levels = np.searchsorted(INTENSITY_THRESHOLDS, means, side='right') - 1
+        bounds = start + self.epoch_samples * np.arange(1, n + 1)
+        counts = np.bincount(np.searchsorted(bounds, steps, side='right'), minlength=n + 1)
+        counts[0] += self._epoch_steps
+        self._epoch_steps = int(counts[n])
+        seconds = self.epoch_samples / self.sample_rate
+        for level, total in enumerate(np.bincount(levels, minlength=len(INTENSITIES)).tolist()):
+            self.time_in[INTENSITIES[level]] += total * seconds
+
+        epochs = []
+        for i in range(n):
+            t = self._time(bounds[i] - 1, now, end)
+            epoch = MotionEpoch(t, float(means[i]), INTENSITIES[levels[i]], int(counts[i]), self.cadence)
+            epochs.append(epoch)
+            self._track_fall(bounds[i], epoch)
+            self._track_inactivity(epoch)
+            if self.epoch_callback:
+                self.epoch_callback(epoch)
+        return epochs
+
+    def _track_fall(self, bound, epoch):
+        if self._fall is None or bound - self._fall[0] <= self.epoch_samples:
+            # no candidate, or this epoch still contains the impact
+            return
+        if epoch.intensity != INTENSITIES[0]:
+            self._fall = None
+            return
+        self._fall[2] += 1
+        if self._fall[2] * self.epoch_samples >= self.fall_confirm * self.sample_rate:
+            self._emit(self._fall[1], 'fall')
+            self._fall = None
+
+    def _track_inactivity(self, epoch):
+        if self._last_active is None:
+            self._last_active = epoch.t
+        if epoch.intensity != INTENSITIES[0] or epoch.steps:
+            self._last_active = epoch.t
+            if self._inactive:
+                self._inactive = False
+                self._emit(epoch.t, 'active')
+        elif not self._inactive and epoch.t - self._last_active >= self.inactivity_timeout:
+            self._inactive = True
+            self._emit(epoch.t, 'inactive')
@@ -0,0 +1,184 @@
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_right
+
+from constants import QUEUE_TYPES
+
+__all__ = ['Recorder', 'RecordingReader', 'replay']
+
+MAGIC = b'MIBR'
+VERSION = 1
+# magic, version, record size, index interval
+HEADER = struct.Struct('<4sBxHI4x')
+# timestamp, type, payload length, payload (zero padded)
+RECORD = struct.Struct('<dBB20s2x')
+# timestamp, record number
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_EVERY = 1024
+
+TYPE_CODES = {
+    QUEUE_TYPES.HEART: 1,
+    QUEUE_TYPES.RAW_ACCEL: 2,
+    QUEUE_TYPES.RAW_HEART: 3,
+}
+CODE_TYPES = dict((code, _type) for _type, code in TYPE_CODES.items())
+
+
+class Recorder(object):
+
+    """Append-only log of raw notification payloads with fixed 32 byte records.
+
+    Every ``index_every`` records a (timestamp, record number) entry is appended to
+    ``<path>.idx`` so readers can jump straight to a time range.
+    """
+
+    def __init__(self, path, index_every=INDEX_EVERY):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        if exists:
+            with open(path, 'rb') as f:
+                _, _, _, index_every = HEADER.unpack(f.read(HEADER.size))
+            self.count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+            self._repair()
+        self._f = open(path, 'ab')
+        self._idx = open(path + '.idx', 'ab')
+        if not exists:
+            self._f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, index_every))
+            self.count = 0
+        self.index_every = index_every
+        self._pack = RECORD.pack
+
+    def _repair(self):
+        # a crash mid-write leaves a torn record (or index entry) at the end: cut it off, so
+        # appended records stay aligned and the index only points at records that exist
+        size = HEADER.size + self.count * RECORD.size
+        if os.path.getsize(self.path) > size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+        idx = self.path + '.idx'
+        if not os.path.exists(idx):
+            return
+        with open(idx, 'r+b') as f:
+            data = f.read()
+            keep = 0
+            while keep + INDEX_ENTRY.size <= len(data):
+                _, record = INDEX_ENTRY.unpack_from(data, keep)
+                if record >= self.count:
+                    break
+                keep += INDEX_ENTRY.size
+            if keep < len(data):
+                f.truncate(keep)
+
+    def write(self, _type, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.count % self.index_every == 0:
+            self._idx.write(INDEX_ENTRY.pack(timestamp, self.count))
+        self._f.write(self._pack(timestamp, TYPE_CODES[_type], len(data), data))
+        self.count += 1
+
+    def attach(self, band):
+        """Record everything the band's dispatcher puts on the HEART/RAW_* channels."""
+        for _type in TYPE_CODES:
+            band.channels[_type].tap = self._tap(_type)
+
+    def _tap(self, _type):
+        def tap(item):
+            self.write(_type, item[0], item[1])
+        return tap
+
+    def flush(self):
+        self._f.flush()
+        self._idx.flush()
+
+    def close(self):
+        self._f.close()
+        self._idx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingReader(object):
+
+    """mmap view of a recording; a time range query only touches the pages it covers."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.index_every = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError("%s is not a MiBand recording" % path)
+        self.count = (len(self._mm) - HEADER.size) // RECORD.size
+        self._index_ts, self._index_rec = [], []
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+            for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                ts, rec = INDEX_ENTRY.unpack_from(data, offset)
+                self._index_ts.append(ts)
+                self._index_rec.append(rec)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, n):
+        ts, code, length, payload = RECORD.unpack_from(self._mm, HEADER.size + n * RECORD.size)
+        return ts, CODE_TYPES[code], payload[:length]
+
+    def _first_record(self, start):
+        # last index entry at or before start, records are in time order
+        i = bisect_right(self._index_ts, start) - 1
+        return self._index_rec[i] if i >= 0 else 0
+
+    def query(self, start=None, end=None, types=None):
+        """Yield ``(timestamp, type, payload)`` for records with start <= timestamp < end."""
+        n = self._first_record(start) if start is not None else 0
+        unpack_from, mm, size = RECORD.unpack_from, self._mm, RECORD.size
+        codes = set(TYPE_CODES[t] for t in types) if types else None
+        offset, stop = HEADER.size + n * size, HEADER.size + self.count * size
+        while offset < stop:
+            ts, code, length, payload = unpack_from(mm, offset)
+            offset += size
+            if end is not None and ts >= end:
+                break
+            if (start is not None and ts < start) or (codes is not None and code not in codes):
+                continue
+            yield ts, CODE_TYPES[code], payload[:length]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+def replay(path, band, start=None, end=None, speed=None, batch=64):
+    """Feed recorded packets into ``band``'s channels and run its normal ``_parse_queue``.
+
+    ``speed`` replays in (scaled) real time, ``None`` as fast as possible.
+    """
+    reader = RecordingReader(path)
+    first = wall = None
+    pending = 0
+    try:
+        for ts, _type, payload in reader.query(start, end):
+            if speed:
+                if first is None:
+                    first, wall = ts, time.time()
+                delay = (ts - first) / speed - (time.time() - wall)
+                if delay > 0:
+                    band._parse_queue()
+                    time.sleep(delay)
+            band.channels[_type].put((payload, ts))
+            pending += 1
+            if pending >= batch:
+                band._parse_queue()
+                pending = 0
+        band._parse_queue()
+    finally:
+        reader.close()
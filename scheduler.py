@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from bluepy.btle import BTLEException
+
+__all__ = ['Scheduler', 'Job']
+
+
+class Job(object):
+
+    """A call scheduled on a Scheduler, repeated every ``interval`` seconds (once if None).
+
+    ``lateness`` keeps the most recent start delays past the deadline;
+    ``missed`` counts deadlines skipped because a run started more than a
+    whole interval late.
+    """
+
+    def __init__(self, fn, interval, due, name=None, history=1024):
+        self.fn = fn
+        self.interval = interval
+        self.due = due
+        self.name = name or getattr(fn, '__name__', 'job')
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.cancelled = False
+        self.lateness = deque(maxlen=history)
+
+    def stats(self):
+        late = sorted(self.lateness)
+        return {'name': self.name, 'interval': self.interval, 'runs': self.runs, 'missed': self.missed,
+                'errors': self.errors, 'lateness_p50': _percentile(late, 50),
+                'lateness_p99': _percentile(late, 99), 'lateness_max': late[-1] if late else None}
+
+    def __repr__(self):
+        return '<Job %s every %s due %.3f>' % (self.name, self.interval, self.due)
+
+
+class Scheduler(object):
+
+    """Timer heap of one connection's periodic work: keep-alives, polls and user jobs.
+
+    Nothing here runs by itself: the connection's event loop
+    (``MiBand3.run_pending``) waits for notifications at most ``timeout()``
+    seconds, then calls ``run_due()``, so jobs run on the pump thread and
+    never race notification handling for the link. A job that falls a whole
+    interval behind skips the missed deadlines instead of running in a burst.
+    """
+
+    def __init__(self, metrics=None, labels=()):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.metrics = metrics
+        self.labels = labels
+        self._heap = []
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _push(self, job):
+        with self._lock:
+            old = self._jobs.get(job.name)
+            if old is not None and old is not job:
+                # one job per name, rescheduling replaces it
+                old.cancelled = True
+            self._jobs[job.name] = job
+            heapq.heappush(self._heap, (job.due, next(self._seq), job))
+        return job
+
+    def every(self, interval, fn, name=None, delay=None):
+        """Run ``fn()`` every ``interval`` seconds, the first time after ``delay`` (default ``interval``)."""
+        due = time.time() + (interval if delay is None else delay)
+        return self._push(Job(fn, interval, due, name))
+
+    def after(self, delay, fn, name=None):
+        """Run ``fn()`` once, ``delay`` seconds from now."""
+        return self._push(Job(fn, None, time.time() + delay, name))
+
+    def cancel(self, job):
+        """Cancel a job or the job of that name; it is dropped from the heap lazily."""
+        with self._lock:
+            if not isinstance(job, Job):
+                job = self._jobs.get(job)
+            if job is not None:
+                job.cancelled = True
+                if self._jobs.get(job.name) is job:
+                    del self._jobs[job.name]
+
+    def __contains__(self, name):
+        return name in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    @property
+    def jobs(self):
+        return dict(self._jobs)
+
+    def next_due(self):
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def timeout(self, cap=None):
+        """Seconds until the next deadline, at most ``cap``; what a notification wait should block for."""
+        due = self.next_due()
+        if due is None:
+            return cap
+        remaining = max(0.0, due - time.time())
+        return remaining if cap is None else min(cap, remaining)
+
+    def run_due(self, now=None):
+        """Run every job whose deadline has passed; returns how many ran.
+
+        BLE errors are re-raised after the job is rescheduled, so the event
+        loop can reconnect; anything else is logged and counted.
+        """
+        now = time.time() if now is None else now
+        ran = 0
+        while True:
+            with self._lock:
+                heap = self._heap
+                while heap and heap[0][2].cancelled:
+                    heapq.heappop(heap)
+                if not heap or heap[0][0] > now:
+                    return ran
+                _, _, job = heapq.heappop(heap)
+            ran += 1
+            self._run(job)
+
+    def _run(self, job):
+        started = time.time()
+        late = max(0.0, started - job.due)
+        job.lateness.append(late)
+        job.runs += 1
+        if job.interval is not None:
+            skipped = int(late // job.interval)
+            job.missed += skipped
+            job.due += job.interval * (skipped + 1)
+            with self._lock:
+                if not job.cancelled:
+                    heapq.heappush(self._heap, (job.due, next(self._seq), job))
+        else:
+            self.cancel(job)
+        if self.metrics is not None:
+            labels = self.labels + (('job', job.name),)
+            self.metrics.observe('job_lateness_seconds', labels, late)
+            if job.interval is not None and late >= job.interval:
+                self.metrics.inc('job_missed', labels, int(late // job.interval))
+        try:
+            job.fn()
+        except BTLEException:
+            job.errors += 1
+            raise
+        except Exception:
+            job.errors += 1
+            self._log.exception("Job %s failed", job.name)
+
+    def stats(self):
+        return [job.stats() for _, job in sorted(self._jobs.items())]
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
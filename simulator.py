@@ -0,0 +1,407 @@
+import math
+import os
+import struct
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from Crypto.Cipher import AES
+
+from bluepy.btle import Service, Characteristic, Descriptor, UUID, BTLEGattError, BTLEDisconnectError
+
+import codec
+from auth import MiBand3
+from constants import UUIDS, QUEUE_TYPES
+from crc import crc16
+
+__all__ = ['SimulatedMiBand3']
+
+NOTIFY = Characteristic.props["NOTIFY"]
+READ_WRITE = Characteristic.props["READ"] | Characteristic.props["WRITE"] | \
+    Characteristic.props["WRITE_NO_RESP"]
+
+# (service, [(characteristic, has notification descriptor)])
+GATT_LAYOUT = [
+    (UUIDS.SERVICE_MIBAND1, [
+        (UUIDS.CHARACTERISTIC_SENSOR, True),
+        (UUIDS.CHARACTERISTIC_HZ, True),
+        (UUIDS.CHARACTERISTIC_CONFIGURATION, True),
+        (UUIDS.CHARACTERISTIC_FETCH, True),
+        (UUIDS.CHARACTERISTIC_ACTIVITY_DATA, True),
+        (UUIDS.CHARACTERISTIC_BATTERY, True),
+        (UUIDS.CHARACTERISTIC_STEPS, True),
+        (UUIDS.CHARACTERISTIC_USER_SETTINGS, True),
+        (UUIDS.CHARACTERISTIC_LE_PARAMS, False),
+        (UUIDS.CHARACTERISTIC_DEVICEEVENT, True),
+        (UUIDS.CHARACTERISTIC_CURRENT_TIME, True),
+        (UUIDS.CHARACTERISTIC_AGE, False),
+    ]),
+    (UUIDS.SERVICE_MIBAND2, [
+        (UUIDS.CHARACTERISTIC_AUTH, True),
+    ]),
+    (UUIDS.SERVICE_HEART_RATE, [
+        (UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE, True),
+        (UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL, False),
+    ]),
+    (UUIDS.SERVICE_ALERT, [
+        (UUIDS.CHARACTERISTIC_ALERT, False),
+    ]),
+    (UUIDS.SERVICE_ALERT_NOTIFICATION, [
+        (UUIDS.CHARACTERISTIC_CUSTOM_ALERT, False),
+    ]),
+    (UUIDS.SERVICE_DEVICE_INFO, [
+        (UUIDS.CHARACTERISTIC_SERIAL, False),
+        (UUIDS.CHARACTERISTIC_HRDW_REVISION, False),
+        (UUIDS.CHARACTERISTIC_REVISION, False),
+    ]),
+    (UUIDS.SERVICE_DFU_FIRMWARE, [
+        (UUIDS.CHARACTERISTIC_DFU_FIRMWARE, True),
+        (UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE, False),
+    ]),
+]
+
+
+DEFAULT_VALUES = {
+    UUIDS.CHARACTERISTIC_REVISION: b'V1.5.0.11',
+    UUIDS.CHARACTERISTIC_HRDW_REVISION: b'V0.25.3.5',
+    UUIDS.CHARACTERISTIC_SERIAL: b'0123456789AB',
+    UUIDS.CHARACTERISTIC_BATTERY: codec.encode_battery(75, last_level=100),
+    UUIDS.CHARACTERISTIC_STEPS: codec.encode_steps(1000, 300, 40),
+    UUIDS.CHARACTERISTIC_CURRENT_TIME: codec.encode_current_time(datetime(2019, 1, 1, 12), tz_quarters=22),
+}
+
+
+# realtime notification rates in packets per second (3 accel / 7 PPG samples per packet)
+DEFAULT_RATES = {
+    QUEUE_TYPES.HEART: 1.0,
+    QUEUE_TYPES.RAW_ACCEL: 25.0 / 3,
+    QUEUE_TYPES.RAW_HEART: 25.0 / 7,
+}
+
+
+class SimulatedMiBand3(MiBand3):
+
+    """MiBand3 talking to an in-process emulation of the band instead of bluepy-helper.
+
+    Every GATT request counts as one ATT round trip (``att_ops``); requests that
+    wait for a response sleep ``latency`` seconds. Starting realtime data makes
+    the band emit heart/accel/PPG notifications at ``rates`` packets per second,
+    firmware written over DFU ends up in ``dfu_image``.
+
+    Faults: ``drop_link()`` (or ``schedule_drop(delay)``) cuts the link like
+    walking out of range: realtime data stops and every request raises
+    BTLEDisconnectError until the next connect; ``connect_failures`` makes
+    that many connect attempts fail first.
+
+    Connection parameters written to CHARACTERISTIC_LE_PARAMS are granted at
+    the top of the requested interval range and kept in ``le_params``; with
+    ``interval_latency`` a round trip then takes one connection interval
+    instead of ``latency``.
+    """
+
+    def __init__(self, mac_address='AA:BB:CC:DD:EE:FF', latency=0.0, paired_key=MiBand3._KEY,
+                 rates=None, heart_bpm=72, interval_latency=False, **kwargs):
+        self.latency = latency
+        self.interval_latency = interval_latency
+        self.le_params = None
+        self.paired_key = paired_key
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.heart_bpm = heart_bpm
+        # type -> [next packet due, packet counter]
+        self._streams = {}
+        self._raw_armed = False
+        self.dfu_image = bytearray()
+        self.dfu_size = 0
+        self.dfu_confirmed = 0
+        self.dfu_crc_ok = None
+        self._challenge = None
+        # synthetic activity history: one record per minute from here until now
+        self.history_start = (datetime.now() - timedelta(days=7)).replace(second=0, microsecond=0)
+        self._fetch_from = None
+        self.att_ops = 0
+        self.connected = True
+        self.connect_failures = 0
+        self.drops = 0
+        self._drop_at = None
+        self.writes = []
+        self.pending = deque()
+        self._build_gatt()
+        MiBand3.__init__(self, mac_address, **kwargs)
+
+    def _build_gatt(self):
+        self.sim_services = []
+        self.sim_chars = []
+        self.sim_descs = []
+        self.sim_values = {}
+        self.sim_handles = {}
+        hnd = 1
+        for svc_uuid, chars in GATT_LAYOUT:
+            start = hnd
+            self.sim_descs.append(Descriptor(self, UUID(0x2800), hnd))
+            hnd += 1
+            for char_uuid, notify in chars:
+                char = Characteristic(self, char_uuid, hnd, READ_WRITE | (NOTIFY if notify else 0), hnd + 1)
+                self.sim_descs.append(Descriptor(self, UUID(0x2803), hnd))
+                self.sim_descs.append(Descriptor(self, char_uuid, hnd + 1))
+                self.sim_chars.append(char)
+                self.sim_handles[char.uuid] = hnd + 1
+                self.sim_values[hnd + 1] = DEFAULT_VALUES.get(char_uuid, b'')
+                hnd += 2
+                if notify:
+                    self.sim_descs.append(Descriptor(self, UUID(UUIDS.NOTIFICATION_DESCRIPTOR), hnd))
+                    self.sim_values[hnd] = b'\x00\x00'
+                    hnd += 1
+            self.sim_services.append(Service(self, svc_uuid, start, hnd - 1))
+
+    def _att(self, wait=True):
+        self._check_link()
+        self.att_ops += 1
+        if self.latency and wait:
+            time.sleep(self.latency)
+
+    def sim_handle(self, uuid):
+        return self.sim_handles[UUID(uuid)]
+
+    def notify(self, uuid, data):
+        self.pending.append((self.sim_handle(uuid), data))
+
+    # faults #################################################################
+
+    def drop_link(self):
+        self.connected = False
+        self.drops += 1
+        self._drop_at = None
+        self._raw_armed = False
+        self._streams.clear()
+        self.pending.clear()
+
+    def schedule_drop(self, delay):
+        self._drop_at = time.time() + delay
+
+    def _check_link(self):
+        if self._drop_at is not None and time.time() >= self._drop_at:
+            self.drop_link()
+        if not self.connected:
+            raise BTLEDisconnectError("Device disconnected", {'state': ['disc']})
+
+    # bluepy Peripheral ######################################################
+
+    def _connect(self, addr, addrType=None, iface=None):
+        if self.connect_failures:
+            self.connect_failures -= 1
+            time.sleep(self.latency)
+            raise BTLEDisconnectError("Failed to connect to peripheral %s" % addr, {'state': ['disc']})
+        self.connected = True
+        self._att()
+        self.addr = addr
+        self.addrType = addrType
+        self.iface = iface
+
+    def disconnect(self):
+        self.connected = False
+        self._streams.clear()
+        self.pending.clear()
+
+    def setSecurityLevel(self, level):
+        return {'rsp': ['stat']}
+
+    def setMTU(self, mtu):
+        self._att()
+        return {'rsp': ['stat'], 'mtu': [mtu]}
+
+    def discoverServices(self):
+        self._att()
+        self._serviceMap = dict((svc.uuid, svc) for svc in self.sim_services)
+        return self._serviceMap
+
+    def getServiceByUUID(self, uuidVal):
+        uuid = UUID(uuidVal)
+        if self._serviceMap is not None and uuid in self._serviceMap:
+            return self._serviceMap[uuid]
+        self._att()
+        svc = [s for s in self.sim_services if s.uuid == uuid][0]
+        if self._serviceMap is None:
+            self._serviceMap = {}
+        self._serviceMap[uuid] = Service(self, svc.uuid, svc.hndStart, svc.hndEnd)
+        return self._serviceMap[uuid]
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        self._att()
+        return [Characteristic(self, c.uuid, c.handle, c.properties, c.valHandle)
+                for c in self.sim_chars
+                if startHnd <= c.handle <= endHnd and (uuid is None or c.uuid == UUID(uuid))]
+
+    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        self._att()
+        return [Descriptor(self, d.uuid, d.handle) for d in self.sim_descs
+                if startHnd <= d.handle <= endHnd]
+
+    def _check_handle(self, handle, wait=True):
+        self._att(wait)
+        if handle not in self.sim_values:
+            raise BTLEGattError("Bluetooth command failed", {'code': ['atterr']})
+
+    def readCharacteristic(self, handle):
+        self._check_handle(handle)
+        return self.sim_values[handle]
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self._check_handle(handle, withResponse)
+        self.writes.append((handle, val))
+        self.sim_values[handle] = val
+        self.on_write(handle, val)
+        return {'rsp': ['wr']}
+
+    def waitForNotifications(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self._check_link()
+            now = time.time()
+            if self._streams:
+                self._generate(now)
+            if self.pending:
+                break
+            if now >= deadline:
+                return False
+            next_due = min([state[0] for state in self._streams.values()] + [deadline] +
+                           ([self._drop_at] if self._drop_at is not None else []))
+            time.sleep(max(0.0, next_due - now))
+        hnd, data = self.pending.popleft()
+        if self.delegate is not None:
+            self.delegate.handleNotification(hnd, data)
+        return True
+
+    # realtime streams #######################################################
+
+    def _start_stream(self, _type):
+        if _type not in self._streams:
+            self._streams[_type] = [time.time(), 0]
+
+    def _stop_stream(self, _type):
+        self._streams.pop(_type, None)
+
+    def _generate(self, now):
+        for _type, state in self._streams.items():
+            interval = 1.0 / self.rates[_type]
+            while state[0] <= now:
+                uuid, data = self.stream_packet(_type, state[1])
+                self.notify(uuid, data)
+                state[0] += interval
+                state[1] += 1
+
+    def stream_packet(self, _type, n):
+        """Notification number ``n`` of a realtime stream as ``(characteristic uuid, payload)``."""
+        if _type == QUEUE_TYPES.HEART:
+            return UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE, codec.encode_heart_measure(self.heart_bpm)
+        if _type == QUEUE_TYPES.RAW_ACCEL:
+            # wrist at rest: gravity on z plus a slow sway on x/y
+            samples = []
+            for k in range(3 * n, 3 * n + 3):
+                sway = int(40 * math.sin(k / 10.0))
+                samples.append((sway, -sway, 1000))
+            return UUIDS.CHARACTERISTIC_HZ, codec.encode_accel(n, samples)
+        # PPG: one sine pulse per beat at 7 * rate samples per second
+        sample_rate = 7 * self.rates[QUEUE_TYPES.RAW_HEART]
+        beat = 2 * math.pi * self.heart_bpm / 60.0 / sample_rate
+        samples = [int(2000 + 300 * math.sin(beat * k)) for k in range(7 * n, 7 * n + 7)]
+        return UUIDS.CHARACTERISTIC_HZ, codec.encode_ppg(n, samples)
+
+    # band behaviour #########################################################
+
+    def on_write(self, handle, val):
+        if handle == self.sim_handle(UUIDS.CHARACTERISTIC_AUTH):
+            self._on_auth(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_FETCH):
+            self._on_fetch(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL):
+            self._on_heart_control(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_SENSOR):
+            self._on_sensor(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_DFU_FIRMWARE):
+            self._on_dfu(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE):
+            self.dfu_image.extend(val)
+        elif handle == self.sim_handle(UUIDS.CHARACTERISTIC_LE_PARAMS):
+            self._on_le_params(val)
+
+    def _on_le_params(self, val):
+        min_interval, max_interval, latency, timeout, adv = codec.LE_PARAMS.unpack(val)
+        self.le_params = (max_interval, max_interval, latency, timeout, adv)
+        self.sim_values[self.sim_handle(UUIDS.CHARACTERISTIC_LE_PARAMS)] = codec.LE_PARAMS.pack(*self.le_params)
+        if self.interval_latency:
+            self.latency = max_interval * 1.25 / 1000
+
+    def _on_heart_control(self, val):
+        if val == b'\x15\x01\x01':
+            self._start_stream(QUEUE_TYPES.HEART)
+        elif val == b'\x15\x01\x00':
+            self._stop_stream(QUEUE_TYPES.HEART)
+
+    def _on_sensor(self, val):
+        if val[:1] == b'\x01':
+            self._raw_armed = True
+        elif val == b'\x02' and self._raw_armed:
+            self._start_stream(QUEUE_TYPES.RAW_ACCEL)
+            self._start_stream(QUEUE_TYPES.RAW_HEART)
+        elif val == b'\x03':
+            self._raw_armed = False
+            self._stop_stream(QUEUE_TYPES.RAW_ACCEL)
+            self._stop_stream(QUEUE_TYPES.RAW_HEART)
+
+    def _on_dfu(self, val):
+        cmd = val[:1]
+        if cmd == b'\x01':
+            self.dfu_size = struct.unpack('<I', val[1:4] + b'\x00')[0]
+            self.dfu_image = bytearray()
+            self.dfu_confirmed = 0
+            self.dfu_crc_ok = None
+        elif cmd == b'\x00':
+            self.dfu_confirmed = len(self.dfu_image)
+            return
+        elif cmd == b'\x04':
+            self.dfu_crc_ok = struct.unpack('<H', val[1:3])[0] == crc16(bytes(self.dfu_image))
+            self.notify(UUIDS.CHARACTERISTIC_DFU_FIRMWARE, b'\x10\x04' + (b'\x01' if self.dfu_crc_ok else b'\x04'))
+            return
+        self.notify(UUIDS.CHARACTERISTIC_DFU_FIRMWARE, b'\x10' + cmd + b'\x01')
+
+    @staticmethod
+    def history_record(minute):
+        # kind, intensity, steps, heart rate for minute number ``minute``
+        return struct.pack('BBBB', 1 + minute % 4, minute % 97, minute % 31, 60 + minute % 40)
+
+    def _on_fetch(self, val):
+        if val[:2] == b'\x01\x01':
+            year, month, day, hour, minute = struct.unpack_from('<HBBBB', val, 2)
+            since = max(datetime(year, month, day, hour, minute), self.history_start)
+            now = datetime.now().replace(second=0, microsecond=0)
+            count = max(0, int((now - since).total_seconds() // 60))
+            self._fetch_from = (since, count)
+            self.notify(UUIDS.CHARACTERISTIC_FETCH, b'\x10\x01\x01' + struct.pack(
+                '<IHBBBBBB', count, since.year, since.month, since.day, since.hour, since.minute, 0, 0))
+        elif val[:1] == b'\x02' and self._fetch_from:
+            since, count = self._fetch_from
+            first = int((since - self.history_start).total_seconds() // 60)
+            for n, i in enumerate(range(0, count, 4)):
+                records = b''.join(self.history_record(first + j) for j in range(i, min(i + 4, count)))
+                self.notify(UUIDS.CHARACTERISTIC_ACTIVITY_DATA, struct.pack('B', n & 0xFF) + records)
+            self.notify(UUIDS.CHARACTERISTIC_FETCH, b'\x10\x02\x01')
+            self._fetch_from = None
+
+    def _on_auth(self, val):
+        cmd = val[:2]
+        if cmd == b'\x01\x08':
+            self.paired_key = val[2:18]
+            self.notify(UUIDS.CHARACTERISTIC_AUTH, b'\x10\x01\x01')
+        elif cmd == b'\x02\x08':
+            if self.paired_key is None:
+                self.notify(UUIDS.CHARACTERISTIC_AUTH, b'\x10\x02\x04')
+                return
+            self._challenge = os.urandom(16)
+            self.notify(UUIDS.CHARACTERISTIC_AUTH, b'\x10\x02\x01' + self._challenge)
+        elif cmd == b'\x03\x08':
+            expected = AES.new(self.paired_key, AES.MODE_ECB).encrypt(self._challenge or b'\x00' * 16)
+            if val[2:18] == expected:
+                self.notify(UUIDS.CHARACTERISTIC_AUTH, b'\x10\x03\x01')
+            else:
+                self.notify(UUIDS.CHARACTERISTIC_AUTH, b'\x10\x03\x04')
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import threading
+
+__all__ = ['JsonStore', 'STATE_DIR']
+
+STATE_DIR = os.path.expanduser('~/.miband')
+
+# (class, absolute path) -> the store shared by every band of the process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class JsonStore(object):
+
+    """Small per-band JSON state file (one entry per MAC address), written atomically.
+
+    Use ``shared(path)`` rather than the constructor when several bands may
+    write the same file: they then share one store and its lock. Each write
+    re-reads the file and only replaces its own entry, so entries written
+    meanwhile by another store or process are kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        # one store may be shared by bands running in parallel
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, path):
+        """The one store of this class for ``path`` in this process."""
+        key = (cls, os.path.abspath(path))
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                store = _stores[key] = cls(path)
+            return store
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp', dir=directory or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._entries = entries
+
+    def get(self, mac_address, default=None):
+        with self._lock:
+            return self._load().get(mac_address.upper(), default)
+
+    def set(self, mac_address, value):
+        with self._lock:
+            entries = self._read()
+            entries[mac_address.upper()] = value
+            self._save(entries)
+
+    def pop(self, mac_address):
+        with self._lock:
+            entries = self._read()
+            value = entries.pop(mac_address.upper(), None)
+            if value is not None:
+                self._save(entries)
+            else:
+                self._entries = entries
+            return value
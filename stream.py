@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from Queue import Empty
+
+from bluepy.btle import BTLEException
+
+from constants import QUEUE_TYPES
+
+__all__ = ['RealtimeStream']
+
+
+class RealtimeStream(object):
+
+    """Handle for a running realtime subscription.
+
+    A background thread runs the band's event loop (``MiBand3.run_pending``):
+    it pumps notifications, runs the band callbacks and the scheduled jobs,
+    among them the heart rate keep-alive ping, so the caller's thread stays
+    free. A dropped link is reconnected (``MiBand3.reconnect``) unless the
+    band was created with ``auto_reconnect=False``; the reconnect records
+    get a ``data_gap_seconds`` once notifications arrive again. Iterate
+    ``samples()`` to consume ``(type, value)`` pairs; leaving the loop (or
+    ``stop()``) ends the subscription through ``MiBand3.stop_realtime``.
+    """
+
+    def __init__(self, band, ping_interval=12.0, poll_interval=0.1, maxsize=4096):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.band = band
+        self.ping_interval = ping_interval
+        self.poll_interval = poll_interval
+        self.error = None
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.band.scheduler.every(self.ping_interval, self.band.keep_alive, name='keep_alive')
+        self._thread = threading.Thread(target=self._run, name='miband-pump-' + self.band.mac_address)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        band = self.band
+        # recovery record of the last reconnect, until data flows again
+        gap = None
+        while not self._stop.is_set():
+            try:
+                band.run_pending(self.poll_interval)
+                if gap is not None and band.last_notification > gap['recovered']:
+                    gap['data_gap_seconds'] = band.last_notification - (gap['last_notification'] or gap['detected'])
+                    gap = None
+            except BTLEException as e:
+                if self._stop.is_set() or not band.auto_reconnect:
+                    self.error = e
+                    self._log.error("Realtime pump stopped: %s", e)
+                    return
+                self._log.warning("Link dropped, reconnecting: %s", e)
+                try:
+                    gap = band.reconnect(band.reconnect_attempts)
+                except BTLEException as e:
+                    self.error = e
+                    self._log.error("Realtime pump stopped, reconnect failed: %s", e)
+                    return
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self.band.scheduler.cancel('keep_alive')
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self.band._stream is self:
+            self.band._stream = None
+        # after a pump error the link is gone: writing the band would only raise again
+        self.band.stop_realtime(link_lost=self.error is not None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # consumers ##############################################################
+
+    def samples(self, types=(QUEUE_TYPES.HEART,), seconds=None):
+        """Yield ``(type, value)`` until stopped or ``seconds`` have passed; raw types yield NumPy column batches.
+
+        Raises the pump's error if it stopped on one.
+        """
+        deadline = time.time() + seconds if seconds is not None else None
+        sub = self.band.subscribe(types, maxsize=self.maxsize, policy='drop_newest', name='stream')
+        try:
+            while self.running or len(sub):
+                timeout = self.poll_interval
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.time())
+                    if timeout <= 0:
+                        return
+                try:
+                    yield sub.get(timeout=timeout)
+                except Empty:
+                    continue
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.dropped += sub.dropped
+            sub.close()
+            self.stop()
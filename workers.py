@@ -0,0 +1,276 @@
+import ctypes
+import logging
+import multiprocessing
+import struct
+import threading
+from multiprocessing.sharedctypes import RawArray
+from Queue import Empty
+
+import numpy as np
+
+from constants import QUEUE_TYPES
+from decode import AccelRing, PpgRing
+from recorder import TYPE_CODES
+
+__all__ = ['WorkerPool', 'SharedRing', 'ANALYTICS']
+
+# fanout type of analytics results, published as (raw type, result)
+ANALYTICS = 'analytics'
+# the recorder's 32 byte record, with the ring generation in its padding
+SLOT = struct.Struct('<dBB20sH')
+RECORD_DTYPE = np.dtype([('t', '<f8'), ('type', 'u1'), ('length', 'u1'), ('payload', 'u1', (20,)),
+                         ('generation', '<u2')])
+_ACCEL = TYPE_CODES[QUEUE_TYPES.RAW_ACCEL]
+_PPG = TYPE_CODES[QUEUE_TYPES.RAW_HEART]
+
+
+class SharedRing(object):
+
+    """Single-producer, single-consumer ring of recorder records in shared memory.
+
+    The ring is a ``multiprocessing`` RawArray created before the workers
+    fork, so the BLE pump and a worker map the same pages. The producer
+    writes a record and then advances ``head``; the consumer copies records
+    out and then advances ``tail``. A full ring drops the new record (counted
+    in ``dropped``) rather than block the pump.
+
+    A ring is reused when another band is attached; ``renew()`` starts a new
+    ``generation``, which every record carries, so the consumer can tell the
+    records and engine state of the previous band from the new ones.
+    """
+
+    def __init__(self, capacity=1 << 14):
+        self.capacity = capacity
+        self._buf = RawArray(ctypes.c_char, capacity * SLOT.size)
+        # head, tail, dropped, generation
+        self._counters = RawArray(ctypes.c_uint64, 4)
+        self._records = None
+
+    @property
+    def generation(self):
+        return int(self._counters[3])
+
+    def renew(self):
+        """Start a new generation; returns it."""
+        self._counters[3] += 1
+        return self.generation
+
+    def put(self, code, data, timestamp, generation=0):
+        counters = self._counters
+        head = counters[0]
+        if head - counters[1] >= self.capacity:
+            counters[2] += 1
+            return False
+        SLOT.pack_into(self._buf, (head % self.capacity) * SLOT.size, timestamp, code, len(data), data,
+                       generation & 0xFFFF)
+        counters[0] = head + 1
+        return True
+
+    def take(self, limit=None):
+        """Copy of the records written since the last take (at most ``limit``), None if there are none."""
+        counters = self._counters
+        tail = counters[1]
+        n = counters[0] - tail
+        if limit is not None:
+            n = min(n, limit)
+        if not n:
+            return None
+        if self._records is None:
+            self._records = np.frombuffer(self._buf, dtype=RECORD_DTYPE)
+        start = tail % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            records = self._records[start:end].copy()
+        else:
+            records = np.concatenate((self._records[start:], self._records[:end - self.capacity]))
+        counters[1] = tail + n
+        return records
+
+    def __len__(self):
+        return int(self._counters[0] - self._counters[1])
+
+    def stats(self):
+        head, tail, dropped, generation = self._counters
+        return {'written': int(head), 'consumed': int(tail), 'lag': int(head - tail), 'dropped': int(dropped),
+                'generation': int(generation)}
+
+
+def _decode(decoder, records):
+    size = decoder.packet_dtype.itemsize
+    packets = np.ascontiguousarray(records['payload'][:, :size]).view(decoder.packet_dtype).ravel()
+    return decoder.columns(decoder.decode(packets, records['t']))
+
+
+def _work(rings, results, stop, analytics, return_samples, batch, poll_interval):
+    """Worker process: decode the records of ``rings`` and run the analytics engines on them."""
+    decoders = ((_ACCEL, QUEUE_TYPES.RAW_ACCEL, AccelRing(1)), (_PPG, QUEUE_TYPES.RAW_HEART, PpgRing(1)))
+    # (ring, raw type) -> engine; a band always lands on the same worker, so engines keep their state
+    engines = {}
+    # ring -> generation the engines belong to
+    generations = {}
+    log = logging.getLogger('WorkerPool')
+    while True:
+        idle = True
+        for index, ring in rings:
+            records = ring.take(batch)
+            if records is None:
+                continue
+            idle = False
+            # read after the take, so no record in the batch is newer
+            generation = ring.generation
+            if generations.get(index) != generation:
+                # the ring was handed to another band: start its engines afresh
+                generations[index] = generation
+                for _type in analytics:
+                    engines.pop((index, _type), None)
+            records = records[records['generation'] == (generation & 0xFFFF)]
+            if not len(records):
+                continue
+            out = []
+            for code, _type, decoder in decoders:
+                selected = records[records['type'] == code]
+                if not len(selected):
+                    continue
+                columns = _decode(decoder, selected)
+                if return_samples:
+                    out.append((_type, columns))
+                factory = analytics.get(_type)
+                if factory is None:
+                    continue
+                engine = engines.get((index, _type))
+                if engine is None:
+                    engine = engines[(index, _type)] = factory()
+                try:
+                    result = engine.update(columns)
+                except Exception:
+                    log.exception("%s analytics failed", _type)
+                    continue
+                if result:
+                    out.append((ANALYTICS, (_type, result)))
+            if out:
+                results.put((index, generation, out))
+        if idle:
+            if stop.is_set():
+                return
+            stop.wait(poll_interval)
+
+
+class WorkerPool(object):
+
+    """Decodes raw accelerometer/PPG data and runs analytics in worker processes.
+
+    ``attach(band)`` points the band's ``raw_sink`` at a shared ring, so the
+    BLE pump only copies each raw payload into shared memory; a worker
+    process decodes it with the ``decode`` rings and feeds ``analytics``
+    engines, one per band and type from ``analytics[type]()`` (e.g.
+    ``{'raw_heart': HeartRateEstimator, 'raw_accel': MotionEngine}``;
+    anything with ``update(columns)``). Results come back to the band's
+    fanout subscribers from a collector thread: decoded batches as
+    ``raw_heart``/``raw_accel`` (unless ``return_samples`` is off) and
+    non-empty engine results as ``('analytics', (type, result))``. Raw batch
+    callbacks do not run for attached bands.
+
+    Bands are spread over ``workers`` processes; at most ``max_bands`` can be
+    attached, since the rings exist before the workers fork. A ring freed by
+    ``detach`` is reused with a new generation: records and results the
+    previous band left behind are dropped, not delivered to the next one.
+    """
+
+    def __init__(self, workers=None, max_bands=16, capacity=1 << 14, analytics=None, return_samples=True,
+                 batch=4096, poll_interval=0.002):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.rings = [SharedRing(capacity) for _ in range(max_bands)]
+        self.results = 0
+        self.samples = 0
+        self._bands = [None] * max_bands
+        self._stop = multiprocessing.Event()
+        self._queue = multiprocessing.Queue()
+        self._processes = []
+        for n in range(self.workers):
+            rings = [(i, ring) for i, ring in enumerate(self.rings) if i % self.workers == n]
+            process = multiprocessing.Process(target=_work, name='miband-worker-%d' % n,
+                                              args=(rings, self._queue, self._stop, analytics or {},
+                                                    return_samples, batch, poll_interval))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect, name='miband-worker-results')
+        self._collector.daemon = True
+        self._collector.start()
+
+    def attach(self, band):
+        """Hand the band's raw sensor data to the workers; subscribe to it with ``band.subscribe``."""
+        if band in self._bands:
+            return
+        try:
+            index = self._bands.index(None)
+        except ValueError:
+            raise ValueError("all %d rings are in use" % len(self._bands))
+        self._bands[index] = band
+        if band.fanout is None:
+            from fanout import FanOut
+            band.fanout = FanOut()
+        ring = self.rings[index]
+        put = ring.put
+        generation = ring.renew()
+
+        def sink(data, timestamp):
+            if len(data) == 20 and data[0:1] == b'\x01':
+                put(_ACCEL, data, timestamp, generation)
+            elif len(data) == 16:
+                put(_PPG, data, timestamp, generation)
+        band.raw_sink = sink
+
+    def detach(self, band):
+        band.raw_sink = None
+        if band in self._bands:
+            index = self._bands.index(band)
+            self.rings[index].renew()
+            self._bands[index] = None
+
+    def _collect(self):
+        while True:
+            try:
+                index, generation, out = self._queue.get(timeout=0.1)
+            except Empty:
+                if self._closed:
+                    return
+                continue
+            # results of a detached band's records
+            band = self._bands[index] if self.rings[index].generation == generation else None
+            self.results += 1
+            for _type, value in out:
+                if _type != ANALYTICS:
+                    self.samples += len(value['t'])
+                if band is not None:
+                    band.fanout.publish(_type, value)
+
+    def pending(self):
+        """Records written to the rings and not picked up by a worker yet."""
+        return sum(len(ring) for ring in self.rings)
+
+    def stats(self):
+        return {'workers': self.workers, 'results': self.results, 'samples': self.samples,
+                'bands': dict((band.mac_address, self.rings[i].stats())
+                              for i, band in enumerate(self._bands) if band is not None)}
+
+    def close(self, timeout=5.0):
+        """Let the workers drain their rings, then stop them and the collector."""
+        for band in self._bands:
+            if band is not None:
+                band.raw_sink = None
+        self._stop.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._closed = True
+        self._collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()